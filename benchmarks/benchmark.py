@@ -0,0 +1,448 @@
+"""Benchmark cdnupload against synthetic source trees and a fake S3.
+
+This generates a synthetic source tree (file count, size distribution,
+text/binary ratio, directory depth, and CRLF density are configurable), then
+times FileSource.build_key_map(), upload(), and delete() against an
+in-process fake of the boto3 S3 client. The fake client can inject per-request
+latency, limit bandwidth, and throttle the request rate, so no network access
+is needed. Results are written as JSON so runs can be compared across commits.
+
+Example (from the repository root):
+
+    python benchmarks/benchmark.py --files 2000 --latency 0.02 --output before.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cdnupload
+
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+TEXT_EXTENSIONS = ['.css', '.js', '.txt', '.html', '.svg']
+BINARY_EXTENSIONS = ['.png', '.jpg', '.woff', '.bin']
+
+
+def generate_tree(root, num_files=1000, median_size=4096, size_sigma=1.5,
+                  max_size=4*1024*1024, text_ratio=0.7, max_depth=4,
+                  files_per_dir=20, crlf_density=0.0, seed=0):
+    """Generate a synthetic source tree in directory "root" (which must
+    exist) and return the total number of bytes written.
+
+    File sizes are log-normally distributed around "median_size" (capped at
+    "max_size"); "text_ratio" is the fraction of files that are text; files
+    are spread over directories nested up to "max_depth" levels deep with
+    roughly "files_per_dir" files each; "crlf_density" is the fraction of
+    text lines ending with CR LF instead of LF.
+    """
+    rand = random.Random(seed)
+    dirs = ['']
+    total_bytes = 0
+    for i in range(num_files):
+        if i and i % files_per_dir == 0:
+            parent = rand.choice(dirs)
+            if parent.count(os.sep) + 1 < max_depth or not parent:
+                new_dir = os.path.join(parent, 'd{}'.format(len(dirs)))
+                os.mkdir(os.path.join(root, new_dir))
+                dirs.append(new_dir)
+        size = int(rand.lognormvariate(math.log(median_size), size_sigma))
+        size = max(1, min(size, max_size))
+        is_text = rand.random() < text_ratio
+        if is_text:
+            ext = rand.choice(TEXT_EXTENSIONS)
+            content = _text_content(rand, size, crlf_density)
+        else:
+            ext = rand.choice(BINARY_EXTENSIONS)
+            content = _binary_content(rand, size)
+        rel_path = os.path.join(rand.choice(dirs), 'f{}{}'.format(i, ext))
+        with open(os.path.join(root, rel_path), 'wb') as f:
+            f.write(content)
+        total_bytes += len(content)
+    return total_bytes
+
+
+def _text_content(rand, size, crlf_density):
+    line = (b'abcdefghijklmnopqrstuvwxyz0123456789 {}();:.,' * 2)[:79]
+    lines = []
+    length = 0
+    while length < size:
+        start = rand.randrange(len(line))
+        ending = b'\r\n' if rand.random() < crlf_density else b'\n'
+        chunk = line[start:] + line[:start] + ending
+        lines.append(chunk)
+        length += len(chunk)
+    return b''.join(lines)[:size]
+
+
+def _binary_content(rand, size):
+    # Seeded random bytes are slow to generate in pure Python, so repeat a
+    # random block; the hash still covers every byte
+    block = bytearray(rand.randrange(256) for _ in range(min(size, 4096)))
+    num_blocks = size // len(block) + 1
+    return bytes(block * num_blocks)[:size]
+
+
+class FakeBoto3(object):
+    """Stand-in for the boto3 module, passed to S3Destination as _boto3."""
+
+    def __init__(self, **s3_args):
+        self.s3_args = s3_args
+        self.s3 = None
+
+    @property
+    def session(self):
+        return self  # stands in for the boto3.session module
+
+    def Session(self):
+        return self
+
+    def client(self, name, **client_args):
+        assert name == 's3'
+        if self.s3 is None:
+            self.s3 = FakeS3Client(**self.s3_args)
+        return self.s3
+
+
+class FakeS3Client(object):
+    """In-memory fake of the boto3 S3 client methods cdnupload uses:
+    get_paginator('list_objects_v2'), upload_fileobj(), put_object(), and
+    delete_object().
+
+    Each request sleeps for "latency" seconds, transfers are limited to
+    "bandwidth" bytes per second (per request, if non-zero), and when
+    "max_requests_per_second" is non-zero requests beyond that rate are
+    delayed, as boto3's retries do when S3 responds with SlowDown.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=0, max_requests_per_second=0,
+                 page_size=1000):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.max_requests_per_second = max_requests_per_second
+        self.page_size = page_size
+        self.objects = {}
+        self.num_requests = 0
+        self.num_throttled = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self._next_request_time = 0.0
+
+    def _request(self, num_bytes=0):
+        delay = self.latency
+        with self._lock:
+            self.num_requests += 1
+            self.bytes_received += num_bytes
+            if self.max_requests_per_second:
+                now = _timer()
+                if self._next_request_time > now:
+                    self.num_throttled += 1
+                    delay += self._next_request_time - now
+                    now = self._next_request_time
+                self._next_request_time = now + 1.0 / self.max_requests_per_second
+        if self.bandwidth:
+            delay += float(num_bytes) / self.bandwidth
+        if delay > 0:
+            time.sleep(delay)
+
+    def get_paginator(self, name):
+        assert name == 'list_objects_v2'
+        return FakePaginator(self)
+
+    def upload_fileobj(self, file, bucket, key, ExtraArgs=None, Config=None):
+        data = file.read()
+        self._request(len(data))
+        with self._lock:
+            self.objects[key] = len(data)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.upload_fileobj(Body, Bucket, Key)
+
+    def delete_object(self, Bucket, Key):
+        self._request()
+        with self._lock:
+            self.objects.pop(Key, None)
+
+
+class FakePaginator(object):
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Bucket, Prefix=None, PaginationConfig=None):
+        page_size = (PaginationConfig or {}).get('PageSize', self.client.page_size)
+        page_size = min(page_size, self.client.page_size)
+        keys = sorted(k for k in self.client.objects
+                      if not Prefix or k.startswith(Prefix))
+        for i in range(0, max(len(keys), 1), page_size):
+            self.client._request()
+            yield {'Contents': [{'Key': k} for k in keys[i:i + page_size]]}
+
+
+def _remove_files(root, fraction, seed):
+    """Remove "fraction" of the files under root, so delete() has work."""
+    paths = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names.sort()
+        paths.extend(os.path.join(dir_path, n) for n in sorted(file_names))
+    rand = random.Random(seed)
+    removed = rand.sample(paths, int(len(paths) * fraction))
+    for path in removed:
+        os.remove(path)
+    return len(removed)
+
+
+def hash_throughput(root, repeat=3, source_args=None):
+    """Time FileSource.hash_file() separately over the text and binary
+    files in the tree (by extension), with and without
+    cache_text_by_extension. Return a dict of byte counts and throughputs.
+    """
+    source_args = dict(source_args or {}, cache_key_map=False)
+    rel_paths = list(cdnupload.FileSource(root, **source_args).walk_files())
+    kinds = {
+        'text': [p for p in rel_paths
+                 if os.path.splitext(p)[1] in TEXT_EXTENSIONS],
+        'binary': [p for p in rel_paths
+                   if os.path.splitext(p)[1] not in TEXT_EXTENSIONS],
+    }
+    results = {}
+    for by_extension in (False, True):
+        for kind, paths in sorted(kinds.items()):
+            best = None
+            for _ in range(repeat):
+                source = cdnupload.FileSource(
+                        root, cache_text_by_extension=by_extension,
+                        **source_args)
+                start = _timer()
+                for rel_path in paths:
+                    source.hash_file(rel_path)
+                elapsed = _timer() - start
+                best = elapsed if best is None else min(best, elapsed)
+            name = kind + ('_by_extension' if by_extension else '')
+            results[name] = {
+                'num_files': len(paths),
+                'num_bytes': source.bytes_hashed,
+                'bytes_per_second': source.bytes_hashed / best if best else None,
+            }
+    return results
+
+
+def _git_commit():
+    """Return the short hash of the current git commit, or None."""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=devnull)
+        return output.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _summary(times):
+    times = sorted(times)
+    return {
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'max': times[-1],
+    }
+
+
+def run_benchmark(num_files=1000, median_size=4096, size_sigma=1.5,
+                  max_size=4*1024*1024, text_ratio=0.7, max_depth=4,
+                  files_per_dir=20, crlf_density=0.0, delete_fraction=0.1,
+                  latency=0.0, bandwidth=0, max_requests_per_second=0,
+                  page_size=1000, repeat=3, seed=0, source_args=None,
+                  workers=1):
+    """Run the build_key_map, upload, and delete benchmarks; return a dict
+    of parameters and results suitable for dumping as JSON.
+    """
+    params = dict(
+        num_files=num_files, median_size=median_size, size_sigma=size_sigma,
+        max_size=max_size, text_ratio=text_ratio, max_depth=max_depth,
+        files_per_dir=files_per_dir, crlf_density=crlf_density,
+        delete_fraction=delete_fraction, latency=latency,
+        bandwidth=bandwidth, max_requests_per_second=max_requests_per_second,
+        page_size=page_size, repeat=repeat, seed=seed,
+        source_args=source_args or {}, workers=workers,
+    )
+    s3_args = dict(latency=latency, bandwidth=bandwidth,
+                   max_requests_per_second=max_requests_per_second,
+                   page_size=page_size)
+    source_args = dict(source_args or {}, cache_key_map=False)
+
+    tree_root = tempfile.mkdtemp(prefix='cdnupload-bench-')
+    try:
+        total_bytes = generate_tree(
+            tree_root, num_files=num_files, median_size=median_size,
+            size_sigma=size_sigma, max_size=max_size, text_ratio=text_ratio,
+            max_depth=max_depth, files_per_dir=files_per_dir,
+            crlf_density=crlf_density, seed=seed)
+
+        build_times = []
+        for _ in range(repeat):
+            source = cdnupload.FileSource(tree_root, **source_args)
+            start = _timer()
+            source.build_key_map()
+            build_times.append(_timer() - start)
+        hashing = hash_throughput(tree_root, repeat=repeat,
+                                  source_args=source_args)
+
+        upload_times = []
+        for _ in range(repeat):
+            boto3 = FakeBoto3(**s3_args)
+            destination = cdnupload.S3Destination('s3://bench/', _boto3=boto3)
+            source = cdnupload.FileSource(tree_root, **source_args)
+            start = _timer()
+            upload_result = cdnupload.upload(source, destination,
+                                             workers=workers)
+            upload_times.append(_timer() - start)
+        upload_client = boto3.s3
+
+        num_removed = _remove_files(tree_root, delete_fraction, seed)
+        delete_times = []
+        for _ in range(repeat):
+            boto3 = FakeBoto3(**s3_args)
+            boto3.client('s3').objects = dict(upload_client.objects)
+            destination = cdnupload.S3Destination('s3://bench/', _boto3=boto3)
+            source = cdnupload.FileSource(tree_root, **source_args)
+            start = _timer()
+            delete_result = cdnupload.delete(source, destination)
+            delete_times.append(_timer() - start)
+        delete_client = boto3.s3
+    finally:
+        shutil.rmtree(tree_root)
+
+    return {
+        'commit': _git_commit(),
+        'cdnupload_version': cdnupload.__version__,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'params': params,
+        'tree': {'num_files': num_files, 'num_bytes': total_bytes},
+        'results': {
+            'build_key_map': {
+                'seconds': _summary(build_times),
+                'files_per_second': num_files / min(build_times),
+                'bytes_per_second': total_bytes / min(build_times),
+            },
+            'hash_file': hashing,
+            'upload': {
+                'seconds': _summary(upload_times),
+                'num_uploaded': upload_result.num_uploaded,
+                'num_requests': upload_client.num_requests,
+                'num_throttled': upload_client.num_throttled,
+                'stats': upload_result.stats.as_dict(),
+            },
+            'delete': {
+                'seconds': _summary(delete_times),
+                'num_removed_files': num_removed,
+                'num_deleted': delete_result.num_deleted,
+                'num_requests': delete_client.num_requests,
+                'num_throttled': delete_client.num_throttled,
+                'stats': delete_result.stats.as_dict(),
+            },
+        },
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark cdnupload with a synthetic source tree and '
+                    'a fake S3 destination (no network access needed).')
+    parser.add_argument('--files', type=int, default=1000,
+                        help='number of files to generate (default %(default)s)')
+    parser.add_argument('--median-size', type=int, default=4096,
+                        help='median file size in bytes (default %(default)s)')
+    parser.add_argument('--size-sigma', type=float, default=1.5,
+                        help='sigma of log-normal file size distribution '
+                             '(default %(default)s)')
+    parser.add_argument('--max-size', type=int, default=4*1024*1024,
+                        help='maximum file size in bytes (default %(default)s)')
+    parser.add_argument('--text-ratio', type=float, default=0.7,
+                        help='fraction of files that are text (default %(default)s)')
+    parser.add_argument('--max-depth', type=int, default=4,
+                        help='maximum directory depth (default %(default)s)')
+    parser.add_argument('--files-per-dir', type=int, default=20,
+                        help='approximate files per directory (default %(default)s)')
+    parser.add_argument('--crlf-density', type=float, default=0.0,
+                        help='fraction of text lines ending in CR LF '
+                             '(default %(default)s)')
+    parser.add_argument('--delete-fraction', type=float, default=0.1,
+                        help='fraction of files removed before the delete '
+                             'benchmark (default %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='fake S3 latency per request in seconds '
+                             '(default %(default)s)')
+    parser.add_argument('--bandwidth', type=int, default=0,
+                        help='fake S3 upload bandwidth per request in bytes '
+                             'per second, 0 for unlimited (default %(default)s)')
+    parser.add_argument('--max-requests-per-second', type=float, default=0,
+                        help='fake S3 request rate before throttling, 0 for '
+                             'unlimited (default %(default)s)')
+    parser.add_argument('--page-size', type=int, default=1000,
+                        help='fake S3 listing page size (default %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of times to run each benchmark '
+                             '(default %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for tree generation (default %(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of upload workers (default %(default)s)')
+    parser.add_argument('--source-arg', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='extra FileSource keyword arg (VALUE is parsed '
+                             'as JSON if possible); may be given more than once')
+    parser.add_argument('-o', '--output',
+                        help='write JSON results to this file instead of stdout')
+    args = parser.parse_args(args)
+
+    # Per-file upload and delete messages would swamp the JSON output
+    logging.getLogger('cdnupload').setLevel(logging.ERROR)
+
+    source_args = {}
+    for arg in args.source_arg:
+        name, sep, value = arg.partition('=')
+        if not sep:
+            parser.error('--source-arg must be in the form NAME=VALUE')
+        try:
+            source_args[name] = json.loads(value)
+        except ValueError:
+            source_args[name] = value
+
+    results = run_benchmark(
+        num_files=args.files, median_size=args.median_size,
+        size_sigma=args.size_sigma, max_size=args.max_size,
+        text_ratio=args.text_ratio, max_depth=args.max_depth,
+        files_per_dir=args.files_per_dir, crlf_density=args.crlf_density,
+        delete_fraction=args.delete_fraction, latency=args.latency,
+        bandwidth=args.bandwidth,
+        max_requests_per_second=args.max_requests_per_second,
+        page_size=args.page_size, repeat=args.repeat, seed=args.seed,
+        source_args=source_args, workers=args.workers)
+
+    output = json.dumps(results, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
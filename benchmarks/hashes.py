@@ -0,0 +1,122 @@
+"""Compare hash algorithms (and tree hashing) for FileSource.build_key_map().
+
+This generates a synthetic source tree using benchmark.generate_tree() (so
+the size distribution can be matched to a real site), then times building
+the key map with each available hash algorithm in cdnupload.HASH_ALGORITHMS,
+optionally also in tree-hash mode. Algorithms whose packages aren't
+installed (xxh3_128 and blake3) are reported as unavailable. Results are
+written as JSON.
+
+Example (from the repository root):
+
+    python benchmarks/hashes.py --files 500 --median-size 100000 --tree-hash-chunk-size 1048576
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchmark
+from benchmark import cdnupload
+
+
+def time_build_key_map(root, repeat, **source_args):
+    """Return the best time (in seconds) of "repeat" build_key_map() runs."""
+    times = []
+    for _ in range(repeat):
+        source = cdnupload.FileSource(root, cache_key_map=False, **source_args)
+        start = benchmark._timer()
+        source.build_key_map()
+        times.append(benchmark._timer() - start)
+    return min(times)
+
+
+def run_hashes(algorithms=None, tree_hash_chunk_size=0, repeat=3, **tree_args):
+    """Time build_key_map() for each algorithm and return a results dict."""
+    root = tempfile.mkdtemp(prefix='cdnupload-hashes-')
+    try:
+        total_bytes = benchmark.generate_tree(root, **tree_args)
+        results = {}
+        for name in algorithms or cdnupload.HASH_ALGORITHMS:
+            try:
+                cdnupload.get_hash_class(name)
+            except ValueError as error:
+                results[name] = {'error': str(error)}
+                continue
+            seconds = time_build_key_map(root, repeat, hash_algorithm=name)
+            result = {
+                'seconds': seconds,
+                'bytes_per_second': total_bytes / seconds,
+            }
+            if tree_hash_chunk_size:
+                tree_seconds = time_build_key_map(
+                        root, repeat, hash_algorithm=name,
+                        tree_hash_chunk_size=tree_hash_chunk_size)
+                result['tree_seconds'] = tree_seconds
+                result['tree_bytes_per_second'] = total_bytes / tree_seconds
+            results[name] = result
+    finally:
+        shutil.rmtree(root)
+
+    return {
+        'cdnupload_version': cdnupload.__version__,
+        'params': dict(tree_args, repeat=repeat,
+                       tree_hash_chunk_size=tree_hash_chunk_size),
+        'tree': {'num_bytes': total_bytes},
+        'results': results,
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Compare hash algorithms for building the key map.')
+    parser.add_argument('--algorithm', action='append',
+                        choices=list(cdnupload.HASH_ALGORITHMS),
+                        help='algorithm to test (default all); may be given '
+                             'more than once')
+    parser.add_argument('--files', type=int, default=500,
+                        help='number of files to generate (default %(default)s)')
+    parser.add_argument('--median-size', type=int, default=16384,
+                        help='median file size in bytes (default %(default)s)')
+    parser.add_argument('--size-sigma', type=float, default=1.5,
+                        help='sigma of log-normal file size distribution '
+                             '(default %(default)s)')
+    parser.add_argument('--max-size', type=int, default=64*1024*1024,
+                        help='maximum file size in bytes (default %(default)s)')
+    parser.add_argument('--text-ratio', type=float, default=0.7,
+                        help='fraction of files that are text (default %(default)s)')
+    parser.add_argument('--tree-hash-chunk-size', type=int, default=0,
+                        help='also time tree hashing with this chunk size '
+                             '(default 0, off)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of times to run each benchmark '
+                             '(default %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for tree generation (default %(default)s)')
+    parser.add_argument('-o', '--output',
+                        help='write JSON results to this file instead of stdout')
+    args = parser.parse_args(args)
+
+    results = run_hashes(
+        algorithms=args.algorithm,
+        tree_hash_chunk_size=args.tree_hash_chunk_size, repeat=args.repeat,
+        num_files=args.files, median_size=args.median_size,
+        size_sigma=args.size_sigma, max_size=args.max_size,
+        text_ratio=args.text_ratio, seed=args.seed)
+
+    output = json.dumps(results, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""Benchmark HTTPDestination against a local stand-in origin server.
+
+This runs an http.server-based origin in a background thread. It accepts PUT
+requests (with a Content-Length or chunked body) and DELETE requests, and
+serves a paginated JSON listing of what it stores at /_list. It can inject
+per-request latency. The benchmark generates a synthetic source tree using
+benchmark.generate_tree(), then times upload() and delete() to the origin,
+once with HTTPDestination's keep-alive connection pool and once with a new
+connection for every request (keep_alive=false). Results are written as JSON.
+
+Example (from the repository root):
+
+    python benchmarks/http_origin.py --files 1000 --latency 0.002 --workers 8
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, unquote, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchmark
+from benchmark import cdnupload
+
+
+LIST_PATH = '/_list'
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """Request handler for Origin: PUT and DELETE objects by path, and GET
+    the listing at LIST_PATH.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.num_connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _start_request(self):
+        with self.server.lock:
+            self.server.num_requests += 1
+            self.server.requests.append((self.command, self.path,
+                                         dict(self.headers.items())))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def _respond(self, status, body=b'', content_type=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_PUT(self):
+        self._start_request()
+        body = self._read_body()
+        with self.server.lock:
+            self.server.objects[unquote(urlparse(self.path).path)] = body
+        self._respond(201)
+
+    def do_DELETE(self):
+        self._start_request()
+        with self.server.lock:
+            found = self.server.objects.pop(unquote(urlparse(self.path).path),
+                                            None)
+        self._respond(204 if found is not None else 404)
+
+    def do_GET(self):
+        self._start_request()
+        parsed = urlparse(self.path)
+        if parsed.path != LIST_PATH:
+            self._respond(404)
+            return
+        page = int(parse_qs(parsed.query).get('page', ['0'])[0])
+        page_size = self.server.page_size
+        with self.server.lock:
+            paths = sorted(self.server.objects)
+        listing = {'keys': paths[page * page_size:(page + 1) * page_size]}
+        if (page + 1) * page_size < len(paths):
+            listing['next'] = '{}?page={}'.format(LIST_PATH, page + 1)
+        self._respond(200, json.dumps(listing).encode('utf-8'),
+                      content_type='application/json')
+
+
+class Origin(ThreadingMixIn, HTTPServer):
+    """Stand-in origin server storing objects in memory ("objects" maps
+    path to contents). Each request sleeps for "latency" seconds, and the
+    listing returns "page_size" paths per page.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, page_size=1000):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), OriginHandler)
+        self.latency = latency
+        self.page_size = page_size
+        self.objects = {}
+        self.requests = []
+        self.num_requests = 0
+        self.num_connections = 0
+        self.lock = threading.Lock()
+        self.url = 'http://127.0.0.1:{}/'.format(self.server_address[1])
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+def run_http_benchmark(latency=0.0, workers=8, page_size=1000, repeat=3,
+                       **tree_args):
+    """Time upload() and delete() to an Origin with and without keep-alive
+    connections, and return a results dict.
+    """
+    logging.getLogger('cdnupload').setLevel(logging.CRITICAL)
+    root = tempfile.mkdtemp(prefix='cdnupload-http-')
+    try:
+        total_bytes = benchmark.generate_tree(root, **tree_args)
+        results = {}
+        for keep_alive in (True, False):
+            upload_times = []
+            delete_times = []
+            for _ in range(repeat):
+                origin = Origin(latency=latency, page_size=page_size).start()
+                try:
+                    destination = cdnupload.HTTPDestination(
+                            origin.url + 'static/', list_url=LIST_PATH,
+                            workers=workers, keep_alive=keep_alive)
+                    source = cdnupload.FileSource(root)
+                    source.build_key_map()
+                    start = benchmark._timer()
+                    cdnupload.upload(source, destination, workers=workers)
+                    upload_times.append(benchmark._timer() - start)
+
+                    empty = tempfile.mkdtemp(prefix='cdnupload-http-empty-')
+                    try:
+                        start = benchmark._timer()
+                        cdnupload.delete(empty, destination, force=True)
+                        delete_times.append(benchmark._timer() - start)
+                    finally:
+                        shutil.rmtree(empty)
+                    num_requests = origin.num_requests
+                    num_connections = origin.num_connections
+                finally:
+                    origin.stop()
+            results['keep_alive' if keep_alive else 'no_keep_alive'] = {
+                'upload': benchmark._summary(upload_times),
+                'delete': benchmark._summary(delete_times),
+                'num_requests': num_requests,
+                'num_connections': num_connections,
+            }
+    finally:
+        shutil.rmtree(root)
+
+    return {
+        'cdnupload_version': cdnupload.__version__,
+        'params': dict(tree_args, latency=latency, workers=workers,
+                       page_size=page_size, repeat=repeat),
+        'tree': {'num_bytes': total_bytes},
+        'results': results,
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark HTTPDestination against a local origin.')
+    parser.add_argument('--files', type=int, default=500,
+                        help='number of files to generate (default %(default)s)')
+    parser.add_argument('--median-size', type=int, default=4096,
+                        help='median file size in bytes (default %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the origin sleeps per request '
+                             '(default %(default)s)')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='number of upload threads (default %(default)s)')
+    parser.add_argument('--page-size', type=int, default=1000,
+                        help='keys per listing page (default %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of times to run each benchmark '
+                             '(default %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for tree generation (default %(default)s)')
+    parser.add_argument('-o', '--output',
+                        help='write JSON results to this file instead of stdout')
+    args = parser.parse_args(args)
+
+    results = run_http_benchmark(
+        latency=args.latency, workers=args.workers, page_size=args.page_size,
+        repeat=args.repeat, num_files=args.files,
+        median_size=args.median_size, seed=args.seed)
+
+    output = json.dumps(results, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
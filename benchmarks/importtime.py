@@ -0,0 +1,106 @@
+"""Measure how long "import cdnupload" takes, using python -X importtime.
+
+This runs a fresh interpreter several times and reports the best cumulative
+import time of the cdnupload module (in microseconds) along with the modules
+it pulled in, as JSON. Use --max-us to fail (exit code 1) if the import
+gets slower than a given threshold, for example in CI.
+
+Example (from the repository root, Python 3.7+):
+
+    python benchmarks/importtime.py --repeat 10 --max-us 20000
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure_import(module='cdnupload'):
+    """Import module in a fresh interpreter with -X importtime and return a
+    tuple of (cumulative_us, imported), where imported is a list of
+    (module_name, self_us, cumulative_us) tuples for each module imported
+    while importing it (not counting modules already loaded at startup).
+    """
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, stderr = process.communicate()
+    if process.returncode != 0:
+        raise Exception('importing {} failed:\n{}'.format(
+                module, stderr.decode('utf-8', 'replace')))
+
+    imported = []
+    total = None
+    lines = [line for line in stderr.decode('utf-8', 'replace').splitlines()
+             if line.startswith('import time:') and 'self [us]' not in line]
+    for line in lines:
+        self_us, cumulative_us, name = line.split(':', 1)[1].split('|')
+        # Output is in post-order, with nested imports indented further
+        depth = len(name) - len(name.lstrip())
+        imported.append((name.strip(), int(self_us), int(cumulative_us),
+                         depth))
+    for i, (name, _, cumulative_us, depth) in enumerate(imported):
+        if name == module:
+            total = cumulative_us
+            children = []
+            for child in reversed(imported[:i]):
+                if child[3] <= depth:
+                    break
+                children.append(child[:3])
+            imported = children[::-1]
+            break
+    if total is None:
+        raise Exception('{} not found in -X importtime output'.format(module))
+    return total, imported
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Measure "import cdnupload" time with -X importtime.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of fresh interpreters to run '
+                             '(default %(default)s)')
+    parser.add_argument('--max-us', type=int,
+                        help='exit with code 1 if the best import time is '
+                             'more than this many microseconds')
+    parser.add_argument('-o', '--output',
+                        help='write JSON results to this file instead of stdout')
+    args = parser.parse_args(args)
+
+    runs = [measure_import() for _ in range(args.repeat)]
+    times = sorted(total for total, _ in runs)
+    best_total, best_imported = min(runs, key=lambda r: r[0])
+    results = {
+        'python': sys.version.split()[0],
+        'repeat': args.repeat,
+        'import_us': {
+            'min': times[0],
+            'median': times[len(times) // 2],
+            'max': times[-1],
+        },
+        'modules': sorted(name for name, _, _ in best_imported),
+    }
+
+    output = json.dumps(results, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.max_us is not None and times[0] > args.max_us:
+        print('import cdnupload took {} us, more than --max-us {}'.format(
+                times[0], args.max_us), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
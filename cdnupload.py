@@ -13,30 +13,55 @@ https://github.com/benhoyt/cdnupload
 
 from __future__ import print_function
 
-import argparse
+# Only cheap modules are imported here, so that importing cdnupload (for
+# example, just to read __version__) and running short actions start fast.
+# Heavier modules like argparse, json, hashlib, and shutil are imported in
+# the functions that need them.
 import collections
+import contextlib
 import errno
-import fnmatch
-import hashlib
-import json
+import functools
+import heapq
+import io
 import logging
-import mimetypes
+import math
 import os
-import re
-import shutil
+import struct
 import sys
-try:
-    from urllib.parse import urlparse
-except ImportError:
-    from urlparse import urlparse
+import threading
+import time
+import zlib
 
 
 __all__ = ['SourceError', 'DestinationError', 'FileSource', 'Destination',
-           'FileDestination', 'S3Destination', 'upload', 'delete']
+           'FileDestination', 'S3Destination', 'HTTPDestination', 'upload',
+           'delete', 'sync', 'write_plan', 'apply_plan', 'merge_key_maps',
+           'write_key_map', 'read_key_map', 'diff_key_maps', 'split_key_map',
+           'make_import_map', 'make_preload_links', 'KeyMap', 'get_hash_class',
+           'Stats', 'RateLimiter', 'ThroughputHistory', 'Hook', 'add_hook',
+           'remove_hook']
 
 __version__ = '1.0.4'
 
 DEFAULT_HASH_LENGTH = 16
+MAX_SHARED_READ_SIZE = 8*1024*1024
+PLAN_VERSION = 1
+FINGERPRINT_CACHE_VERSION = 1
+KEY_MAP_FORMATS = ['json', 'index', 'sqlite']
+
+# Hash algorithms selectable by name: (module, class name, pip package if
+# it's not in the standard library)
+HASH_ALGORITHMS = collections.OrderedDict([
+    ('sha1', ('hashlib', 'sha1', None)),
+    ('sha256', ('hashlib', 'sha256', None)),
+    ('md5', ('hashlib', 'md5', None)),
+    ('blake2b', ('hashlib', 'blake2b', None)),
+    ('blake2s', ('hashlib', 'blake2s', None)),
+    ('xxh3_128', ('xxhash', 'xxh3_128', 'xxhash')),
+    ('blake3', ('blake3', 'blake3', 'blake3')),
+])
+KEY_MAP_INDEX_MAGIC = b'CDNKMAP1'
+_UINT32 = struct.Struct('<I')
 LOG_LEVELS = [
     ('debug', logging.DEBUG),
     ('verbose', logging.INFO),
@@ -47,11 +72,164 @@ LOG_LEVELS = [
 
 logger = logging.getLogger('cdnupload')
 
+# Highest-resolution timer available (time.perf_counter isn't in Python 2.x)
+_timer = getattr(time, 'perf_counter', time.time)
+
+# os.scandir() avoids a stat per directory entry, but isn't in Python 2.x
+_scandir = getattr(os, 'scandir', None)
+
 
 IS_PY2 = sys.version_info < (3, 0)
 if IS_PY2:
     input = raw_input
 
+# Content types for common static file extensions, used before falling back
+# to the mimetypes module (which reads the system's MIME databases the first
+# time it's used, and whose answers vary from system to system)
+CONTENT_TYPES = {
+    '.avif': 'image/avif',
+    '.bmp': 'image/bmp',
+    '.css': 'text/css',
+    '.csv': 'text/csv',
+    '.eot': 'application/vnd.ms-fontobject',
+    '.gif': 'image/gif',
+    '.htm': 'text/html',
+    '.html': 'text/html',
+    '.ico': 'image/vnd.microsoft.icon',
+    '.jpeg': 'image/jpeg',
+    '.jpg': 'image/jpeg',
+    '.js': 'application/javascript',
+    '.json': 'application/json',
+    '.map': 'application/json',
+    '.mjs': 'application/javascript',
+    '.mp3': 'audio/mpeg',
+    '.mp4': 'video/mp4',
+    '.otf': 'font/otf',
+    '.pdf': 'application/pdf',
+    '.png': 'image/png',
+    '.svg': 'image/svg+xml',
+    '.ttf': 'font/ttf',
+    '.txt': 'text/plain',
+    '.wasm': 'application/wasm',
+    '.webm': 'video/webm',
+    '.webp': 'image/webp',
+    '.woff': 'font/woff',
+    '.woff2': 'font/woff2',
+    '.xml': 'application/xml',
+    '.zip': 'application/zip',
+}
+
+
+# Patterns for the references FileSource finds to rewrite (rewrite_css and
+# rewrite_html); the URL is in whichever group matched
+CSS_URL_PATTERN = br'''url\(\s*(?:"([^"]*)"|'([^']*)'|([^)'"\s]*))\s*\)'''
+CSS_IMPORT_PATTERN = br'''@import\s+(?:"([^"]*)"|'([^']*)')'''
+HTML_ATTR_PATTERN = (br'''(?i)\s(?:src|href)\s*=\s*'''
+                     br'''(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''')
+
+
+# Value of the "as" attribute of <link rel="preload"> by file extension
+# (see make_preload_links)
+PRELOAD_AS = {
+    '.avif': 'image',
+    '.css': 'style',
+    '.gif': 'image',
+    '.ico': 'image',
+    '.jpeg': 'image',
+    '.jpg': 'image',
+    '.js': 'script',
+    '.otf': 'font',
+    '.png': 'image',
+    '.svg': 'image',
+    '.ttf': 'font',
+    '.webp': 'image',
+    '.woff': 'font',
+    '.woff2': 'font',
+}
+
+
+def _guess_content_type(rel_path):
+    """Return the content type (MIME type) for given relative path based on
+    its extension, or None if it's not known. Common extensions are looked
+    up in CONTENT_TYPES, other extensions using the mimetypes module.
+    """
+    ext = os.path.splitext(rel_path)[1].lower()
+    content_type = CONTENT_TYPES.get(ext)
+    if content_type is None:
+        import mimetypes
+        content_type = mimetypes.guess_type(rel_path)[0]
+    return content_type
+
+
+def _file_size(file):
+    """Return size in bytes of given open file object, or None if it can't
+    be determined.
+    """
+    if isinstance(file, _ThrottledFile):
+        file = file.file
+    if isinstance(file, io.BytesIO):
+        return len(file.getvalue())
+    try:
+        return os.fstat(file.fileno()).st_size
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return None
+
+
+def _method_function(method):
+    """Return the function underlying given method (on Python 2, accessing a
+    method on a class creates a new unbound method object each time).
+    """
+    return getattr(method, '__func__', method)
+
+
+def _fstat(file):
+    """Return os.fstat() result for given open file object, or None if it
+    isn't a real file.
+    """
+    try:
+        return os.fstat(file.fileno())
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return None
+
+
+def get_hash_class(name):
+    """Return the hash class for given algorithm name (one of the keys of
+    HASH_ALGORITHMS). Raise ValueError if the name isn't known or the
+    algorithm isn't available.
+    """
+    try:
+        module_name, class_name, package = HASH_ALGORITHMS[name]
+    except KeyError:
+        raise ValueError('unknown hash algorithm {!r} (must be one of '
+                         '{})'.format(name, ', '.join(HASH_ALGORITHMS)))
+    try:
+        module = __import__(module_name)
+        return getattr(module, class_name)
+    except (ImportError, AttributeError):
+        if package:
+            raise ValueError('{} must be installed to use hash algorithm {}, '
+                             'try: pip install {}'.format(package, name, package))
+        raise ValueError('hash algorithm {} is not available in this version '
+                         'of Python'.format(name))
+
+
+def _hash_class_name(hash_class):
+    """Return a name for given hash class, like 'sha1' for hashlib.sha1."""
+    try:
+        return hash_class().name.lower()
+    except Exception:
+        return getattr(hash_class, '__name__', 'unknown')
+
+
+def shard_index(rel_path, num_shards):
+    """Return the shard (from 1 to num_shards) that given relative path is
+    in. This uses CRC-32 of the UTF-8 encoded path, so it's stable across
+    machines, platforms, and Python versions.
+    """
+    if not isinstance(rel_path, bytes):
+        rel_path = rel_path.encode('utf-8')
+    return (zlib.crc32(rel_path) & 0xffffffff) % num_shards + 1
+
 
 class Error(Exception):
     """Base class that all exceptions raised in this module inherit from."""
@@ -74,6 +252,18 @@ class DeleteAllKeysError(Error):
     """Raised when delete() would delete all keys in destination."""
 
 
+class PlanError(Error):
+    """Raised when a plan file is invalid or incomplete, or when the source
+    no longer matches the plan.
+    """
+
+
+class KeyMapError(Error):
+    """Raised when partial key maps written by sharded runs can't be merged,
+    or when a key map index file is invalid.
+    """
+
+
 class DestinationError(Error):
     """Raised when an error occurs accessing the destination (usually
     uploading or deleting). Where relevant, includes the destination key in
@@ -89,6 +279,827 @@ class DestinationError(Error):
         return '{}: {}'.format(self.message, self.error)
 
 
+class LatencyHistogram(object):
+    """Histogram of operation latencies in seconds, using exponentially-sized
+    buckets (each 25% larger than the last, from 10 microseconds up to about
+    an hour), so memory use is constant no matter how many values are added.
+    Percentiles are approximate (to within a bucket's width).
+    """
+    MIN_SECONDS = 0.00001
+    FACTOR = 1.25
+    NUM_BUCKETS = 90
+
+    def __init__(self):
+        self.counts = [0] * self.NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """Add a single latency value to the histogram."""
+        if seconds <= self.MIN_SECONDS:
+            index = 0
+        else:
+            index = int(math.log(seconds / self.MIN_SECONDS) /
+                        math.log(self.FACTOR)) + 1
+            index = min(index, self.NUM_BUCKETS - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        """Add all the values from another histogram to this one."""
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """Return approximate latency at given percentile (0 to 100), or 0.0
+        if the histogram is empty.
+        """
+        if not self.count:
+            return 0.0
+        target = self.count * percent / 100.0
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target and count:
+                if i == self.NUM_BUCKETS - 1:
+                    break
+                upper = self.MIN_SECONDS * self.FACTOR ** i
+                return min(upper, self.max)
+        return self.max
+
+    def as_dict(self):
+        """Return summary of histogram as a dict."""
+        return collections.OrderedDict([
+            ('count', self.count),
+            ('total', self.total),
+            ('p50', self.percentile(50)),
+            ('p95', self.percentile(95)),
+            ('p99', self.percentile(99)),
+            ('max', self.max),
+        ])
+
+
+class TimingFit(object):
+    """Running sums for a least-squares fit of operation time against
+    number of bytes, seconds = latency + num_bytes * seconds_per_byte. The
+    sums can be added together and scaled, so a fit can be kept up to date
+    (and persisted) without storing the individual operations.
+    """
+    FIELDS = ['count', 'bytes', 'seconds', 'bytes_squared', 'bytes_seconds']
+
+    def __init__(self, count=0, bytes=0.0, seconds=0.0, bytes_squared=0.0,
+                 bytes_seconds=0.0):
+        self.count = count
+        self.bytes = float(bytes)
+        self.seconds = float(seconds)
+        self.bytes_squared = float(bytes_squared)
+        self.bytes_seconds = float(bytes_seconds)
+
+    def add(self, num_bytes, seconds):
+        """Add a single operation that took given number of seconds."""
+        self.count += 1
+        self.bytes += num_bytes
+        self.seconds += seconds
+        self.bytes_squared += float(num_bytes) * num_bytes
+        self.bytes_seconds += num_bytes * seconds
+
+    def merge(self, other):
+        """Add all the operations from another TimingFit to this one."""
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+    def scale(self, factor):
+        """Multiply the sums by factor (less than 1 to give older
+        operations less weight).
+        """
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field) * factor)
+
+    def solve(self):
+        """Return (latency, seconds_per_byte) tuple, or None if there are no
+        operations. If the fit isn't meaningful (for example, all operations
+        were the same size), fall back to time proportional to bytes, or to
+        a fixed latency if there were no bytes.
+        """
+        if not self.count:
+            return None
+        variance = self.count * self.bytes_squared - self.bytes ** 2
+        if variance > 1e-9 * self.count * self.bytes_squared:
+            slope = (self.count * self.bytes_seconds -
+                     self.bytes * self.seconds) / variance
+            latency = (self.seconds - slope * self.bytes) / self.count
+            if slope >= 0 and latency >= 0:
+                return (latency, slope)
+            if slope < 0:
+                return (self.seconds / self.count, 0.0)
+        if self.bytes:
+            return (0.0, self.seconds / self.bytes)
+        return (self.seconds / self.count, 0.0)
+
+    def as_dict(self):
+        """Return the sums as a JSON-serializable dict."""
+        return collections.OrderedDict(
+                (field, getattr(self, field)) for field in self.FIELDS)
+
+    @classmethod
+    def from_dict(cls, d):
+        """Create a TimingFit from a dict returned by as_dict()."""
+        return cls(**dict((field, d[field]) for field in cls.FIELDS))
+
+
+class Stats(object):
+    """Timing and throughput statistics for an upload, delete, or key map
+    build: wall time per phase ('walk', 'hash', 'list', 'upload', and
+    'delete'), bytes hashed and uploaded, a LatencyHistogram and TimingFit
+    per operation ('hash', 'list' pages, 'upload', 'delete'), the
+    "num_slowest" slowest individual operations, and the number of waits
+    and total seconds spent waiting for a RateLimiter. For a dry run,
+    "estimate" is an Estimate of what the real run would do. Methods that
+    add values are thread-safe.
+    """
+
+    def __init__(self, num_slowest=10):
+        self.num_slowest = num_slowest
+        self.phase_times = collections.OrderedDict()
+        self.bytes_hashed = 0
+        self.bytes_uploaded = 0
+        self.latencies = collections.OrderedDict()
+        self.fits = collections.OrderedDict()
+        self.slowest = []  # heap of (seconds, operation, name, num_bytes)
+        self.throttle_waits = 0
+        self.throttle_seconds = 0.0
+        self.estimate = None
+        self._lock = threading.Lock()
+
+    def add_phase_time(self, phase, seconds):
+        """Add wall time in seconds spent in given phase."""
+        with self._lock:
+            self.phase_times[phase] = self.phase_times.get(phase, 0.0) + seconds
+
+    def add_operation(self, operation, name, seconds, num_bytes=0):
+        """Record a single operation (for example, uploading a file) that
+        took given number of seconds and processed num_bytes bytes.
+        """
+        with self._lock:
+            if operation not in self.latencies:
+                self.latencies[operation] = LatencyHistogram()
+                self.fits[operation] = TimingFit()
+            self.latencies[operation].add(seconds)
+            self.fits[operation].add(num_bytes, seconds)
+            if operation == 'hash':
+                self.bytes_hashed += num_bytes
+            elif operation == 'upload':
+                self.bytes_uploaded += num_bytes
+            item = (seconds, operation, name, num_bytes)
+            if len(self.slowest) < self.num_slowest:
+                heapq.heappush(self.slowest, item)
+            elif self.slowest and item > self.slowest[0]:
+                heapq.heapreplace(self.slowest, item)
+
+    def add_throttle(self, seconds):
+        """Record a single wait of given number of seconds for a rate
+        limiter.
+        """
+        with self._lock:
+            self.throttle_waits += 1
+            self.throttle_seconds += seconds
+
+    def copy(self):
+        """Return a copy of this Stats instance."""
+        stats = Stats(num_slowest=self.num_slowest)
+        stats.merge(self)
+        return stats
+
+    def merge(self, other):
+        """Add all the statistics from another Stats instance to this one."""
+        with self._lock:
+            for phase, seconds in other.phase_times.items():
+                self.phase_times[phase] = self.phase_times.get(phase, 0.0) + seconds
+            self.bytes_hashed += other.bytes_hashed
+            self.bytes_uploaded += other.bytes_uploaded
+            for operation, histogram in other.latencies.items():
+                if operation not in self.latencies:
+                    self.latencies[operation] = LatencyHistogram()
+                    self.fits[operation] = TimingFit()
+                self.latencies[operation].merge(histogram)
+                self.fits[operation].merge(other.fits[operation])
+            self.slowest = heapq.nlargest(self.num_slowest,
+                                          self.slowest + other.slowest)
+            heapq.heapify(self.slowest)
+            self.throttle_waits += other.throttle_waits
+            self.throttle_seconds += other.throttle_seconds
+
+    def as_dict(self):
+        """Return statistics as a JSON-serializable dict."""
+        d = collections.OrderedDict([
+            ('phases', collections.OrderedDict(self.phase_times)),
+            ('bytes_hashed', self.bytes_hashed),
+            ('bytes_uploaded', self.bytes_uploaded),
+            ('operations', collections.OrderedDict(
+                (op, h.as_dict()) for op, h in self.latencies.items())),
+            ('slowest', [
+                collections.OrderedDict([
+                    ('operation', operation),
+                    ('name', name),
+                    ('seconds', seconds),
+                    ('bytes', num_bytes),
+                ])
+                for seconds, operation, name, num_bytes
+                in sorted(self.slowest, reverse=True)
+            ]),
+            ('throttle', collections.OrderedDict([
+                ('waits', self.throttle_waits),
+                ('seconds', self.throttle_seconds),
+            ])),
+        ])
+        if self.estimate is not None:
+            d['estimate'] = self.estimate.as_dict()
+        return d
+
+    def prometheus_samples(self, labels=None):
+        """Yield (metric_family, line) tuples of these statistics in
+        Prometheus text format, with given dict of extra labels.
+        """
+        for phase, seconds in self.phase_times.items():
+            yield ('phase_seconds', _prometheus_line(
+                    'phase_seconds', seconds, labels, phase=phase))
+        yield ('bytes_hashed', _prometheus_line(
+                'bytes_hashed', self.bytes_hashed, labels))
+        yield ('bytes_uploaded', _prometheus_line(
+                'bytes_uploaded', self.bytes_uploaded, labels))
+        for operation, histogram in self.latencies.items():
+            for quantile in (50, 95, 99):
+                yield ('operation_seconds', _prometheus_line(
+                        'operation_seconds', histogram.percentile(quantile),
+                        labels, operation=operation,
+                        quantile='{:.2f}'.format(quantile / 100.0)))
+            yield ('operation_seconds', _prometheus_line(
+                    'operation_seconds_sum', histogram.total, labels,
+                    operation=operation))
+            yield ('operation_seconds', _prometheus_line(
+                    'operation_seconds_count', histogram.count, labels,
+                    operation=operation))
+        yield ('throttle_seconds', _prometheus_line(
+                'throttle_seconds', self.throttle_seconds, labels))
+
+
+class Estimate(object):
+    """Estimate of what a dry run would do if run for real: the number of
+    bytes to upload, the number of requests of each type in "requests"
+    ('put' for single-request uploads, 'multipart_uploads' and
+    'multipart_parts' for large uploads to destinations with a
+    multipart_threshold, 'delete', and 'list' pages), and the estimated
+    wall time of each phase in "seconds" ('list', 'upload', 'delete'). A
+    phase's time is None if there's no throughput history to estimate it
+    from.
+    """
+    REQUEST_TYPES = ['put', 'multipart_uploads', 'multipart_parts',
+                     'delete', 'list']
+
+    def __init__(self):
+        self.bytes = 0
+        self.requests = collections.OrderedDict(
+                (t, 0) for t in self.REQUEST_TYPES)
+        self.seconds = collections.OrderedDict()
+
+    @property
+    def total_seconds(self):
+        """Estimated total wall time in seconds, or None if any phase's time
+        couldn't be estimated.
+        """
+        if any(s is None for s in self.seconds.values()):
+            return None
+        return sum(self.seconds.values())
+
+    def add_list(self, num_pages, seconds):
+        """Set the number of list pages and time taken to list (which a dry
+        run measures directly).
+        """
+        self.requests['list'] = num_pages
+        self.seconds['list'] = seconds
+
+    def add_uploads(self, destination, sizes, fit=None, workers=1,
+                    rate_limiter=None):
+        """Add uploads of files with given sizes (list of bytes) to
+        destination, with per-upload timings estimated from "fit" (a
+        TimingFit, or None if unknown) spread over "workers" threads.
+        """
+        threshold = getattr(destination, 'multipart_threshold', None)
+        chunk_size = getattr(destination, 'multipart_chunksize', None)
+        for size in sizes:
+            self.bytes += size
+            if threshold and chunk_size and size >= threshold:
+                self.requests['multipart_uploads'] += 1
+                self.requests['multipart_parts'] += max(
+                        1, (size + chunk_size - 1) // chunk_size)
+            else:
+                self.requests['put'] += 1
+
+        solution = fit.solve() if fit is not None else None
+        if not sizes:
+            seconds = 0.0
+        elif solution is None:
+            seconds = None
+        else:
+            latency, seconds_per_byte = solution
+            times = [latency + size * seconds_per_byte for size in sizes]
+            # Workers take the largest files first, so the run can't finish
+            # before the longest single upload
+            seconds = max(sum(times) / max(workers, 1), max(times))
+            if rate_limiter is not None:
+                if rate_limiter.max_bandwidth:
+                    seconds = max(seconds, float(sum(sizes)) /
+                                  rate_limiter.max_bandwidth)
+                if rate_limiter.max_requests_per_second:
+                    seconds = max(seconds, float(len(sizes)) /
+                                  rate_limiter.max_requests_per_second)
+        self._add_seconds('upload', seconds)
+
+    def add_deletes(self, num_deletes, fit=None, rate_limiter=None):
+        """Add num_deletes deletes (which are done one at a time), with
+        timings estimated from "fit".
+        """
+        self.requests['delete'] += num_deletes
+        solution = fit.solve() if fit is not None else None
+        if not num_deletes:
+            seconds = 0.0
+        elif solution is None:
+            seconds = None
+        else:
+            seconds = num_deletes * solution[0]
+            if rate_limiter is not None and rate_limiter.max_requests_per_second:
+                seconds = max(seconds, float(num_deletes) /
+                              rate_limiter.max_requests_per_second)
+        self._add_seconds('delete', seconds)
+
+    def _add_seconds(self, phase, seconds):
+        if phase in self.seconds:
+            if seconds is None or self.seconds[phase] is None:
+                seconds = None
+            else:
+                seconds += self.seconds[phase]
+        self.seconds[phase] = seconds
+
+    def as_dict(self):
+        """Return estimate as a JSON-serializable dict."""
+        return collections.OrderedDict([
+            ('bytes', self.bytes),
+            ('requests', collections.OrderedDict(self.requests)),
+            ('seconds', collections.OrderedDict(self.seconds)),
+            ('total_seconds', self.total_seconds),
+        ])
+
+    def __str__(self):
+        requests = ', '.join('{} {}'.format(n, t.replace('_', ' '))
+                             for t, n in self.requests.items() if n)
+        total = self.total_seconds
+        return '{} bytes to upload, {} requests ({}), {}'.format(
+                self.bytes, sum(self.requests.values()), requests or 'none',
+                'about {:.3f} seconds'.format(total) if total is not None
+                else 'no throughput history to estimate time')
+
+
+class ThroughputHistory(object):
+    """History of observed upload and delete timings for each destination
+    (a TimingFit per operation, keyed by str(destination)), persisted as
+    JSON at "path" if given. Pass an instance to upload(), delete(), or
+    sync() to record the timings of a real run, or to estimate the time
+    of a dry run. Call save() to write the history back to "path".
+
+    Once an operation has more than "max_count" timings, the older ones are
+    scaled down when new ones are added, so that estimates follow changes
+    in network conditions.
+    """
+    VERSION = 1
+    OPERATIONS = ['upload', 'delete']
+
+    def __init__(self, path=None, max_count=10000):
+        self.path = path
+        self.max_count = max_count
+        self.destinations = {}
+        self._lock = threading.Lock()
+        if path is not None:
+            self._load()
+
+    def _load(self):
+        import json
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get('version') != self.VERSION:
+                raise ValueError('unknown version {!r}'.format(
+                        data.get('version')))
+            for name, operations in data['destinations'].items():
+                self.destinations[name] = dict(
+                        (op, TimingFit.from_dict(fit))
+                        for op, fit in operations.items())
+        except (IOError, OSError) as error:
+            if error.errno != errno.ENOENT:
+                logger.warning('ignoring throughput history %s: %s',
+                               self.path, error)
+        except (ValueError, KeyError, TypeError, AttributeError) as error:
+            logger.warning('ignoring invalid throughput history %s: %s',
+                           self.path, error)
+            self.destinations = {}
+
+    def get_fit(self, destination, operation):
+        """Return TimingFit for given destination and operation, or None if
+        there's no history for it.
+        """
+        with self._lock:
+            return self.destinations.get(str(destination), {}).get(operation)
+
+    def record(self, destination, stats, operation):
+        """Add the timings of given operation ('upload' or 'delete') from
+        stats (a Stats instance) to the history for destination.
+        """
+        fit = stats.fits.get(operation)
+        if fit is None or not fit.count:
+            return
+        with self._lock:
+            operations = self.destinations.setdefault(str(destination), {})
+            old_fit = operations.setdefault(operation, TimingFit())
+            old_fit.merge(fit)
+            if old_fit.count > self.max_count:
+                old_fit.scale(float(self.max_count) / old_fit.count)
+
+    def save(self):
+        """Write the history to "path" atomically."""
+        import json
+        with self._lock:
+            data = collections.OrderedDict([
+                ('version', self.VERSION),
+                ('destinations', collections.OrderedDict(
+                    (name, collections.OrderedDict(
+                        (op, operations[op].as_dict())
+                        for op in self.OPERATIONS if op in operations))
+                    for name, operations in sorted(self.destinations.items()))),
+            ])
+        _write_file_atomic(self.path, json.dumps(data, indent=4) + '\n')
+
+
+def _prometheus_line(name, value, labels, **extra_labels):
+    """Return a single Prometheus text format sample line."""
+    all_labels = dict(labels or {}, **extra_labels)
+    label_str = ','.join(
+            '{}="{}"'.format(
+                k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in sorted(all_labels.items()))
+    return 'cdnupload_{}{{{}}} {!r}'.format(name, label_str, value)
+
+
+PROMETHEUS_HELP = [
+    ('files', 'gauge', 'Number of files scanned, processed, and with errors.'),
+    ('phase_seconds', 'gauge', 'Wall time spent in each phase.'),
+    ('bytes_hashed', 'gauge', 'Number of bytes read and hashed from source.'),
+    ('bytes_uploaded', 'gauge', 'Number of bytes uploaded to destination.'),
+    ('operation_seconds', 'summary', 'Latency of individual operations.'),
+    ('throttle_seconds', 'gauge', 'Time spent waiting for the rate limiter.'),
+    ('connections', 'gauge', 'Destination clients, HTTP requests, new '
+                             'connections, and reused connections.'),
+]
+
+
+@contextlib.contextmanager
+def _atomic_path(path):
+    """Context manager that yields a temporary path in the same directory as
+    "path" to write to, and renames it over "path" when the block finishes
+    successfully (or removes it if an exception is raised). Readers see
+    either the old file or the complete new one, never a partial file.
+    """
+    temp_path = '{}.tmp{}'.format(path, os.getpid())
+    try:
+        yield temp_path
+        getattr(os, 'replace', os.rename)(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _write_file_atomic(path, text):
+    """Write text to file at given path atomically, by writing to a temporary
+    file in the same directory and then renaming it over the original.
+    """
+    with _atomic_path(path) as temp_path:
+        with open(temp_path, 'w') as f:
+            f.write(text)
+
+
+def _write_stats(destinations, results, json_path=None,
+                 prometheus_path=None):
+    """Write statistics from given lists of destinations and corresponding
+    Result namedtuples to a JSON file at json_path and/or a Prometheus
+    textfile-collector file at prometheus_path (written atomically).
+    """
+    if json_path:
+        data = []
+        for destination, result in zip(destinations, results):
+            item = collections.OrderedDict([
+                ('destination', str(destination)),
+                ('num_scanned', result.num_scanned),
+                ('num_processed', result.num_processed),
+                ('num_errors', result.num_errors),
+                ('num_uploaded', result.num_uploaded),
+                ('num_deleted', result.num_deleted),
+            ])
+            item.update(result.stats.as_dict())
+            if hasattr(destination, 'connection_stats'):
+                item['connections'] = destination.connection_stats()
+            data.append(item)
+        import json
+        _write_file_atomic(json_path, json.dumps(data, indent=4) + '\n')
+
+    if prometheus_path:
+        samples = collections.defaultdict(list)
+        for destination, result in zip(destinations, results):
+            labels = {'destination': str(destination)}
+            for name in ('scanned', 'processed', 'errors', 'uploaded',
+                         'deleted'):
+                samples['files'].append(_prometheus_line(
+                        'files', getattr(result, 'num_' + name), labels,
+                        type=name))
+            for family, line in result.stats.prometheus_samples(labels):
+                samples[family].append(line)
+            if hasattr(destination, 'connection_stats'):
+                for name, value in destination.connection_stats().items():
+                    if value is not None:
+                        samples['connections'].append(_prometheus_line(
+                                'connections', value, labels, type=name))
+
+        lines = []
+        for family, metric_type, help_text in PROMETHEUS_HELP:
+            if not samples[family]:
+                continue
+            lines.append('# HELP cdnupload_{} {}'.format(family, help_text))
+            lines.append('# TYPE cdnupload_{} {}'.format(family, metric_type))
+            lines.extend(samples[family])
+        _write_file_atomic(prometheus_path, '\n'.join(lines) + '\n')
+
+
+class Hook(object):
+    """Base class for hooks that observe what cdnupload is doing, for
+    example for profiling or tracing. Subclass this and override the methods
+    for the events you're interested in, then register an instance with
+    add_hook(). Methods may be called from multiple threads at once.
+
+    When no hooks are registered, the events aren't generated at all, so
+    there's no overhead.
+    """
+
+    def action_start(self, action):
+        """Called when an action ('upload', 'delete', 'sync', 'plan', or
+        'apply') starts.
+        """
+
+    def action_end(self, action):
+        """Called when an action finishes (even if it raised an error)."""
+
+    def walk_start(self, source):
+        """Called when building the key map starts walking the source."""
+
+    def walk_end(self, source, num_files):
+        """Called when building the key map has finished."""
+
+    def hash_start(self, rel_path):
+        """Called before hashing a source file."""
+
+    def hash_end(self, rel_path, num_bytes):
+        """Called after hashing a source file of num_bytes bytes."""
+
+    def list_start(self, destination):
+        """Called when listing the keys at a destination starts."""
+
+    def list_page(self, destination, num_keys):
+        """Called when a page of num_keys keys has been received while listing
+        a destination (destinations that don't list in pages call this once
+        per directory or once at the end).
+        """
+
+    def list_end(self, destination, num_keys):
+        """Called when listing the keys at a destination has finished."""
+
+    def upload_start(self, key, rel_path):
+        """Called before uploading source file at rel_path to key."""
+
+    def upload_end(self, key, rel_path, num_bytes):
+        """Called after successfully uploading num_bytes bytes to key."""
+
+    def upload_error(self, key, rel_path, error):
+        """Called when uploading to key raised an exception."""
+
+    def delete_start(self, key):
+        """Called before deleting key."""
+
+    def delete_end(self, key):
+        """Called after successfully deleting key."""
+
+    def delete_error(self, key, error):
+        """Called when deleting key raised an exception."""
+
+
+_hooks = []
+
+
+def add_hook(hook):
+    """Register a Hook instance to be called on cdnupload events."""
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """Unregister a Hook instance previously registered with add_hook()."""
+    _hooks.remove(hook)
+
+
+def _call_hooks(event, *args):
+    """Call given event method on all registered hooks. Callers check
+    "if _hooks:" first, so that there's no overhead without hooks.
+    """
+    for hook in list(_hooks):
+        getattr(hook, event)(*args)
+
+
+# Per-thread callback set by _list_keys() to count the pages of a listing
+_list_page_local = threading.local()
+
+
+def _list_page(destination, num_keys):
+    """Called by destinations when a page of num_keys keys has been received
+    while listing: calls the list_page hooks, and the callback _list_keys()
+    set for this thread (if any).
+    """
+    callback = getattr(_list_page_local, 'callback', None)
+    if callback is not None:
+        callback(destination, num_keys)
+    if _hooks:
+        _call_hooks('list_page', destination, num_keys)
+
+
+def _action_hooks(action):
+    """Decorator for top-level action functions that calls action_start and
+    action_end hooks around the function.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _hooks:
+                return func(*args, **kwargs)
+            _call_hooks('action_start', action)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _call_hooks('action_end', action)
+        return wrapper
+    return decorator
+
+
+class ProfileHook(Hook):
+    """Hook that runs each action under cProfile and writes the profile
+    statistics to "path" when it finishes (view with "python -m pstats" or a
+    tool like snakeviz). Only the thread that started the action is
+    profiled.
+    """
+
+    def __init__(self, path):
+        import cProfile
+
+        self.path = path
+        self.profile = cProfile.Profile()
+        self._depth = 0
+        self._lock = threading.Lock()
+
+    def action_start(self, action):
+        with self._lock:
+            self._depth += 1
+            if self._depth == 1:
+                self.profile.enable()
+
+    def action_end(self, action):
+        with self._lock:
+            self._depth -= 1
+            if self._depth == 0:
+                self.profile.disable()
+                self.profile.dump_stats(self.path)
+
+
+class TraceHook(Hook):
+    """Hook that records a timeline of events and writes it to "path" in
+    Chrome trace event JSON format when each action finishes. Load the file
+    in chrome://tracing or https://ui.perfetto.dev to see what each thread
+    was doing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.events = []
+        self._lock = threading.Lock()
+        self._start_time = _timer()
+
+    def _event(self, phase, name, category, args=None):
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': phase,
+            'ts': (_timer() - self._start_time) * 1000000,
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+        }
+        if args:
+            event['args'] = args
+        with self._lock:
+            self.events.append(event)
+
+    def action_start(self, action):
+        self._event('B', action, 'action')
+
+    def action_end(self, action):
+        self._event('E', action, 'action')
+        with self._lock:
+            data = {'traceEvents': list(self.events),
+                    'displayTimeUnit': 'ms'}
+        import json
+        _write_file_atomic(self.path, json.dumps(data))
+
+    def walk_start(self, source):
+        self._event('B', 'build_key_map', 'walk', {'source': str(source)})
+
+    def walk_end(self, source, num_files):
+        self._event('E', 'build_key_map', 'walk', {'num_files': num_files})
+
+    def hash_start(self, rel_path):
+        self._event('B', rel_path, 'hash')
+
+    def hash_end(self, rel_path, num_bytes):
+        self._event('E', rel_path, 'hash', {'bytes': num_bytes})
+
+    def list_start(self, destination):
+        self._event('B', 'list', 'list', {'destination': str(destination)})
+
+    def list_page(self, destination, num_keys):
+        self._event('i', 'page', 'list', {'num_keys': num_keys})
+
+    def list_end(self, destination, num_keys):
+        self._event('E', 'list', 'list', {'num_keys': num_keys})
+
+    def upload_start(self, key, rel_path):
+        self._event('B', key, 'upload', {'rel_path': rel_path})
+
+    def upload_end(self, key, rel_path, num_bytes):
+        self._event('E', key, 'upload', {'bytes': num_bytes})
+
+    def upload_error(self, key, rel_path, error):
+        self._event('E', key, 'upload', {'error': str(error)})
+
+    def delete_start(self, key):
+        self._event('B', key, 'delete')
+
+    def delete_end(self, key):
+        self._event('E', key, 'delete')
+
+    def delete_error(self, key, error):
+        self._event('E', key, 'delete', {'error': str(error)})
+
+
+class MemoryHook(Hook):
+    """Hook that traces memory allocations with tracemalloc while each action
+    runs, and logs the peak traced memory when it finishes. The peak in bytes
+    is also stored in self.peak. Requires Python 3.4+.
+    """
+
+    def __init__(self):
+        try:
+            import tracemalloc
+        except ImportError:
+            raise Exception('tracemalloc is not available in this version of '
+                            'Python (requires Python 3.4+)')
+        self.tracemalloc = tracemalloc
+        self.peak = None
+        self._depth = 0
+        self._lock = threading.Lock()
+
+    def action_start(self, action):
+        with self._lock:
+            self._depth += 1
+            if self._depth == 1:
+                self.tracemalloc.start()
+
+    def action_end(self, action):
+        with self._lock:
+            self._depth -= 1
+            if self._depth != 0:
+                return
+            _, self.peak = self.tracemalloc.get_traced_memory()
+            self.tracemalloc.stop()
+        logger.warning('peak traced memory during %s: %.1f MB',
+                       action, self.peak / (1024.0 * 1024.0))
+
+
 class FileSource(object):
     """Upload source that recursively returns files from directory tree
     starting at given root path. See __init__'s docstring for details.
@@ -101,7 +1112,13 @@ class FileSource(object):
     def __init__(self, root, dot_names=False, include=None, exclude=None,
                  ignore_walk_errors=False, follow_symlinks=False,
                  hash_length=DEFAULT_HASH_LENGTH, hash_chunk_size=64*1024,
-                 hash_class=hashlib.sha1, cache_key_map=True, _os_walk=os.walk):
+                 hash_class=None, cache_key_map=True,
+                 content_cache_size=0, content_cache_max_file=256*1024,
+                 shard=None, hash_algorithm=None, tree_hash_chunk_size=0,
+                 tree_hash_workers=4, cache_text_by_extension=False,
+                 fingerprint_cache=None, full_rescan=False, walk_workers=1,
+                 rewrite_css=False, rewrite_html=False, rewrite_workers=4,
+                 _os_walk=os.walk):
         """Initialize instance for sourcing files from given root directory.
 
         Include directories and files starting with '.' if "dot_names" is True
@@ -114,17 +1131,69 @@ class FileSource(object):
         If ignore_walk_errors is True, ignore listdir errors when walking the
         source tree (except for the root directory, which is always considered
         an error). If follow_symlinks is True, follow symbolic links in the
-        source tree (default is not to follow links).
+        source tree (default is not to follow links). If walk_workers is
+        greater than 1, list that many directories at once using threads,
+        which speeds up walking trees on network filesystems like NFS where
+        each listdir and stat is a round trip (in this case, files are
+        yielded in a deterministic order: level by level, sorted by name).
 
         When building a key mapping, "hash_length" characters of the hex
         content hash are included in the filename. The file is read in
         "hash_chunk_size" blocks when being hashed. "hash_class" is called
-        to generate the file hashes (you could use hashlib.md5 or something
-        else instead).
+        to generate the file hashes (default hashlib.sha1, but you could use
+        hashlib.md5 or something else instead). Alternatively, specify
+        "hash_algorithm" as one of the names in HASH_ALGORITHMS, for example
+        'blake2b' (this overrides hash_class).
+
+        If tree_hash_chunk_size is nonzero, files larger than that are hashed
+        as a tree: each tree_hash_chunk_size chunk is hashed separately (up to
+        "tree_hash_workers" chunks at once, in threads), and the file hash is
+        the hash of the concatenated chunk digests. This is faster for very
+        large files on multi-core machines, but gives different hashes.
+
+        If cache_text_by_extension is True, hash_file() only checks whether
+        the first file with each extension is text or binary, and assumes
+        later files with the same extension are the same. This saves time if
+        there are many small files, but only use it if your extensions
+        reliably indicate whether files are text.
 
         If cache_key_map is False, don't cache the result of build_key_map().
         Default is to cache the result so it doesn't need to be rebuilt if
         build_key_map() is called again.
+
+        If content_cache_size is nonzero, the contents of files up to
+        "content_cache_max_file" bytes are kept in memory after they're
+        hashed, so that open() can return them (once) without reading the
+        file again when it's uploaded. At most "content_cache_size" bytes are
+        cached in total (least recently used files are evicted first). The
+        cache is cleared each time the key map is built, and upload() drops
+        files the destination already has.
+
+        If "shard" is specified, it must be an (index, count) tuple, where
+        index is from 1 to count, and only files in that shard (according to
+        a stable hash of their relative path) are included. This is used to
+        split very large trees across several machines, each of which hashes
+        and uploads its own shard.
+
+        If "fingerprint_cache" is a filename, build_key_map() stores a
+        fingerprint of each directory in that file: the directory's mtime
+        plus the name, size, and mtime of each of its files, along with the
+        files' keys. On the next build, files in directories whose
+        fingerprint hasn't changed aren't hashed again, and their keys are
+        reused (subdirectories are still checked, so the result is the same
+        as a full scan). If full_rescan is True, ignore the existing cache
+        (but still write a new one). "fingerprint_cache" may also be a dict,
+        which is used as an in-memory cache and updated in place (this is
+        how --action=serve keeps key maps warm between requests).
+
+        If rewrite_css is True, relative url(...) and @import references in
+        .css files are rewritten to the keys of the files they refer to, and
+        the .css file's own key is based on the rewritten content (which is
+        what open() returns and what gets uploaded). If rewrite_html is
+        True, the same is done for src and href attributes (and url(...)
+        in inline styles) in .html and .htm files. See find_references()
+        and build_key_map() for details. Up to "rewrite_workers" files are
+        read and rewritten at once, in threads.
         """
         self.root = root
         self.dot_names = dot_names
@@ -138,13 +1207,62 @@ class FileSource(object):
 
         self.ignore_walk_errors = ignore_walk_errors
         self.follow_symlinks = follow_symlinks
+        self.walk_workers = walk_workers
 
         self.hash_length = hash_length
         self.hash_chunk_size = hash_chunk_size
+        if hash_algorithm is not None:
+            hash_class = get_hash_class(hash_algorithm)
+        elif hash_class is None:
+            import hashlib
+            hash_class = hashlib.sha1
+            hash_algorithm = 'sha1'
+        else:
+            hash_algorithm = _hash_class_name(hash_class)
         self.hash_class = hash_class
+        self.hash_algorithm = hash_algorithm
+        self.tree_hash_chunk_size = tree_hash_chunk_size
+        self.tree_hash_workers = tree_hash_workers
+        self.cache_text_by_extension = cache_text_by_extension
+        self._text_by_extension = {}
+
+        if shard is not None:
+            index, count = shard
+            if not 1 <= index <= count:
+                raise ValueError('shard index must be from 1 to {}, not '
+                                 '{}'.format(count, index))
+            if rewrite_css or rewrite_html:
+                raise ValueError("can't rewrite references with a sharded "
+                                 "source, as referenced files may be in "
+                                 "another shard")
+        self.shard = shard
 
         self.cache_key_map = cache_key_map
         self._key_map = None
+        self.fingerprint_cache = fingerprint_cache
+        self.full_rescan = full_rescan
+
+        # Rewritten contents of CSS and HTML files from the last build, and
+        # cache of rewrites by path and input digest
+        self.rewrite_css = rewrite_css
+        self.rewrite_html = rewrite_html
+        self.rewrite_workers = rewrite_workers
+        self._rewritten = None
+        self._rewrite_cache = {}
+        self._rewrite_lock = threading.RLock()
+
+        # Total bytes read by hash_file(), number of hashes reused for hard
+        # links and symlinks, and Stats from last build_key_map()
+        self.bytes_hashed = 0
+        self.num_hashes_reused = 0
+        self.build_stats = None
+        self._hashes_by_inode = None
+
+        self.content_cache_size = content_cache_size
+        self.content_cache_max_file = content_cache_max_file
+        self._content_cache = collections.OrderedDict()
+        self._content_cache_bytes = 0
+        self._content_cache_lock = threading.Lock()
 
         self.os_walk = _os_walk  # for easier testing
 
@@ -153,13 +1271,99 @@ class FileSource(object):
         return self.root
 
     def open(self, rel_path):
-        """Open file at given relative path."""
+        """Open file at given relative path. If the file's contents are in
+        the content cache, or the file's references have been rewritten,
+        return an in-memory file object instead.
+        """
+        if self.rewrite_css or self.rewrite_html:
+            content = self._get_rewritten(rel_path)
+            if content is not None:
+                return io.BytesIO(content)
+        if self.content_cache_size:
+            content = self._pop_cached_content(rel_path)
+            if content is not None:
+                return io.BytesIO(content)
         path = os.path.join(self.root, rel_path)
         return open(path, 'rb')
 
+    def _get_rewritten(self, rel_path):
+        """Return rewritten contents of file at given relative path, or None
+        if its references aren't rewritten. If the key map hasn't been built
+        yet (for example, when applying a plan), build it first.
+        """
+        if not self._rewrite_type(rel_path):
+            return None
+        with self._rewrite_lock:
+            if self._rewritten is None:
+                self.build_key_map()
+            return self._rewritten.get(rel_path)
+
+    def _pop_cached_content(self, rel_path):
+        """Remove cached contents of file at given relative path from the
+        cache and return them, or None if it's not in the cache.
+        """
+        with self._content_cache_lock:
+            content = self._content_cache.pop(rel_path, None)
+            if content is not None:
+                self._content_cache_bytes -= len(content)
+        return content
+
+    def _clear_content_cache(self):
+        """Remove all files from the content cache."""
+        with self._content_cache_lock:
+            self._content_cache.clear()
+            self._content_cache_bytes = 0
+
+    def _trim_content_cache(self, rel_paths):
+        """Remove files other than those in rel_paths (the files that will
+        be uploaded) from the content cache.
+        """
+        with self._content_cache_lock:
+            for rel_path in list(self._content_cache):
+                if rel_path not in rel_paths:
+                    content = self._content_cache.pop(rel_path)
+                    self._content_cache_bytes -= len(content)
+
+    def _cache_content(self, rel_path, content):
+        """Add file contents to the content cache, evicting least recently
+        used files if the cache would grow beyond content_cache_size bytes.
+        """
+        size = len(content)
+        if size > self.content_cache_max_file or size > self.content_cache_size:
+            return
+        with self._content_cache_lock:
+            old_content = self._content_cache.pop(rel_path, None)
+            if old_content is not None:
+                self._content_cache_bytes -= len(old_content)
+            while self._content_cache_bytes + size > self.content_cache_size:
+                _, evicted = self._content_cache.popitem(last=False)
+                self._content_cache_bytes -= len(evicted)
+            self._content_cache[rel_path] = content
+            self._content_cache_bytes += size
+
+    def _is_cacheable(self, file):
+        """Return True if given open file is small enough that its contents
+        should be added to the content cache when it's hashed.
+        """
+        if not self.content_cache_size or isinstance(file, io.BytesIO):
+            return False
+        size = _file_size(file)
+        return size is not None and size <= self.content_cache_max_file
+
+    @property
+    def hash_id(self):
+        """String identifying how files are hashed, for example 'sha1' or
+        'blake2b-tree-8388608' (with tree hashing). Keys only match between
+        key maps and plans with the same hash_id.
+        """
+        if self.tree_hash_chunk_size:
+            return '{}-tree-{}'.format(self.hash_algorithm,
+                                       self.tree_hash_chunk_size)
+        return self.hash_algorithm
+
     def hash_file(self, rel_path, is_text=None):
         """Read file at given relative path and return content hash as hex
-        string (hash is SHA-1 hash of content).
+        string (by default, hash is SHA-1 hash of content).
 
         If is_text is None, determine whether file is text like Git does (it's
         treated as text if there's no NUL byte in first 8000 bytes).
@@ -170,20 +1374,147 @@ class FileSource(object):
         (LF), especially with "automatic" line ending conversion when using
         Git or Subversion.
         """
-        with self.open(rel_path) as file:
+        with self._open_for_hash(rel_path) as file:
+            return self._hash_open_file(rel_path, file, is_text=is_text)
+
+    def _open_for_hash(self, rel_path):
+        """Open file at given relative path for hashing."""
+        if self.content_cache_size:
+            # Hash what's on disk now, not contents cached by an earlier hash
+            self._pop_cached_content(rel_path)
+        return self.open(rel_path)
+
+    def _hash_open_file(self, rel_path, file, is_text=None):
+        """Hash already-open file at given relative path (see hash_file())
+        and return content hash as hex string.
+        """
+        raw_chunks = [] if self._is_cacheable(file) else None
+        chunk = file.read(self.hash_chunk_size)
+        if is_text is None:
+            is_text = self._is_text(rel_path, chunk)
+
+        if self.tree_hash_chunk_size:
+            size = _file_size(file)
+            if size is not None and size > self.tree_hash_chunk_size:
+                hex_digest, num_bytes = self._hash_tree(file, chunk, is_text)
+                self.bytes_hashed += num_bytes
+                return hex_digest
+
+        hash_obj = self.hash_class()
+        num_bytes = 0
+        while chunk:
+            num_bytes += len(chunk)
+            if raw_chunks is not None:
+                raw_chunks.append(chunk)
+            if is_text:
+                # This is faster than checking for CR with find() first,
+                # or deleting it with translate(): replace() scans with
+                # memchr and returns the chunk itself (no copy) if there
+                # are no CRs, as in most minified files
+                chunk = chunk.replace(b'\r', b'')
+            hash_obj.update(chunk)
             chunk = file.read(self.hash_chunk_size)
-            if is_text is None:
-                is_text = chunk.find(b'\x00', 0, self.IS_TEXT_BYTES) == -1
 
-            hash_obj = self.hash_class()
-            while chunk:
-                if is_text:
-                    chunk = chunk.replace(b'\r', b'')
-                hash_obj.update(chunk)
-                chunk = file.read(self.hash_chunk_size)
+        if raw_chunks is not None:
+            self._cache_content(rel_path, b''.join(raw_chunks))
+        self.bytes_hashed += num_bytes
 
         return hash_obj.hexdigest()
 
+    def _is_text(self, rel_path, chunk):
+        """Return True if file at rel_path, whose first chunk is given, is
+        text (no NUL bytes in the first IS_TEXT_BYTES bytes), using the
+        per-extension decision if cache_text_by_extension is enabled.
+        """
+        ext = None
+        if self.cache_text_by_extension:
+            ext = os.path.splitext(rel_path)[1].lower()
+            is_text = self._text_by_extension.get(ext) if ext else None
+            if is_text is not None:
+                return is_text
+        is_text = chunk.find(b'\x00', 0, self.IS_TEXT_BYTES) == -1
+        if ext:
+            self._text_by_extension[ext] = is_text
+        return is_text
+
+    def _hash_tree(self, file, chunk, is_text):
+        """Hash rest of file (starting with already-read chunk) as a tree of
+        tree_hash_chunk_size chunks, hashing up to tree_hash_workers chunks
+        at once. Return tuple of (hex_digest, num_bytes).
+
+        For text files, the chunks are cut from the contents with CRs
+        removed, so that chunk boundaries (and the hash) don't depend on
+        line endings. If that leaves no more than one chunk, it's hashed
+        like a file that's too small for tree hashing.
+        """
+        def hash_chunk(data):
+            hash_obj = self.hash_class()
+            hash_obj.update(data)
+            return hash_obj.digest()
+
+        raw_bytes = [0]
+        digests = []
+        batch = []
+        first_chunk = None
+        num_chunks = 0
+        chunks = self._tree_chunks(file, chunk, is_text, raw_bytes)
+        for data in chunks:
+            num_chunks += 1
+            if num_chunks == 1:
+                first_chunk = data
+            batch.append((data,))
+            if len(batch) >= self.tree_hash_workers:
+                digests.extend(self._hash_batch(hash_chunk, batch))
+                batch = []
+        if num_chunks <= 1:
+            hash_obj = self.hash_class()
+            hash_obj.update(first_chunk or b'')
+            return hash_obj.hexdigest(), raw_bytes[0]
+        digests.extend(self._hash_batch(hash_chunk, batch))
+
+        hash_obj = self.hash_class()
+        hash_obj.update(b''.join(digests))
+        return hash_obj.hexdigest(), raw_bytes[0]
+
+    @staticmethod
+    def _hash_batch(hash_chunk, batch):
+        """Return list of digests of the chunks in batch, hashed in parallel
+        if there's more than one.
+        """
+        if len(batch) <= 1:
+            return [hash_chunk(*args) for args in batch]
+        return _map_threads(hash_chunk, batch)
+
+    def _tree_chunks(self, file, chunk, is_text, raw_bytes):
+        """Yield tree_hash_chunk_size chunks (the last one may be shorter) of
+        rest of file, starting with already-read chunk, with CRs removed if
+        is_text is True. Add the number of bytes read to raw_bytes[0].
+        """
+        chunk_size = self.tree_hash_chunk_size
+        pending = []
+        pending_size = 0
+        while chunk:
+            raw_bytes[0] += len(chunk)
+            if is_text:
+                chunk = chunk.replace(b'\r', b'')
+            pending.append(chunk)
+            pending_size += len(chunk)
+            if pending_size >= chunk_size:
+                data = b''.join(pending)
+                start = 0
+                while len(data) - start >= chunk_size:
+                    yield data[start:start + chunk_size]
+                    start += chunk_size
+                pending = [data[start:]]
+                pending_size = len(data) - start
+            chunk = file.read(chunk_size)
+        if pending_size:
+            yield b''.join(pending)
+
+    def stat_file(self, rel_path):
+        """Return os.stat() result for file at given relative path."""
+        return os.stat(os.path.join(self.root, rel_path))
+
     def make_key(self, rel_path, file_hash):
         """Convert relative path and file hash to destination key, for
         example, a "rel_path" of 'images/logo.png' would become something like
@@ -203,7 +1534,13 @@ class FileSource(object):
         Relative paths in the yielded values are canonicalized to always
         use use '/' (forward slash) as a path separator, regardless of running
         platform.
+
+        If follow_symlinks is True, symbolic links to a directory's own
+        ancestor are skipped (rather than walking the cycle until the path is
+        too long).
         """
+        import fnmatch
+
         if isinstance(self.root, bytes):
             # Mainly because os.walk() doesn't handle Unicode chars in walked
             # paths on Windows if a bytes path is specified (easy on Python 2.x
@@ -222,9 +1559,22 @@ class FileSource(object):
             else:
                 logger.debug('ignoring error scanning source tree: %s', error)
 
-        walker = self.os_walk(walk_root, onerror=onerror,
-                              followlinks=self.follow_symlinks)
+        if self.walk_workers > 1:
+            walker = _walk_parallel(walk_root, onerror=onerror,
+                                    followlinks=self.follow_symlinks,
+                                    num_workers=self.walk_workers,
+                                    _os_walk=self.os_walk)
+        else:
+            walker = self.os_walk(walk_root, onerror=onerror,
+                                  followlinks=self.follow_symlinks)
+        dir_ids = {}
         for root, dirs, files in walker:
+            if self.follow_symlinks and _is_symlink_cycle(root, walk_root,
+                                                          dir_ids):
+                logger.info('skipping %s, a symbolic link to one of its '
+                            'parent directories', root)
+                dirs[:] = []
+                continue
             if not self.dot_names:
                 dirs[:] = [d for d in dirs if not d.startswith('.')]
 
@@ -241,6 +1591,9 @@ class FileSource(object):
                 if self.exclude and any(fnmatch.fnmatch(rel_path, e)
                                         for e in self.exclude):
                     continue
+                if self.shard and shard_index(rel_path,
+                                              self.shard[1]) != self.shard[0]:
+                    continue
 
                 yield rel_path
 
@@ -252,21 +1605,448 @@ class FileSource(object):
         meaning '\' is converted to '/' on Windows, so that users of the
         mapping can always look up keys using 'dir/file.ext' style paths,
         regardless of operating system.
+
+        Timing statistics for the build are stored in self.build_stats (a
+        Stats instance): 'walk' and 'hash' phase times and per-file 'hash'
+        operations.
+
+        If fingerprint_cache was specified, files in unchanged directories
+        are not hashed again (see __init__).
+
+        Paths that refer to the same physical file (hard links, or symbolic
+        links to files) are only hashed once: the hash is reused for later
+        paths with the same device, inode, size, mtime, and extension.
+
+        If rewrite_css or rewrite_html is enabled, other files are hashed
+        first, then the CSS and HTML files are rewritten in dependency order
+        (a file that's referenced by another, for example via @import, is
+        rewritten and keyed first), with files whose references are ready
+        rewritten in parallel. References to files that aren't in the key
+        map are left unchanged, as are absolute URLs and references to HTML
+        files (pages often link to each other, so they'd form cycles).
         """
         if self.cache_key_map and self._key_map is not None:
             return self._key_map
 
-        keys_by_path = {}
-        for rel_path in self.walk_files():
-            file_hash = self.hash_file(rel_path)
-            key = self.make_key(rel_path, file_hash)
-            keys_by_path[rel_path] = key
+        if _hooks:
+            _call_hooks('walk_start', self)
+        stats = Stats()
+        start_time = _timer()
+        if self.content_cache_size:
+            self._clear_content_cache()
+        self._hashes_by_inode = {}
+        num_reused_before = self.num_hashes_reused
+        rel_paths = self.walk_files()
+        rewrite_paths = []
+        if self.rewrite_css or self.rewrite_html:
+            rel_paths = self._split_rewrite_paths(rel_paths, rewrite_paths)
+        if self.fingerprint_cache is not None:
+            keys_by_path, hash_time = self._build_key_map_incremental(
+                    stats, rel_paths)
+        else:
+            hash_time = 0.0
+            keys_by_path = {}
+            for rel_path in rel_paths:
+                key, elapsed = self._hash_key(rel_path, stats)
+                hash_time += elapsed
+                keys_by_path[rel_path] = key
+        if self.rewrite_css or self.rewrite_html:
+            hash_time += self._rewrite_references(rewrite_paths, keys_by_path,
+                                                  stats)
+        if _hooks:
+            _call_hooks('walk_end', self, len(keys_by_path))
+        self._hashes_by_inode = None
+        if self.num_hashes_reused > num_reused_before:
+            logger.info('reused hashes of %d hard-linked or symlinked files',
+                        self.num_hashes_reused - num_reused_before)
+
+        stats.add_phase_time('walk', _timer() - start_time - hash_time)
+        stats.add_phase_time('hash', hash_time)
+        self.build_stats = stats
 
         if self.cache_key_map:
             self._key_map = keys_by_path
 
         return keys_by_path
 
+    def _hash_key(self, rel_path, stats, st=None, by_inode=True):
+        """Hash file at given relative path and return tuple of (key,
+        seconds taken), adding the 'hash' operation to stats. If the file's
+        inode has already been hashed during this build (and by_inode is
+        True), reuse that hash. "st" is the file's stat result, if the
+        caller already has it.
+
+        Without "st", the file's identity comes from fstat() on the file
+        once it's open for hashing, rather than from a separate stat, which
+        would be another round trip on network filesystems. (If a subclass
+        overrides hash_file(), it's stat'ed first instead.)
+        """
+        by_inode = by_inode and self._hashes_by_inode is not None
+        file = None
+        if by_inode and st is None:
+            if (_method_function(type(self).hash_file) is
+                    _method_function(FileSource.hash_file)):
+                file = self._open_for_hash(rel_path)
+                st = _fstat(file)
+            else:
+                try:
+                    st = self.stat_file(rel_path)
+                except OSError:
+                    pass  # let hash_file() raise the error
+        try:
+            file_id = self._file_id(rel_path, st) if by_inode else None
+            if file_id is not None:
+                file_hash = self._hashes_by_inode.get(file_id)
+                if file_hash is not None:
+                    self.num_hashes_reused += 1
+                    return self.make_key(rel_path, file_hash), 0.0
+
+            if _hooks:
+                _call_hooks('hash_start', rel_path)
+            hash_start = _timer()
+            bytes_before = self.bytes_hashed
+            if file is not None:
+                file_hash = self._hash_open_file(rel_path, file)
+            else:
+                file_hash = self.hash_file(rel_path)
+            elapsed = _timer() - hash_start
+        finally:
+            if file is not None:
+                file.close()
+        num_bytes = self.bytes_hashed - bytes_before
+        stats.add_operation('hash', rel_path, elapsed, num_bytes)
+        if _hooks:
+            _call_hooks('hash_end', rel_path, num_bytes)
+        if file_id is not None:
+            self._hashes_by_inode[file_id] = file_hash
+        return self.make_key(rel_path, file_hash), elapsed
+
+    @staticmethod
+    def _file_id(rel_path, st):
+        """Return tuple identifying the physical file with stat result st,
+        or None if st is None or inodes aren't supported (Python 2 on
+        Windows).
+        """
+        if st is None or not st.st_ino:
+            return None
+        # Extension is included because subclasses may hash differently by
+        # extension (as cache_text_by_extension does)
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime,
+                os.path.splitext(rel_path)[1].lower())
+
+    def _fingerprint_settings(self):
+        """Return dict of the settings that affect keys, which must match
+        for the fingerprint cache to be used.
+        """
+        return {
+            'hash_id': self.hash_id,
+            'hash_length': self.hash_length,
+            'cache_text_by_extension': bool(self.cache_text_by_extension),
+        }
+
+    def _read_fingerprint_cache(self):
+        """Return the "directories" dict from the fingerprint cache file, or
+        an empty dict if it doesn't exist, is invalid, or was written with
+        different settings.
+        """
+        import json
+
+        path = self.fingerprint_cache
+        if isinstance(path, dict):
+            cache = path
+            if not cache:
+                return {}
+            path = '(in memory)'
+        else:
+            try:
+                with open(path) as f:
+                    cache = json.load(f)
+            except (IOError, OSError) as error:
+                if error.errno != errno.ENOENT:
+                    logger.warning('ignoring fingerprint cache %s: %s',
+                                   path, error)
+                return {}
+            except ValueError as error:
+                logger.warning('ignoring invalid fingerprint cache %s: %s',
+                               path, error)
+                return {}
+        if (not isinstance(cache, dict) or
+                cache.get('version') != FINGERPRINT_CACHE_VERSION or
+                cache.get('settings') != self._fingerprint_settings()):
+            logger.info('fingerprint cache %s was written with different '
+                        'settings, rescanning', path)
+            return {}
+        return cache.get('directories') or {}
+
+    def _build_key_map_incremental(self, stats, rel_paths):
+        """Build key map of given relative paths (from walk_files()) using
+        and then updating the fingerprint cache. Return tuple of (key_map,
+        seconds spent hashing).
+        """
+        import json
+
+        old_dirs = {} if self.full_rescan else self._read_fingerprint_cache()
+        scan_start = time.time()
+
+        # Group files by directory (walk_files() does the filtering, so a
+        # change to include or exclude just changes the set of names)
+        paths_by_dir = collections.OrderedDict()
+        for rel_path in rel_paths:
+            rel_dir = rel_path.rpartition('/')[0]
+            paths_by_dir.setdefault(rel_dir, []).append(rel_path)
+
+        keys_by_path = {}
+        new_dirs = {}
+        hash_time = 0.0
+        num_reused = 0
+        for rel_dir, rel_paths in paths_by_dir.items():
+            dir_mtime = os.stat(os.path.join(self.root, rel_dir)).st_mtime
+            file_stats = {}
+            stat_results = {}
+            for rel_path in rel_paths:
+                st = self.stat_file(rel_path)
+                stat_results[rel_path] = st
+                file_stats[rel_path] = (st.st_size, st.st_mtime)
+
+            old_dir = old_dirs.get(rel_dir) or {}
+            old_files = old_dir.get('files') or {}
+            if (old_dir.get('mtime') == dir_mtime and
+                    len(old_files) == len(file_stats) and
+                    all(tuple(old_files.get(p, [None])[1:]) == s
+                        for p, s in file_stats.items())):
+                files = old_files
+                for rel_path in rel_paths:
+                    keys_by_path[rel_path] = files[rel_path][0]
+                num_reused += len(rel_paths)
+            else:
+                files = {}
+                for rel_path in rel_paths:
+                    key, elapsed = self._hash_key(rel_path, stats,
+                                                  st=stat_results[rel_path])
+                    hash_time += elapsed
+                    keys_by_path[rel_path] = key
+                    size, mtime = file_stats[rel_path]
+                    files[rel_path] = [key, size, mtime]
+
+            # A file modified within the mtime resolution of the scan could
+            # change without its mtime changing, so only cache directories
+            # whose fingerprints have been stable for a couple of seconds
+            newest = max([dir_mtime] + [s[1] for s in file_stats.values()])
+            if newest < scan_start - 2:
+                new_dirs[rel_dir] = {'mtime': dir_mtime, 'files': files}
+
+        in_memory = isinstance(self.fingerprint_cache, dict)
+        logger.info('fingerprint cache %s: reused keys of %d files, hashed %d',
+                    '(in memory)' if in_memory else self.fingerprint_cache,
+                    num_reused, len(keys_by_path) - num_reused)
+        cache = collections.OrderedDict([
+            ('version', FINGERPRINT_CACHE_VERSION),
+            ('settings', self._fingerprint_settings()),
+            ('directories', new_dirs),
+        ])
+        if in_memory:
+            self.fingerprint_cache.clear()
+            self.fingerprint_cache.update(cache)
+        else:
+            _write_file_atomic(self.fingerprint_cache,
+                               json.dumps(cache, sort_keys=True) + '\n')
+        return keys_by_path, hash_time
+
+    def _rewrite_type(self, rel_path):
+        """Return 'css' or 'html' if references in the file at given
+        relative path are rewritten, otherwise None.
+        """
+        ext = os.path.splitext(rel_path)[1].lower()
+        if ext == '.css' and self.rewrite_css:
+            return 'css'
+        if ext in ('.html', '.htm') and self.rewrite_html:
+            return 'html'
+        return None
+
+    def _split_rewrite_paths(self, rel_paths, rewrite_paths):
+        """Yield the relative paths in rel_paths, except those of files
+        whose references are rewritten, which are appended to the
+        rewrite_paths list instead.
+        """
+        for rel_path in rel_paths:
+            if self._rewrite_type(rel_path):
+                rewrite_paths.append(rel_path)
+            else:
+                yield rel_path
+
+    def find_references(self, rel_path, content):
+        """Return list of (start, end, url) tuples for the references in
+        given content (bytes) of the file at relative path rel_path, where
+        start and end are the offsets of the URL in content. In CSS files,
+        url(...) and @import "..." references are found; in HTML files, src
+        and href attributes and url(...) in inline styles. Override this to
+        find other kinds of references.
+        """
+        import re
+
+        if self._rewrite_type(rel_path) == 'html':
+            patterns = [HTML_ATTR_PATTERN, CSS_URL_PATTERN]
+        else:
+            patterns = [CSS_URL_PATTERN, CSS_IMPORT_PATTERN]
+        matches = []
+        for pattern in patterns:
+            for match in re.finditer(pattern, content):
+                # The URL is in whichever group matched (depending on quotes)
+                group = next(i for i in range(1, len(match.groups()) + 1)
+                             if match.group(i) is not None)
+                matches.append((match.start(group), match.end(group),
+                                match.group(group)))
+
+        references = []
+        end = 0
+        for start, next_end, url in sorted(matches):
+            if start < end:
+                continue  # overlaps previous match
+            try:
+                url = url.decode('utf-8')
+            except UnicodeDecodeError:
+                continue
+            references.append((start, next_end, url))
+            end = next_end
+        return references
+
+    def _resolve_reference(self, rel_path, url):
+        """Return tuple of (target, path, suffix) for reference url in file
+        at given relative path, where target is the relative path of the file
+        it refers to, path is the path part of url, and suffix is its query
+        string and fragment. Return None if url isn't a relative path within
+        the source tree.
+        """
+        import posixpath
+        import re
+        try:
+            from urllib.parse import unquote
+        except ImportError:
+            from urllib import unquote
+
+        if (not url or url.startswith(('/', '\\', '#')) or
+                re.match(r'[A-Za-z][A-Za-z0-9+.-]*:', url)):
+            return None
+        path = re.split(r'[?#]', url, 1)[0]
+        if not path:
+            return None
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(rel_path),
+                                                   unquote(path)))
+        if target == '..' or target.startswith('../'):
+            return None
+        return target, path, url[len(path):]
+
+    def _rewrite_content(self, raw, references, keys_by_path):
+        """Return tuple of (content, keys), where content is raw content
+        with the given references (from _rewrite_references) replaced by the
+        keys of the files they refer to, and keys is a tuple of those keys.
+        References to files not in keys_by_path are left unchanged.
+        """
+        try:
+            from urllib.parse import quote, unquote
+        except ImportError:
+            from urllib import quote, unquote
+
+        parts = []
+        keys = []
+        pos = 0
+        for start, end, target, path, suffix in references:
+            key = keys_by_path.get(target)
+            if key is None:
+                continue
+            name = key.rpartition('/')[2]
+            if unquote(path) != path:
+                name = quote(name)
+            if '/' in path:
+                name = path.rpartition('/')[0] + '/' + name
+            parts.append(raw[pos:start])
+            parts.append((name + suffix).encode('utf-8'))
+            pos = end
+            keys.append(key)
+        parts.append(raw[pos:])
+        return b''.join(parts), tuple(keys)
+
+    def _rewrite_references(self, rel_paths, keys_by_path, stats):
+        """Rewrite references in the files at given relative paths (see
+        build_key_map()), storing the rewritten contents for open() and
+        adding the files' keys to keys_by_path. Return seconds taken.
+
+        Rewrites are cached by relative path and digest of the original
+        content, so a file that hasn't changed isn't parsed again, nor
+        hashed again if the keys it refers to haven't changed either.
+        """
+        start_time = _timer()
+        rewrite_set = set(rel_paths)
+        old_cache = self._rewrite_cache
+        new_cache = {}
+        entries = {}
+
+        def read(rel_path):
+            with open(os.path.join(self.root, rel_path), 'rb') as f:
+                raw = f.read()
+            hash_obj = self.hash_class()
+            hash_obj.update(raw)
+            digest = hash_obj.hexdigest()
+            cached = old_cache.get((rel_path, digest))
+            if cached is not None:
+                references = cached[0]
+            else:
+                references = []
+                for start, end, url in self.find_references(rel_path, raw):
+                    resolved = self._resolve_reference(rel_path, url)
+                    if (resolved is not None and
+                            os.path.splitext(resolved[0])[1].lower() not in
+                            ('.html', '.htm')):
+                        references.append((start, end) + resolved)
+            entries[rel_path] = (digest, raw, references, cached)
+
+        with self._rewrite_lock:
+            self._rewritten = {}
+        _map_workers(read, rel_paths, self.rewrite_workers)
+
+        # Rewrite in dependency order: each pass handles the files whose
+        # rewritten references have all been keyed
+        pending = sorted(rel_paths)
+        num_cached = 0
+        while pending:
+            ready = [p for p in pending
+                     if all(r[2] not in rewrite_set or r[2] in keys_by_path
+                            for r in entries[p][2])]
+            if not ready:
+                logger.warning('reference cycle between %s, references '
+                               'between them not rewritten',
+                               ', '.join(pending))
+                ready = pending
+
+            contents = {}
+
+            def rewrite(rel_path):
+                contents[rel_path] = self._rewrite_content(
+                        entries[rel_path][1], entries[rel_path][2],
+                        keys_by_path)
+            _map_workers(rewrite, ready, self.rewrite_workers)
+
+            for rel_path in ready:
+                digest, _, references, cached = entries[rel_path]
+                content, keys = contents[rel_path]
+                with self._rewrite_lock:
+                    self._rewritten[rel_path] = content
+                if cached is not None and cached[1] == keys:
+                    key = cached[2]
+                    num_cached += 1
+                else:
+                    key, _ = self._hash_key(rel_path, stats, by_inode=False)
+                keys_by_path[rel_path] = key
+                new_cache[(rel_path, digest)] = (references, keys, key)
+            ready = set(ready)
+            pending = [p for p in pending if p not in ready]
+
+        self._rewrite_cache = new_cache
+        if rel_paths:
+            logger.info('rewrote references in %d files (%d unchanged since '
+                        'last build)', len(rel_paths), num_cached)
+        return _timer() - start_time
+
 
 class Destination(object):
     """Subclass this abstract base class to implement a destination uploader,
@@ -306,33 +2086,127 @@ class FileDestination(Destination):
 
     required argument ("destination" command line parameter):
       root           root of destination directory to copy to
+
+    optional arguments ("dest_args" on command line):
+      walk_workers   list up to this many directories at once in walk_keys(),
+                     and check up to this many keys at once in exists_many(),
+                     using threads (faster on network filesystems like NFS)
+
+    Directories are listed with os.scandir() where available. Directories
+    created by upload() are remembered, so they're only created once.
     """
 
-    def __init__(self, root):
+    def __init__(self, root, walk_workers=1):
         self.root = root
+        try:
+            self.walk_workers = int(walk_workers)
+        except (ValueError, TypeError):
+            raise TypeError('walk_workers must be an integer')
+        self._made_dirs = set()
 
     def __str__(self):
         return self.root
 
+    def _list_dir(self, path):
+        """Return tuple of (dirs, files) names in directory at path, or None
+        if it can't be listed. As with os.walk(), symbolic links to
+        directories aren't walked (so they're in neither list).
+        """
+        dirs = []
+        files = []
+        try:
+            if _scandir is None:
+                for name in os.listdir(path):
+                    entry_path = os.path.join(path, name)
+                    if not os.path.isdir(entry_path):
+                        files.append(name)
+                    elif not os.path.islink(entry_path):
+                        dirs.append(name)
+            else:
+                for entry in _scandir(path):
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if not is_dir:
+                        files.append(entry.name)
+                    elif not entry.is_symlink():
+                        dirs.append(entry.name)
+        except OSError:
+            return None
+        return dirs, files
+
     def walk_keys(self):
-        for root, dirs, files in os.walk(self.root):
-            for file in files:
-                path = os.path.join(root, file)
-                key = os.path.relpath(path, self.root)
-                yield key.replace('\\', '/')
+        # Keys are built up from their directory's key prefix rather than
+        # calling os.path.relpath() on each file's full path
+        level = [(self.root, '')]
+        while level:
+            listings = {}
 
-    def upload(self, key, source, rel_path):
-        dest_path = os.path.join(self.root, key)
+            def list_dir(item):
+                listings[item[0]] = self._list_dir(item[0])
 
+            _map_workers(list_dir, level, self.walk_workers)
+
+            next_level = []
+            for path, prefix in level:
+                listing = listings.get(path)
+                if listing is None:
+                    continue
+                dirs, files = listing
+                _list_page(self, len(files))
+                for file in files:
+                    yield prefix + file
+                for name in dirs:
+                    next_level.append((os.path.join(path, name),
+                                       prefix + name + '/'))
+            level = next_level
+
+    def exists_many(self, keys):
+        """Return the set of given keys that exist at the destination. This
+        is faster than walk_keys() when there are only a few keys to check
+        and many keys at the destination.
+        """
+        found = set()
+
+        def check(key):
+            if os.path.isfile(os.path.join(self.root, key)):
+                found.add(key)
+
+        _map_workers(check, keys, self.walk_workers)
+        return found
+
+    def _make_dirs(self, path):
+        """Create directory at path (and parents) if upload() hasn't already
+        created or found it.
+        """
+        if path in self._made_dirs:
+            return
         try:
-            os.makedirs(os.path.dirname(dest_path))
+            os.makedirs(path)
         except OSError as error:
             # Because the "exist_ok" param doesn't (ahem) exist on Python 2.x
             if error.errno != errno.EEXIST:
                 raise
+        self._made_dirs.add(path)
+
+    def upload(self, key, source, rel_path):
+        dest_path = os.path.join(self.root, key)
+        dest_dir = os.path.dirname(dest_path)
+        self._make_dirs(dest_dir)
 
+        import shutil
         with source.open(rel_path) as source_file:
-            with open(dest_path, 'wb') as dest_file:
+            try:
+                dest_file = open(dest_path, 'wb')
+            except (IOError, OSError) as error:
+                if error.errno != errno.ENOENT:
+                    raise
+                # Directory was removed since we created it, so recreate it
+                self._made_dirs.discard(dest_dir)
+                self._make_dirs(dest_dir)
+                dest_file = open(dest_path, 'wb')
+            with dest_file:
                 shutil.copyfileobj(source_file, dest_file)
 
     def delete(self, key):
@@ -358,13 +2232,41 @@ class S3Destination(Destination):
       client_args    dict of additional keyword args for boto3 client setup:
                      boto3.client('s3', ..., **client_args)
       upload_args    dict of additional keyword args (ExtraArgs) for
-                     client.upload_file() call
+                     client.upload_fileobj() and client.put_object() calls
+      multipart_threshold  files this size in bytes or larger are uploaded
+                     with boto3's multipart transfer manager; smaller files
+                     with a single put_object() request (default 8MB)
+      multipart_chunksize  part size in bytes for multipart uploads
+                     (default 8MB)
+      max_concurrency  maximum number of threads uploading parts of a
+                     single multipart upload (default 10)
+      workers        number of threads that will upload at once (set from
+                     --workers on the command line); used to size the
+                     connection pool
+      max_pool_connections  maximum number of connections kept open per
+                     client (default max(10, max_concurrency), times workers
+                     unless per_thread_clients is set)
+      per_thread_clients  if true, each request uses its own client (and
+                     connection pool) from one shared session, instead of all
+                     threads sharing a single client; clients are checked out
+                     of a pool that keeps up to "workers" idle clients
+
+    Clients are configured with TCP keepalive (if botocore supports it), so
+    connections are reused rather than paying for a new TLS handshake on
+    each request; connection_stats() reports how well that's working.
     """
 
     def __init__(self, s3_url, access_key=None, secret_key=None,
                  max_age=365*24*60*60, cache_control='public, max-age={max_age}',
                  acl='public-read', region_name=None, client_args=None,
-                 upload_args=None, _boto3=None):
+                 upload_args=None, multipart_threshold=8*1024*1024,
+                 multipart_chunksize=8*1024*1024, max_concurrency=10,
+                 workers=1, max_pool_connections=None,
+                 per_thread_clients=False, _boto3=None):
+        try:
+            from urllib.parse import urlparse
+        except ImportError:
+            from urlparse import urlparse
 
         parsed = urlparse(s3_url)
         if parsed.scheme != 's3':
@@ -390,6 +2292,32 @@ class S3Destination(Destination):
             cache_control = cache_control.format(max_age=max_age)
             self.upload_args['CacheControl'] = cache_control
 
+        try:
+            self.multipart_threshold = int(multipart_threshold)
+            self.multipart_chunksize = int(multipart_chunksize)
+            self.max_concurrency = int(max_concurrency)
+            self.workers = int(workers)
+            if max_pool_connections is not None:
+                max_pool_connections = int(max_pool_connections)
+        except (ValueError, TypeError):
+            raise TypeError('multipart_threshold, multipart_chunksize, '
+                            'max_concurrency, workers, and '
+                            'max_pool_connections must be integers')
+        self._transfer_config = None
+
+        if isinstance(per_thread_clients, str):
+            # From the command line, for example "per_thread_clients=false"
+            per_thread_clients = per_thread_clients.lower() not in (
+                    '', '0', 'false', 'no', 'off')
+        self.per_thread_clients = bool(per_thread_clients)
+        if max_pool_connections is None:
+            # Each worker uses one connection for a put_object() request, or
+            # up to max_concurrency for a multipart upload
+            max_pool_connections = max(10, self.max_concurrency)
+            if not self.per_thread_clients:
+                max_pool_connections *= max(1, self.workers)
+        self.max_pool_connections = max_pool_connections
+
         # Import boto3 at runtime so it's not required to use cdnupload.py
         if _boto3 is None:
             try:
@@ -407,89 +2335,1223 @@ class S3Destination(Destination):
         )
         if client_args:
             client_kwargs.update(client_args)
-        self.s3_client = boto3.client('s3', **client_kwargs)
+        config = self._client_config(client_kwargs.get('config'))
+        if config is not None:
+            client_kwargs['config'] = config
+        self._client_kwargs = client_kwargs
+
+        # Clients are thread-safe, but creating them from a session isn't
+        self._session = boto3.session.Session()
+        self._clients = []
+        self._clients_lock = threading.Lock()
+        # Running totals, so clients dropped from the pool still count
+        self._num_requests = 0
+        self._num_retired_connections = 0
+        self._counting_requests = True
+        self._client = self._make_client()
+        self._idle_clients = [self._client]
 
     def __str__(self):
         return 's3://{}/{}'.format(self.bucket_name, self.key_prefix)
 
+    def _client_config(self, user_config=None):
+        """Return botocore Config for clients with the connection pool size
+        and TCP keepalive set (merged with "user_config" if given), or
+        user_config if botocore isn't available.
+        """
+        try:
+            from botocore.config import Config
+        except ImportError:
+            return user_config
+        try:
+            config = Config(max_pool_connections=self.max_pool_connections,
+                            tcp_keepalive=True)
+        except TypeError:
+            # Older versions of botocore don't support tcp_keepalive
+            config = Config(max_pool_connections=self.max_pool_connections)
+        if user_config is not None:
+            config = config.merge(user_config)
+        return config
+
+    def _make_client(self):
+        with self._clients_lock:
+            client = self._session.client('s3', **self._client_kwargs)
+            self._clients.append(client)
+        self._count_requests(client)
+        return client
+
+    def _count_requests(self, client):
+        """Count HTTP requests (including retries) made by given client,
+        using botocore's "request-created" event.
+        """
+        try:
+            client.meta.events.register('request-created.s3',
+                                        self._on_request_created)
+        except AttributeError:
+            self._counting_requests = False
+
+    def _on_request_created(self, **kwargs):
+        with self._clients_lock:
+            self._num_requests += 1
+
+    @staticmethod
+    def _client_connections(client):
+        """Return number of new connections opened by given client, or None
+        if urllib3's connection pools aren't accessible (they're found via
+        botocore internals, so this is best effort).
+        """
+        try:
+            manager = client._endpoint.http_session._manager
+            return sum(pool.num_connections
+                       for pool in list(manager.pools._container.values()))
+        except AttributeError:
+            return None
+
+    def _retire_client(self, client):
+        """Add connections opened by given client (which is being dropped)
+        to the running total. Must be called with _clients_lock held.
+        """
+        num_connections = self._client_connections(client)
+        if num_connections is None or self._num_retired_connections is None:
+            self._num_retired_connections = None
+        else:
+            self._num_retired_connections += num_connections
+
+    @property
+    def s3_client(self):
+        """The shared boto3 S3 client (with per_thread_clients, requests
+        check out their own client with _borrow_client() instead). Setting
+        it, for example to a stubbed or pre-configured client, replaces the
+        shared client and the pool of per-thread clients.
+        """
+        return self._client
+
+    @s3_client.setter
+    def s3_client(self, client):
+        with self._clients_lock:
+            # Clients borrowed right now are retired when they're returned
+            for old_client in self._idle_clients:
+                self._retire_client(old_client)
+            self._client = client
+            self._clients = [client]
+            self._idle_clients = [client]
+        self._count_requests(client)
+
+    @contextlib.contextmanager
+    def _borrow_client(self):
+        """Context manager that yields a client for one request: the shared
+        client, or with per_thread_clients, an idle client from the pool (or
+        a new one if they're all in use). Afterwards the client is returned
+        to the pool, unless "workers" clients are already idle, so the
+        number of clients doesn't grow with the number of threads over the
+        life of the process.
+        """
+        if not self.per_thread_clients:
+            yield self._client
+            return
+        with self._clients_lock:
+            client = self._idle_clients.pop() if self._idle_clients else None
+        if client is None:
+            client = self._make_client()
+        try:
+            yield client
+        finally:
+            with self._clients_lock:
+                # Client may have been dropped by setting s3_client
+                keep = (client in self._clients and
+                        len(self._idle_clients) < max(1, self.workers))
+                if keep:
+                    self._idle_clients.append(client)
+                else:
+                    if client in self._clients:
+                        self._clients.remove(client)
+                    self._retire_client(client)
+            if not keep and hasattr(client, 'close'):
+                client.close()
+
+    def connection_stats(self):
+        """Return dict of connection statistics totalled over all clients,
+        including ones dropped from the pool: number of current clients,
+        HTTP requests made, new connections opened, and requests that
+        reused an existing connection. Requests are counted with botocore's
+        "request-created" event, and new connections are read from urllib3's
+        connection pools (best effort); counts are None if unavailable.
+        """
+        with self._clients_lock:
+            clients = list(self._clients)
+            num_requests = self._num_requests
+            num_connections = self._num_retired_connections
+        if not self._counting_requests:
+            num_requests = None
+        for client in clients:
+            if num_connections is None:
+                break
+            client_connections = self._client_connections(client)
+            if client_connections is None:
+                num_connections = None
+            else:
+                num_connections += client_connections
+        num_reused = None
+        if num_requests is not None and num_connections is not None:
+            num_reused = max(0, num_requests - num_connections)
+        return collections.OrderedDict([
+            ('clients', len(clients)),
+            ('requests', num_requests),
+            ('connections', num_connections),
+            ('reused', num_reused),
+        ])
+
     def walk_keys(self):
-        paginator = self.s3_client.get_paginator('list_objects_v2')
-        pages = paginator.paginate(
-            Bucket=self.bucket_name,
-            Prefix=self.key_prefix,
-            PaginationConfig={'PageSize': 1000},
-        )
-        for response in pages:
-            for obj in response.get('Contents', []):
-                if obj['Key'].endswith('/'):
-                    # Don't return "folders", empty keys that end with '/'
-                    continue
-                yield obj['Key']
+        with self._borrow_client() as client:
+            paginator = client.get_paginator('list_objects_v2')
+            pages = paginator.paginate(
+                Bucket=self.bucket_name,
+                Prefix=self.key_prefix,
+                PaginationConfig={'PageSize': 1000},
+            )
+            for response in pages:
+                _list_page(self, len(response.get('Contents', [])))
+                for obj in response.get('Contents', []):
+                    if obj['Key'].endswith('/'):
+                        # Don't return "folders", empty keys that end with '/'
+                        continue
+                    yield obj['Key']
 
     def upload(self, key, source, rel_path):
-        content_type = mimetypes.guess_type(rel_path)[0]
+        content_type = _guess_content_type(rel_path)
         key = self.key_prefix + key
 
         extra_args = self.upload_args.copy()
         if content_type:
             extra_args['ContentType'] = content_type
 
-        with source.open(rel_path) as source_file:
-            self.s3_client.upload_fileobj(source_file, self.bucket_name, key,
-                                          ExtraArgs=extra_args)
+        with source.open(rel_path) as source_file, \
+                self._borrow_client() as client:
+            size = _file_size(source_file)
+            if size is not None and size < self.multipart_threshold:
+                # A single PutObject request avoids the transfer manager's
+                # thread pool and multipart bookkeeping for small files
+                client.put_object(Bucket=self.bucket_name, Key=key,
+                                  Body=source_file, **extra_args)
+            else:
+                client.upload_fileobj(
+                        source_file, self.bucket_name, key,
+                        ExtraArgs=extra_args, Config=self.transfer_config())
+
+    def transfer_config(self):
+        """Return the boto3 TransferConfig used for multipart uploads (or None
+        if boto3.s3.transfer isn't available, in which case boto3's defaults
+        are used).
+        """
+        if self._transfer_config is None:
+            try:
+                from boto3.s3.transfer import TransferConfig
+            except ImportError:
+                return None
+            self._transfer_config = TransferConfig(
+                multipart_threshold=self.multipart_threshold,
+                multipart_chunksize=self.multipart_chunksize,
+                max_concurrency=self.max_concurrency,
+            )
+        return self._transfer_config
 
     def delete(self, key):
         key = self.key_prefix + key
-        self.s3_client.delete_object(Bucket=self.bucket_name, Key=key)
+        with self._borrow_client() as client:
+            client.delete_object(Bucket=self.bucket_name, Key=key)
 
 
-# Type returned by top-level upload() and delete() functions
-Result = collections.namedtuple('Result', [
-    'source_key_map',
-    'destination_keys',
-    'num_scanned',
-    'num_processed',
-    'num_errors',
-])
+class HTTPDestination(Destination):
+    """Uploads files to a web server using HTTP PUT requests (for example, a
+    WebDAV-style origin), deletes them with DELETE requests, and lists keys
+    by fetching a JSON listing. Connections are kept open and reused.
 
+    required argument ("destination" command line parameter):
+      url            base URL in http[s]://host[:port]/path form; keys are
+                     appended to it (trailing slash is added if not present)
 
-def upload(source, destination, force=False, dry_run=False,
-           continue_on_errors=False):
-    """Upload missing files from source to destination (an instance of a
+    optional arguments:
+      list_url       URL of the JSON listing, relative to "url" (default is
+                     "url" itself); the listing must be a list of keys, or an
+                     object whose "list_field" is the list
+      list_field     field of a listing object that holds the list of keys
+                     (default 'keys')
+      key_field      if listed items are objects, the field that holds the
+                     key (default 'key')
+      next_field     field of a listing object that holds the URL of the
+                     next page of the listing, if any (default 'next')
+      max_age        max-age value for Cache-Control header, in seconds
+      cache_control  full Cache-Control header (overrides max_age)
+      headers        dict of extra headers to send with every request (or
+                     "Name: value" string, or list of them)
+      username       username for HTTP basic authentication
+      password       password for HTTP basic authentication
+      timeout        socket timeout in seconds (default 60)
+      workers        number of threads that will upload at once (set from
+                     --workers on the command line); up to this many idle
+                     connections are kept open
+      keep_alive     if false, close the connection after each request
+      chunk_size     size in bytes of the blocks read from the source file
+                     and sent (default 64KB); files whose size isn't known
+                     are sent with chunked transfer encoding
+
+    Listed keys that start with the path of "url" have it removed, so the
+    listing may give keys either relative to "url" or as absolute paths.
+    """
+
+    def __init__(self, url, list_url=None, list_field='keys', key_field='key',
+                 next_field='next', max_age=365*24*60*60,
+                 cache_control='public, max-age={max_age}', headers=None,
+                 username=None, password=None, timeout=60, workers=1,
+                 keep_alive=True, chunk_size=64*1024):
+        try:
+            from urllib.parse import urljoin, urlparse
+        except ImportError:
+            from urlparse import urljoin, urlparse
+
+        if not url.endswith('/'):
+            url += '/'
+        parsed = urlparse(url)
+        if parsed.scheme not in ('http', 'https'):
+            raise ValueError('url must start with http:// or https://')
+        if not parsed.hostname:
+            raise ValueError('url must include a host name')
+        self.url = url
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.path = parsed.path
+
+        self.list_url = urljoin(url, list_url or '')
+        if urlparse(self.list_url).netloc != parsed.netloc:
+            raise ValueError('list_url must be on the same host as url')
+        self.list_field = list_field
+        self.key_field = key_field
+        self.next_field = next_field
+
+        try:
+            self.timeout = float(timeout)
+            self.workers = int(workers)
+            self.chunk_size = int(chunk_size)
+        except (ValueError, TypeError):
+            raise TypeError('timeout, workers, and chunk_size must be numbers')
+        if isinstance(keep_alive, str):
+            keep_alive = keep_alive.lower() not in ('', '0', 'false', 'no',
+                                                    'off')
+        self.keep_alive = bool(keep_alive)
+
+        self.headers = {}
+        if isinstance(headers, dict):
+            self.headers.update(headers)
+        elif headers:
+            if isinstance(headers, str):
+                headers = [headers]
+            for header in headers:
+                name, sep, value = header.partition(':')
+                if not sep:
+                    raise ValueError('header must be in "Name: value" form, '
+                                     'not {!r}'.format(header))
+                self.headers[name.strip()] = value.strip()
+        if cache_control and 'Cache-Control' not in self.headers:
+            try:
+                max_age = int(max_age)
+            except (ValueError, TypeError):
+                raise TypeError('max_age must be an integer number of seconds, '
+                                'not {!r}'.format(max_age))
+            self.headers['Cache-Control'] = cache_control.format(
+                    max_age=max_age)
+        if username is not None:
+            import base64
+            credentials = '{}:{}'.format(username, password or '')
+            self.headers['Authorization'] = 'Basic ' + base64.b64encode(
+                    credentials.encode('utf-8')).decode('ascii')
+
+        self._pool = []  # idle connections, most recently used last
+        self._pool_lock = threading.Lock()
+        self.num_requests = 0
+        self.num_connections = 0
+
+    def __str__(self):
+        return self.url
+
+    def _get_connection(self):
+        """Return tuple of (connection, reused), taking an idle connection
+        from the pool if there is one, otherwise opening a new one.
+        """
+        with self._pool_lock:
+            self.num_requests += 1
+            if self._pool:
+                return self._pool.pop(), True
+            self.num_connections += 1
+
+        try:
+            import http.client as http_client
+        except ImportError:
+            import httplib as http_client
+        if self.scheme == 'https':
+            connection_class = http_client.HTTPSConnection
+        else:
+            connection_class = http_client.HTTPConnection
+        return connection_class(self.host, self.port,
+                                timeout=self.timeout), False
+
+    def _put_connection(self, connection):
+        """Return connection to the pool (or close it if the pool is full)."""
+        with self._pool_lock:
+            if len(self._pool) < max(1, self.workers):
+                self._pool.append(connection)
+                return
+        connection.close()
+
+    def _send(self, connection, method, path, file=None, headers=None):
+        """Send a single request, streaming the body from "file" if given."""
+        connection.putrequest(method, path, skip_accept_encoding=True)
+        for name, value in self.headers.items():
+            connection.putheader(name, value)
+        for name, value in (headers or {}).items():
+            connection.putheader(name, value)
+        if not self.keep_alive:
+            connection.putheader('Connection', 'close')
+
+        size = None
+        if file is not None:
+            size = _file_size(file)
+            if size is None:
+                connection.putheader('Transfer-Encoding', 'chunked')
+            else:
+                connection.putheader('Content-Length', str(size))
+        elif method == 'PUT':
+            connection.putheader('Content-Length', '0')
+        connection.endheaders()
+
+        if file is None:
+            return
+        while True:
+            chunk = file.read(self.chunk_size)
+            if not chunk:
+                break
+            if size is None:
+                chunk = '{:x}\r\n'.format(len(chunk)).encode('ascii') + \
+                        chunk + b'\r\n'
+            connection.send(chunk)
+        if size is None:
+            connection.send(b'0\r\n\r\n')
+
+    def _request(self, method, path, file=None, headers=None):
+        """Make an HTTP request using a pooled connection and return tuple of
+        (status, reason, body). If a reused connection turns out to have
+        been closed by the server, retry once on a new connection (PUT, GET,
+        and DELETE are idempotent).
+        """
+        try:
+            import http.client as http_client
+        except ImportError:
+            import httplib as http_client
+        import socket
+
+        start = file.tell() if file is not None else None
+        while True:
+            connection, reused = self._get_connection()
+            try:
+                self._send(connection, method, path, file=file,
+                           headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (http_client.HTTPException, socket.error):
+                connection.close()
+                if not reused:
+                    raise
+                if file is not None:
+                    file.seek(start)
+                continue
+            if response.will_close or not self.keep_alive:
+                connection.close()
+            else:
+                self._put_connection(connection)
+            return response.status, response.reason, body
+
+    def _key_path(self, key):
+        try:
+            from urllib.parse import quote
+        except ImportError:
+            from urllib import quote
+        return quote(self.path + key, safe='/')
+
+    def _check_status(self, method, path, status, reason, ok=(200, 201, 204)):
+        if status not in ok:
+            raise IOError('{} {} returned {} {}'.format(method, path, status,
+                                                        reason))
+
+    def walk_keys(self):
+        import json
+        try:
+            from urllib.parse import urljoin, urlparse
+        except ImportError:
+            from urlparse import urljoin, urlparse
+
+        url = self.list_url
+        while url:
+            parsed = urlparse(url)
+            path = parsed.path + ('?' + parsed.query if parsed.query else '')
+            status, reason, body = self._request(
+                    'GET', path, headers={'Accept': 'application/json'})
+            self._check_status('GET', path, status, reason, ok=(200,))
+            listing = json.loads(body.decode('utf-8'))
+
+            url = None
+            if isinstance(listing, dict):
+                next_url = listing.get(self.next_field)
+                if next_url:
+                    url = urljoin(self.list_url, next_url)
+                listing = listing.get(self.list_field) or []
+            _list_page(self, len(listing))
+            for item in listing:
+                key = item[self.key_field] if isinstance(item, dict) else item
+                if key.startswith(self.path):
+                    key = key[len(self.path):]
+                if not key or key.endswith('/'):
+                    continue
+                yield key
+
+    def upload(self, key, source, rel_path):
+        path = self._key_path(key)
+        headers = {}
+        content_type = _guess_content_type(rel_path)
+        if content_type:
+            headers['Content-Type'] = content_type
+        with source.open(rel_path) as source_file:
+            status, reason, _ = self._request('PUT', path, file=source_file,
+                                              headers=headers)
+        self._check_status('PUT', path, status, reason)
+
+    def delete(self, key):
+        path = self._key_path(key)
+        status, reason, _ = self._request('DELETE', path)
+        # Already deleted is fine (as with S3)
+        self._check_status('DELETE', path, status, reason,
+                           ok=(200, 202, 204, 404))
+
+    def connection_stats(self):
+        """Return dict of number of HTTP requests made, new connections
+        opened, and requests that reused an idle connection.
+        """
+        with self._pool_lock:
+            return collections.OrderedDict([
+                ('requests', self.num_requests),
+                ('connections', self.num_connections),
+                ('reused', self.num_requests - self.num_connections),
+            ])
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket that refills at "rate" tokens per second,
+    holding at most "capacity" tokens (default one second's worth).
+    """
+
+    def __init__(self, rate, capacity=None, _timer=_timer, _sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError('rate must be positive, not {!r}'.format(rate))
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self._timer = _timer
+        self._sleep = _sleep
+        self._last = _timer()
+        self._lock = threading.Lock()
+
+    def consume(self, amount=1):
+        """Take "amount" tokens from the bucket, sleeping until they've been
+        refilled if there aren't enough. Return the number of seconds slept.
+
+        Tokens are taken straight away (the bucket can go into debt), so
+        callers are served in the order they arrive, and an amount larger
+        than the capacity just waits proportionally longer.
+        """
+        with self._lock:
+            now = self._timer()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self._last) * self.rate)
+            self._last = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            self._sleep(wait)
+        return wait
+
+
+class RateLimiter(object):
+    """Limit upload bandwidth to "max_bandwidth" bytes per second and
+    requests to the destination (uploads and deletes) to
+    "max_requests_per_second". Either limit may be None for no limit.
+
+    Pass the same instance to upload(), delete(), sync(), or apply_plan() to
+    apply the limits across all worker threads and destinations together,
+    for example to leave room on an uplink shared with production traffic.
+    """
+
+    def __init__(self, max_bandwidth=None, max_requests_per_second=None):
+        self.max_bandwidth = max_bandwidth
+        self.max_requests_per_second = max_requests_per_second
+        self.bandwidth = TokenBucket(max_bandwidth) if max_bandwidth else None
+        self.requests = (TokenBucket(max_requests_per_second)
+                         if max_requests_per_second else None)
+
+    def __repr__(self):
+        return ('RateLimiter(max_bandwidth={!r}, '
+                'max_requests_per_second={!r})'.format(
+                    self.max_bandwidth, self.max_requests_per_second))
+
+    def request(self, stats=None):
+        """Wait until another request may be made. Time spent waiting is
+        added to "stats" (a Stats instance) if given.
+        """
+        if self.requests is not None:
+            _add_throttle(stats, self.requests.consume(1))
+
+    def read(self, num_bytes, stats=None):
+        """Wait until "num_bytes" more bytes may be sent."""
+        if self.bandwidth is not None and num_bytes:
+            _add_throttle(stats, self.bandwidth.consume(num_bytes))
+
+
+def _add_throttle(stats, seconds):
+    """Add throttle wait to stats if there was a wait."""
+    if seconds and stats is not None:
+        stats.add_throttle(seconds)
+
+
+class _ThrottledFile(object):
+    """Wrap a file object so that reading from it is limited by a
+    RateLimiter's bandwidth limit. Other attributes are passed through.
+    """
+
+    def __init__(self, file, rate_limiter, stats=None):
+        self.file = file
+        self._rate_limiter = rate_limiter
+        self._stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.file.close()
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self._rate_limiter.read(len(data), self._stats)
+        return data
+
+    def readinto(self, buffer):
+        num_read = self.file.readinto(buffer)
+        self._rate_limiter.read(num_read or 0, self._stats)
+        return num_read
+
+
+class _ThrottledSource(object):
+    """Wrap a source so that each file opened counts as one request and is
+    read at no more than the RateLimiter's bandwidth limit.
+    """
+
+    def __init__(self, source, rate_limiter, stats=None):
+        self.source = source
+        self._rate_limiter = rate_limiter
+        self._stats = stats
+
+    def __str__(self):
+        return str(self.source)
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+    def open(self, rel_path):
+        self._rate_limiter.request(self._stats)
+        file = self.source.open(rel_path)
+        if self._rate_limiter.bandwidth is None:
+            return file
+        return _ThrottledFile(file, self._rate_limiter, self._stats)
+
+
+class _MeasuredSource(object):
+    """Wrap a source to record the size of each file opened (so that upload
+    statistics can include bytes uploaded). "sizes" maps relative path to
+    size in bytes.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.sizes = {}
+
+    def __str__(self):
+        return str(self.source)
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+    def open(self, rel_path):
+        file = self.source.open(rel_path)
+        size = _file_size(file)
+        if size is not None:
+            self.sizes[rel_path] = size
+        return file
+
+
+class _SharedSource(object):
+    """Wrap a source so that a file being uploaded to several destinations is
+    only read once. "num_readers" is a dict mapping relative path to the
+    number of destinations that will open it. The contents of such files are
+    kept in memory until the last destination has opened them (files larger
+    than MAX_SHARED_READ_SIZE are opened separately for each destination).
+
+    Each path has its own lock, so a slow read of one file only holds up
+    other destinations opening that same file.
+    """
+
+    def __init__(self, source, num_readers):
+        self.source = source
+        self._num_readers = num_readers
+        self._contents = {}
+        self._path_locks = {}
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return str(self.source)
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+    def open(self, rel_path):
+        with self._lock:
+            path_lock = None
+            if self._num_readers.get(rel_path, 0):
+                path_lock = self._path_locks.get(rel_path)
+                if path_lock is None:
+                    path_lock = threading.Lock()
+                    self._path_locks[rel_path] = path_lock
+        if path_lock is None:
+            return self.source.open(rel_path)
+
+        with path_lock:
+            with self._lock:
+                num_readers = self._num_readers.get(rel_path, 0)
+                content = self._contents.pop(rel_path, None)
+            if num_readers == 0:
+                return self.source.open(rel_path)
+
+            if content is None:
+                file = self.source.open(rel_path)
+                size = _file_size(file)
+                if (num_readers == 1 or size is None or
+                        size > MAX_SHARED_READ_SIZE):
+                    self._done(rel_path)
+                    return file
+                try:
+                    content = file.read()
+                finally:
+                    file.close()
+
+            num_readers -= 1
+            if num_readers:
+                with self._lock:
+                    self._num_readers[rel_path] = num_readers
+                    self._contents[rel_path] = content
+            else:
+                self._done(rel_path)
+        return io.BytesIO(content)
+
+    def _done(self, rel_path):
+        """Forget rel_path once no more destinations will share it."""
+        with self._lock:
+            self._num_readers.pop(rel_path, None)
+            self._path_locks.pop(rel_path, None)
+
+
+class _KeyMapShardSource(object):
+    """Wrap a source to add shards of its key map to the key map, so that
+    they're uploaded (and kept when deleting) like other files. The key map
+    is split with split_key_map(), and each section becomes a JSON file at
+    relative path "prefix" + name + '.json', keyed by the source's
+    make_key() with a hash of its content. After build_key_map(),
+    "shard_keys" maps section name to the key of its shard.
+    """
+
+    def __init__(self, source, sections=None, prefix='key-map/'):
+        self.source = source
+        self.sections = sections
+        self.prefix = prefix
+        self.shard_keys = collections.OrderedDict()
+        self._contents = {}
+
+    def __str__(self):
+        return str(self.source)
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+    def build_key_map(self):
+        import hashlib
+        import json
+
+        key_map = self.source.build_key_map()
+        full_key_map = dict(key_map)
+        shard_keys = collections.OrderedDict()
+        contents = {}
+        for name, shard in split_key_map(key_map, self.sections).items():
+            rel_path = self.prefix + name + '.json'
+            if rel_path in key_map:
+                raise ValueError('key map shard {} is also a source '
+                                 'file'.format(rel_path))
+            content = json.dumps(shard, sort_keys=True,
+                                 separators=(',', ':')).encode('utf-8')
+            hash_class = getattr(self.source, 'hash_class', hashlib.sha1)
+            hash_obj = hash_class()
+            hash_obj.update(content)
+            key = self.source.make_key(rel_path, hash_obj.hexdigest())
+            contents[rel_path] = content
+            shard_keys[name] = key
+            full_key_map[rel_path] = key
+        self.shard_keys = shard_keys
+        self._contents = contents
+        return full_key_map
+
+    def open(self, rel_path):
+        content = self._contents.get(rel_path)
+        if content is not None:
+            return io.BytesIO(content)
+        return self.source.open(rel_path)
+
+
+class _KeyCacheDestination(object):
+    """Wrap a destination to keep the set of keys on it in memory, so that
+    walk_keys() only lists the destination again once "relist_interval"
+    seconds have passed. Keys are added and removed as they're uploaded and
+    deleted through the wrapper, so the set stays current as long as
+    nothing else writes to the destination.
+    """
+
+    def __init__(self, destination, relist_interval, _timer=_timer):
+        self.destination = destination
+        self.relist_interval = relist_interval
+        self.keys = None
+        self.listed_time = None
+        self._lock = threading.Lock()
+        self._timer = _timer
+
+    def __str__(self):
+        return str(self.destination)
+
+    def __getattr__(self, name):
+        return getattr(self.destination, name)
+
+    def walk_keys(self):
+        if (self.keys is None or
+                self._timer() - self.listed_time >= self.relist_interval):
+            keys = set(self.destination.walk_keys())
+            with self._lock:
+                self.keys = keys
+                self.listed_time = self._timer()
+        else:
+            logger.debug('using %d cached keys for %s', len(self.keys),
+                         self.destination)
+        with self._lock:
+            keys = list(self.keys)
+        for key in keys:
+            yield key
+
+    def upload(self, key, source, rel_path):
+        self.destination.upload(key, source, rel_path)
+        with self._lock:
+            if self.keys is not None:
+                self.keys.add(key)
+
+    def delete(self, key):
+        self.destination.delete(key)
+        with self._lock:
+            if self.keys is not None:
+                self.keys.discard(key)
+
+
+def _map_threads(func, args_list):
+    """Call func(*args) for each args tuple in args_list, each in its own
+    thread, and return a list of the results in the same order. If any of the
+    calls raised an exception, re-raise the first one (in args_list order)
+    after all the threads have finished.
+    """
+    results = [None] * len(args_list)
+    errors = [None] * len(args_list)
+
+    def run(index, args):
+        try:
+            results[index] = func(*args)
+        except Exception as error:
+            errors[index] = error
+
+    threads = []
+    for index, args in enumerate(args_list):
+        thread = threading.Thread(target=run, args=(index, args))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    for error in errors:
+        if error is not None:
+            raise error
+    return results
+
+
+def _prepare(source, destination, allow_shard=True):
+    """Convert source and destination (or list of destinations) arguments to
+    instances, build the source key map, and return tuple of (source,
+    source_key_map, destination, stats), where destination is a list if a
+    list or tuple of destinations was given, and stats is a Stats instance
+    with the timings of building the key map.
+    """
+    if isinstance(source, (str, bytes)):
+        source = FileSource(source)
+    if not allow_shard and getattr(source, 'shard', None):
+        raise ValueError("can't delete with a sharded source, as its key map "
+                         "only includes some of the source files")
+
+    if isinstance(destination, (list, tuple)):
+        destinations = [FileDestination(d) if isinstance(d, (str, bytes)) else d
+                        for d in destination]
+    else:
+        destinations = None
+        if isinstance(destination, (str, bytes)):
+            destination = FileDestination(destination)
+
+    old_build_stats = getattr(source, 'build_stats', None)
+    start_time = _timer()
+    try:
+        source_key_map = source.build_key_map()
+    except Exception as error:
+        raise SourceError('ERROR scanning source tree', error)
+    stats = Stats()
+    build_stats = getattr(source, 'build_stats', None)
+    if build_stats is not None and build_stats is not old_build_stats:
+        stats.merge(build_stats)
+    else:
+        stats.add_phase_time('scan', _timer() - start_time)
+
+    if destinations is not None:
+        destination = destinations
+    return (source, source_key_map, destination, stats)
+
+
+def _list_keys(destination, only_keys=None, stats=None, check_existing=False):
+    """Return set of keys currently present on destination (if only_keys is
+    given, only include keys that are in it). If stats is given, add the
+    time taken to its 'list' phase, and each page received to its 'list'
+    operations. If check_existing is True and the destination has an
+    exists_many() method, check only_keys with that instead of listing all
+    the keys.
+    """
+    if _hooks:
+        _call_hooks('list_start', destination)
+    start_time = _timer()
+    if stats is not None:
+        pages = {'count': 0, 'time': start_time}
+
+        def count_page(destination, num_keys):
+            now = _timer()
+            pages['count'] += 1
+            stats.add_operation('list', '{} page {}'.format(
+                    destination, pages['count']), now - pages['time'])
+            pages['time'] = now
+        _list_page_local.callback = count_page
+    try:
+        if (check_existing and only_keys is not None and
+                hasattr(destination, 'exists_many')):
+            keys = set(destination.exists_many(only_keys))
+        elif only_keys is not None:
+            keys = set(k for k in destination.walk_keys() if k in only_keys)
+        else:
+            keys = set(destination.walk_keys())
+    except Exception as error:
+        raise DestinationError('ERROR listing keys at {}'.format(destination),
+                               error)
+    finally:
+        _list_page_local.callback = None
+    if _hooks:
+        _call_hooks('list_end', destination, len(keys))
+    if stats is not None:
+        stats.add_phase_time('list', _timer() - start_time)
+    return keys
+
+
+# Type returned by top-level upload() and delete() functions
+Result = collections.namedtuple('Result', [
+    'source_key_map',
+    'destination_keys',
+    'num_scanned',
+    'num_processed',
+    'num_errors',
+    'num_uploaded',
+    'num_deleted',
+    'stats',
+])
+
+
+@_action_hooks('upload')
+def upload(source, destination, force=False, dry_run=False,
+           continue_on_errors=False, workers=1, rate_limiter=None,
+           check_existing=False, history=None):
+    """Upload missing files from source to destination (an instance of a
     Destination subclass). Return a Result namedtuple, which includes the
     source key map, set of destination keys, and upload statistics.
 
     If "source" is a string, FileSource(source) is used as the source
     instance. Otherwise "source" must be a FileSource instance.
 
+    If "destination" is a list or tuple of destinations, the source key map
+    is only built once, and each destination is listed and uploaded to
+    concurrently (in its own thread). In this case a list of Result
+    namedtuples is returned, one per destination in the same order. Source
+    files that need uploading to several destinations are only read once.
+
     The contents of each source file is hashed by the source and included in
     the destination key. This is so that if a file changes, it's uploaded
     again under a new filename to break caching. For example,
     'images/logo.png' will become something like
     'images/logo_deadbeef12345678.png'.
 
+    If the source is sharded (see FileSource's "shard" argument), only keys
+    in this shard are kept from the destination listing, and
+    Result.destination_keys only contains those.
+
     If force is True, upload even if files are there already. If dry_run is
-    True, log what would be uploaded instead of actually uploading.
+    True, log what would be uploaded instead of actually uploading, and set
+    Result.stats.estimate to an Estimate of the bytes and requests the
+    upload would take.
+
+    If "history" is a ThroughputHistory instance, the upload timings are
+    added to it, or for a dry run, they're used to estimate how long the
+    upload would take.
 
     If continue_on_errors is True, it will continue uploading other files even
     if some uploads fail (the default is to raise DestinationError on first
     error).
+
+    If "workers" is greater than 1, upload that many files at once (per
+    destination) using threads. In that case the largest files are uploaded
+    first, so that a huge file doesn't start last and hold up the finish.
+
+    If "rate_limiter" is a RateLimiter instance, uploads are throttled to
+    its bandwidth and request rate limits (shared by all workers and
+    destinations), and the time spent waiting is included in the stats.
+
+    If check_existing is True, destinations that have an exists_many()
+    method (like FileDestination) are asked which of the source keys exist,
+    instead of listing all their keys. This is faster if the destination
+    has many more keys than the source (for example, old versions), and
+    Result.destination_keys then only contains source keys.
     """
-    if isinstance(source, (str, bytes)):
-        source = FileSource(source)
-    if isinstance(destination, (str, bytes)):
-        destination = FileDestination(destination)
+    source, source_key_map, destination, stats = _prepare(source, destination)
+    options = dict(force=force, dry_run=dry_run,
+                   continue_on_errors=continue_on_errors, workers=workers,
+                   rate_limiter=rate_limiter, history=history)
+    only_keys = None
+    if getattr(source, 'shard', None) or check_existing:
+        only_keys = set(source_key_map.values())
+
+    if not isinstance(destination, list):
+        destination_keys = _list_keys(destination, only_keys=only_keys,
+                                      stats=stats,
+                                      check_existing=check_existing)
+        _trim_content_cache(source, source_key_map, [destination_keys], force)
+        return _upload_missing(source, source_key_map, destination,
+                               destination_keys, stats=stats, **options)
+
+    destinations = destination
+    all_stats = [stats.copy() for _ in destinations]
+    all_destination_keys = _map_threads(
+            _list_keys, [(d, only_keys, st, check_existing)
+                         for d, st in zip(destinations, all_stats)])
+    _trim_content_cache(source, source_key_map, all_destination_keys, force)
+    shared_source = _share_source(source, source_key_map,
+                                  all_destination_keys, force)
+
+    def upload_to(destination, destination_keys, stats):
+        return _upload_missing(shared_source, source_key_map, destination,
+                               destination_keys, show_destination=True,
+                               stats=stats, **options)
+
+    return _map_threads(upload_to, list(zip(destinations, all_destination_keys,
+                                            all_stats)))
+
+
+def _trim_content_cache(source, source_key_map, all_destination_keys, force):
+    """Drop files from the source's content cache (if it has one) that
+    aren't missing from any of the destinations, so only files that will be
+    uploaded stay in memory.
+    """
+    trim = getattr(source, '_trim_content_cache', None)
+    if trim is None or not getattr(source, 'content_cache_size', 0):
+        return
+    trim(set(rel_path for rel_path, key in source_key_map.items()
+             if force or any(key not in keys for keys in all_destination_keys)))
 
-    try:
-        source_key_map = source.build_key_map()
-    except Exception as error:
-        raise SourceError('ERROR scanning source tree', error)
 
+def _share_source(source, source_key_map, all_destination_keys, force):
+    """Return a _SharedSource wrapping source, where files are shared between
+    all destinations that need them uploaded.
+    """
+    num_readers = collections.defaultdict(int)
+    for destination_keys in all_destination_keys:
+        for rel_path, key in source_key_map.items():
+            if force or key not in destination_keys:
+                num_readers[rel_path] += 1
+    return _SharedSource(source, dict(num_readers))
+
+
+def _upload_order(source, items):
+    """Return (rel_path, key) items sorted by source file size, largest
+    first (files whose size can't be determined are treated as empty).
+    Scheduling the longest uploads first minimizes the total time when
+    uploading with several workers.
+    """
+    sizes = dict(_file_sizes(source, items))
+    return sorted(items, key=lambda item: (-sizes[item[0]], item[0]))
+
+
+def _file_sizes(source, items):
+    """Return list of (rel_path, size) for given (rel_path, key) items (size
+    is 0 if it can't be determined).
+    """
+    stat_file = getattr(source, 'stat_file', None)
+    sizes = []
+    for rel_path, _ in items:
+        try:
+            sizes.append((rel_path, stat_file(rel_path).st_size))
+        except Exception:
+            sizes.append((rel_path, 0))
+    return sizes
+
+
+def _dry_run_estimate(stats):
+    """Return stats.estimate, first creating it with the list pages and
+    time that were measured while listing the destination.
+    """
+    if stats.estimate is None:
+        stats.estimate = Estimate()
+        histogram = stats.latencies.get('list')
+        stats.estimate.add_list(histogram.count if histogram else 0,
+                                stats.phase_times.get('list', 0.0))
+    return stats.estimate
+
+
+def _map_workers(func, items, num_workers):
+    """Call func(item) for each item in items, using num_workers threads
+    that each take the next item when they finish the previous one. If any
+    call raises an exception, stop taking new items and re-raise the first
+    exception after all the threads have finished.
+    """
+    if num_workers <= 1:
+        for item in items:
+            func(item)
+        return
+
+    iterator = iter(items)
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        while True:
+            with lock:
+                if errors:
+                    return
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            try:
+                func(item)
+            except Exception as error:
+                with lock:
+                    errors.append(error)
+                return
+
+    _map_threads(worker, [()] * num_workers)
+    if errors:
+        raise errors[0]
+
+
+def _is_symlink_cycle(path, top, dir_ids):
+    """Return True if directory "path" is the same directory (by device and
+    inode) as one of its parents up to "top". "dir_ids" is a dict mapping
+    each directory walked so far to its (st_dev, st_ino), which this updates.
+    """
     try:
-        destination_keys = set(destination.walk_keys())
-    except Exception as error:
-        raise DestinationError('ERROR listing keys at {}'.format(destination),
-                               error)
+        st = os.stat(path)
+    except OSError:
+        return False
+    if not st.st_ino:
+        return False  # inodes not supported (Python 2 on Windows)
+    dir_id = (st.st_dev, st.st_ino)
+    parent = path
+    while parent != top:
+        new_parent = os.path.dirname(parent)
+        if new_parent == parent:
+            break
+        parent = new_parent
+        if dir_ids.get(parent) == dir_id:
+            return True
+    dir_ids[path] = dir_id
+    return False
+
+
+def _walk_parallel(top, onerror=None, followlinks=False, num_workers=4,
+                   _os_walk=os.walk):
+    """Walk directory tree like os.walk() (top-down), but list all the
+    directories at each level of the tree concurrently using num_workers
+    threads. Each level's directories are yielded in sorted order, with
+    sorted lists of dirs and files, so the output is deterministic. As with
+    os.walk(), the caller can remove names from "dirs" to avoid walking them.
+    """
+    level = [top]
+    while level:
+        listings = {}
+
+        def list_dir(path):
+            # First item from os.walk() is just the listing of "path" itself,
+            # with the same error handling and symlink semantics
+            for root, dirs, files in _os_walk(path, onerror=onerror,
+                                              followlinks=followlinks):
+                listings[path] = (sorted(dirs), sorted(files))
+                break
+
+        _map_workers(list_dir, level, num_workers)
+
+        next_level = []
+        for path in level:
+            if path not in listings:
+                continue  # error listing directory (ignored by onerror)
+            dirs, files = listings[path]
+            yield path, dirs, files
+            for name in dirs:
+                new_path = os.path.join(path, name)
+                if followlinks or not os.path.islink(new_path):
+                    next_level.append(new_path)
+        level = next_level
+
+
+def _upload_missing(source, source_key_map, destination, destination_keys,
+                    force=False, dry_run=False, continue_on_errors=False,
+                    show_destination=False, stats=None, workers=1,
+                    rate_limiter=None, history=None):
+    """Upload files in source_key_map that are missing from destination_keys
+    to destination (see upload() for details). Return Result namedtuple.
+    Upload timings are added to "stats" (a new Stats instance if None).
+    """
+    if stats is None:
+        stats = Stats()
+    if rate_limiter is not None:
+        source = _ThrottledSource(source, rate_limiter, stats)
+    source = _MeasuredSource(source)
 
     options = []
     if force:
@@ -505,44 +3567,83 @@ def upload(source, destination, force=False, dry_run=False,
                 len(destination_keys),
                 ', options: ' + ', '.join(options) if options else '')
 
+    at_destination = ' at {}'.format(destination) if show_destination else ''
+    start_time = _timer()
     num_scanned = 0
-    num_uploaded = 0
-    num_errors = 0
+    to_upload = []
     for rel_path, key in sorted(source_key_map.items()):
         num_scanned += 1
 
         if not force and key in destination_keys:
-            logger.debug('already uploaded %s, skipping', key)
+            logger.debug('already uploaded %s%s, skipping', key, at_destination)
             continue
+        to_upload.append((rel_path, key))
+
+    if workers > 1 and not dry_run:
+        to_upload = _upload_order(source, to_upload)
+
+    counts = {'uploaded': 0, 'errors': 0}
+    counts_lock = threading.Lock()
 
+    def upload_one(item):
+        rel_path, key = item
         if key in destination_keys:
             verb = 'would force upload' if dry_run else 'force uploading'
         else:
             verb = 'would upload' if dry_run else 'uploading'
-        logger.warning('%s %s to %s', verb, rel_path, key)
+        logger.warning('%s %s to %s%s', verb, rel_path, key, at_destination)
         if not dry_run:
             try:
+                if _hooks:
+                    _call_hooks('upload_start', key, rel_path)
+                upload_start = _timer()
                 destination.upload(key, source, rel_path)
-                num_uploaded += 1
+                num_bytes = source.sizes.pop(rel_path, 0)
+                stats.add_operation('upload', rel_path,
+                                    _timer() - upload_start, num_bytes)
+                if _hooks:
+                    _call_hooks('upload_end', key, rel_path, num_bytes)
             except Exception as error:
+                if _hooks:
+                    _call_hooks('upload_error', key, rel_path, error)
                 if not continue_on_errors:
-                    raise DestinationError('ERROR uploading to {}'.format(key),
+                    raise DestinationError('ERROR uploading to {}{}'.format(
+                                               key, at_destination),
                                            error, key=key)
-                logger.error('ERROR uploading to %s: %s', key, error)
-                num_errors += 1
-        else:
-            num_uploaded += 1
-
-    logger.info('finished upload: uploaded %d, skipped %d, errors with %d',
-                num_uploaded, len(source_key_map) - num_uploaded, num_errors)
+                logger.error('ERROR uploading to %s%s: %s',
+                             key, at_destination, error)
+                with counts_lock:
+                    counts['errors'] += 1
+                return
+        with counts_lock:
+            counts['uploaded'] += 1
+
+    _map_workers(upload_one, to_upload, 1 if dry_run else workers)
+    num_uploaded = counts['uploaded']
+    num_errors = counts['errors']
+
+    stats.add_phase_time('upload', _timer() - start_time)
+    if dry_run:
+        sizes = [size for _, size in _file_sizes(source, to_upload)]
+        _dry_run_estimate(stats).add_uploads(
+                destination, sizes,
+                fit=history.get_fit(destination, 'upload') if history else None,
+                workers=workers, rate_limiter=rate_limiter)
+    elif history is not None:
+        history.record(destination, stats, 'upload')
+    logger.info('finished upload%s: uploaded %d, skipped %d, errors with %d',
+                at_destination, num_uploaded,
+                len(source_key_map) - num_uploaded, num_errors)
 
     result = Result(source_key_map, destination_keys,
-                    num_scanned, num_uploaded, num_errors)
+                    num_scanned, num_uploaded, num_errors, num_uploaded, 0,
+                    stats)
     return result
 
 
+@_action_hooks('delete')
 def delete(source, destination, force=False, dry_run=False,
-           continue_on_errors=False):
+           continue_on_errors=False, rate_limiter=None, history=None):
     """Delete files from destination (an instance of a Destination subclass)
     that are no longer present in source tree. Return a Result namedtuple,
     which includes the source key map, set of destination keys, and deletion
@@ -551,34 +3652,75 @@ def delete(source, destination, force=False, dry_run=False,
     If "source" is a string, FileSource(source) is used as the source
     instance. Otherwise "source" must be a FileSource instance.
 
+    If "destination" is a list or tuple of destinations, the source key map
+    is only built once, and each destination is listed and deleted from
+    concurrently. In this case a list of Result namedtuples is returned, one
+    per destination in the same order.
+
     This function does a sanity check to ensure you're not deleting ALL keys
     at the destination by accident (for example, specifying an empty directory
     for the source tree). If it would delete all destination keys, it raises
     DeleteAllKeysError. To override and delete all anyway, specify force=True.
 
     If dry_run is True, log what would be deleted instead of actually
-    deleting.
+    deleting, and set Result.stats.estimate to an Estimate of the requests
+    the delete would take.
 
     If continue_on_errors is True, it will continue deleting other files even
     if some deletes fail (the default is to raise DestinationError on first
     error).
-    """
-    if isinstance(source, (str, bytes)):
-        source = FileSource(source)
-    if isinstance(destination, (str, bytes)):
-        destination = FileDestination(destination)
 
-    try:
-        source_key_map = source.build_key_map()
-    except Exception as error:
-        raise SourceError('ERROR scanning source tree', error)
-    source_keys = set(source_key_map.values())
+    If "rate_limiter" is a RateLimiter instance, delete requests are limited
+    to its request rate.
 
-    try:
-        destination_keys = set(destination.walk_keys())
-    except Exception as error:
-        raise DestinationError('ERROR listing keys at {}'.format(destination),
-                               error)
+    If "history" is a ThroughputHistory instance, the delete timings are
+    added to it, or for a dry run, they're used to estimate how long the
+    delete would take.
+    """
+    source, source_key_map, destination, stats = _prepare(
+            source, destination, allow_shard=False)
+    options = dict(force=force, dry_run=dry_run,
+                   continue_on_errors=continue_on_errors,
+                   rate_limiter=rate_limiter, history=history)
+
+    if not isinstance(destination, list):
+        destination_keys = _list_keys(destination, stats=stats)
+        return _delete_unused(source, source_key_map, destination,
+                              destination_keys, stats=stats, **options)
+
+    def list_and_delete(destination, stats):
+        destination_keys = _list_keys(destination, stats=stats)
+        return _delete_unused(source, source_key_map, destination,
+                              destination_keys, show_destination=True,
+                              stats=stats, **options)
+
+    return _map_threads(list_and_delete,
+                        [(d, stats.copy()) for d in destination])
+
+
+def _check_delete_all(source_keys, destination_keys):
+    """Raise DeleteAllKeysError if deleting the destination keys that aren't
+    in source_keys would delete all of them.
+    """
+    num_to_delete = sum(1 for k in destination_keys if k not in source_keys)
+    if num_to_delete >= len(destination_keys):
+        raise DeleteAllKeysError(
+                "ERROR - would delete all {} destination keys, "
+                "you probably didn't intend this! (use -f/--force or "
+                "force=True to override)".format(len(destination_keys)))
+
+
+def _delete_unused(source, source_key_map, destination, destination_keys,
+                   force=False, dry_run=False, continue_on_errors=False,
+                   show_destination=False, stats=None, rate_limiter=None,
+                   history=None):
+    """Delete keys in destination_keys that aren't in source_key_map from
+    destination (see delete() for details). Return Result namedtuple.
+    Delete timings are added to "stats" (a new Stats instance if None).
+    """
+    if stats is None:
+        stats = Stats()
+    source_keys = set(source_key_map.values())
 
     options = []
     if dry_run:
@@ -593,13 +3735,10 @@ def delete(source, destination, force=False, dry_run=False,
                 ', options: ' + ', '.join(options) if options else '')
 
     if not force:
-        num_to_delete = sum(1 for k in destination_keys if k not in source_keys)
-        if num_to_delete >= len(destination_keys):
-            raise DeleteAllKeysError(
-                    "ERROR - would delete all {} destination keys, "
-                    "you probably didn't intend this! (use -f/--force or "
-                    "force=True to override)".format(len(destination_keys)))
+        _check_delete_all(source_keys, destination_keys)
 
+    at_destination = ' at {}'.format(destination) if show_destination else ''
+    start_time = _timer()
     num_scanned = 0
     num_deleted = 0
     num_errors = 0
@@ -607,39 +3746,817 @@ def delete(source, destination, force=False, dry_run=False,
         num_scanned += 1
 
         if key in source_keys:
-            logger.debug('still using %s, skipping', key)
+            logger.debug('still using %s%s, skipping', key, at_destination)
             continue
 
         verb = 'would delete' if dry_run else 'deleting'
-        logger.warning('%s %s', verb, key)
+        logger.warning('%s %s%s', verb, key, at_destination)
         if not dry_run:
             try:
+                if rate_limiter is not None:
+                    rate_limiter.request(stats)
+                if _hooks:
+                    _call_hooks('delete_start', key)
+                delete_start = _timer()
                 destination.delete(key)
+                stats.add_operation('delete', key, _timer() - delete_start)
+                if _hooks:
+                    _call_hooks('delete_end', key)
                 num_deleted += 1
             except Exception as error:
+                if _hooks:
+                    _call_hooks('delete_error', key, error)
                 if not continue_on_errors:
-                    raise DestinationError('ERROR deleting {}'.format(key),
+                    raise DestinationError('ERROR deleting {}{}'.format(
+                                               key, at_destination),
                                            error, key=key)
-                logger.error('ERROR deleting %s: %s', key, error)
+                logger.error('ERROR deleting %s%s: %s',
+                             key, at_destination, error)
                 num_errors += 1
         else:
             num_deleted += 1
 
-    logger.info('finished delete: deleted %d, errors with %d',
-                num_deleted, num_errors)
+    stats.add_phase_time('delete', _timer() - start_time)
+    if dry_run:
+        _dry_run_estimate(stats).add_deletes(
+                num_deleted,
+                fit=history.get_fit(destination, 'delete') if history else None,
+                rate_limiter=rate_limiter)
+    elif history is not None:
+        history.record(destination, stats, 'delete')
+    logger.info('finished delete%s: deleted %d, errors with %d',
+                at_destination, num_deleted, num_errors)
 
     result = Result(source_key_map, destination_keys,
-                    num_scanned, num_deleted, num_errors)
+                    num_scanned, num_deleted, num_errors, 0, num_deleted,
+                    stats)
+    return result
+
+
+@_action_hooks('sync')
+def sync(source, destination, force=False, dry_run=False,
+         continue_on_errors=False, delete_delay=0, workers=1,
+         rate_limiter=None, history=None):
+    """Upload missing files from source to destination, and then delete
+    files from destination that are no longer present in source tree. This
+    is like calling upload() and then delete(), but the source key map is
+    only built once and the destination keys are only listed once. Return a
+    single Result namedtuple with the counts for both phases (num_uploaded
+    and num_deleted give the counts for each phase).
+
+    If "delete_delay" is nonzero, wait that many seconds between uploading
+    and deleting (not when dry_run is True), for example to let caches
+    that reference old keys drain.
+
+    The "source", "destination", "dry_run", "continue_on_errors",
+    "workers", "rate_limiter", and "history" arguments are as per upload()
+    and delete(). If "destination"
+    is a list or tuple, a list of Result namedtuples is returned, one per
+    destination. If force is True, upload even if files are there already,
+    and delete even if it would delete all the keys that were at the
+    destination. The DeleteAllKeysError check is done before anything is
+    uploaded.
+    """
+    source, source_key_map, destination, stats = _prepare(
+            source, destination, allow_shard=False)
+    options = dict(force=force, dry_run=dry_run,
+                   continue_on_errors=continue_on_errors, workers=workers,
+                   rate_limiter=rate_limiter, history=history)
+
+    if not isinstance(destination, list):
+        destination_keys = _list_keys(destination, stats=stats)
+        _trim_content_cache(source, source_key_map, [destination_keys], force)
+        return _sync_one(source, source_key_map, destination, destination_keys,
+                         delete_delay=delete_delay, stats=stats, **options)
+
+    destinations = destination
+    all_stats = [stats.copy() for _ in destinations]
+    all_destination_keys = _map_threads(
+            _list_keys, [(d, None, st)
+                         for d, st in zip(destinations, all_stats)])
+    if not force:
+        for destination_keys in all_destination_keys:
+            if destination_keys:
+                _check_delete_all(set(source_key_map.values()),
+                                  destination_keys)
+    _trim_content_cache(source, source_key_map, all_destination_keys, force)
+    shared_source = _share_source(source, source_key_map,
+                                  all_destination_keys, force)
+
+    def sync_to(destination, destination_keys, stats):
+        return _sync_one(shared_source, source_key_map, destination,
+                         destination_keys, delete_delay=delete_delay,
+                         show_destination=True, stats=stats, **options)
+
+    return _map_threads(sync_to, list(zip(destinations, all_destination_keys,
+                                          all_stats)))
+
+
+def _sync_one(source, source_key_map, destination, destination_keys,
+              force=False, dry_run=False, continue_on_errors=False,
+              delete_delay=0, show_destination=False, stats=None, workers=1,
+              rate_limiter=None, history=None):
+    """Upload missing files to and then delete unused files from a single
+    destination (see sync() for details). Return Result namedtuple.
+    """
+    if stats is None:
+        stats = Stats()
+    options = dict(force=force, dry_run=dry_run,
+                   continue_on_errors=continue_on_errors,
+                   show_destination=show_destination, stats=stats,
+                   rate_limiter=rate_limiter, history=history)
+
+    # Check before uploading so a bad source doesn't upload and then fail
+    if destination_keys and not force:
+        _check_delete_all(set(source_key_map.values()), destination_keys)
+
+    upload_result = _upload_missing(source, source_key_map, destination,
+                                    destination_keys, workers=workers,
+                                    **options)
+
+    if delete_delay and not dry_run and destination_keys:
+        logger.info('waiting %s seconds before deleting', delete_delay)
+        time.sleep(delete_delay)
+
+    if destination_keys:
+        # Force needed because delete-all check was done above (and all
+        # destination keys being unused is fine if there's new uploads)
+        options['force'] = True
+        delete_result = _delete_unused(source, source_key_map, destination,
+                                       destination_keys, **options)
+        num_scanned = delete_result.num_scanned
+        num_deleted = delete_result.num_deleted
+        num_errors = delete_result.num_errors
+    else:
+        num_scanned = num_deleted = num_errors = 0
+
+    result = Result(source_key_map, destination_keys,
+                    upload_result.num_scanned + num_scanned,
+                    upload_result.num_uploaded + num_deleted,
+                    upload_result.num_errors + num_errors,
+                    upload_result.num_uploaded, num_deleted, stats)
+    return result
+
+
+@_action_hooks('plan')
+def write_plan(source, destination, plan_path, force=False):
+    """Work out what upload() and delete() would do (as if dry_run were
+    True), and write it to a plan file at "plan_path" which apply_plan() can
+    execute later without scanning the source again, for example on a
+    different machine. Return a Result namedtuple with num_uploaded and
+    num_deleted set to the number of keys the plan would upload and delete.
+
+    The plan file is written in JSON Lines format (one JSON object per
+    line): a header, then one line per source file with its path, key, size,
+    and modification time (and "upload": true if it needs uploading), then
+    one line per unused destination key to delete, and finally a footer with
+    the counts (so that apply_plan() can detect a truncated plan). The file
+    is written atomically, so a reader never sees a partially-written plan.
+
+    The "source", "destination", and "force" arguments are as per upload().
+    If the source is sharded, no deletes are included in the plan.
+    """
+    import json
+
+    if isinstance(destination, (list, tuple)):
+        raise TypeError('write_plan() only supports a single destination')
+    source, source_key_map, destination, stats = _prepare(source, destination)
+    source_keys = set(source_key_map.values())
+    sharded = bool(getattr(source, 'shard', None))
+    destination_keys = _list_keys(destination,
+                                  only_keys=source_keys if sharded else None,
+                                  stats=stats)
+    logger.info('writing plan for %s (%d files) to %s (%d existing keys) '
+                'to %s', source, len(source_key_map), destination,
+                len(destination_keys), plan_path)
+
+    stat_file = getattr(source, 'stat_file', None)
+    num_upload = 0
+    num_delete = 0
+    with _atomic_path(plan_path) as temp_path, open(temp_path, 'w') as f:
+        def write_line(obj):
+            f.write(json.dumps(obj, sort_keys=True, separators=(',', ':')))
+            f.write('\n')
+
+        write_line({
+            'cdnupload_plan': PLAN_VERSION,
+            'source': str(source),
+            'destination': str(destination),
+            'num_destination_keys': len(destination_keys),
+            'hash_algorithm': getattr(source, 'hash_id', None),
+        })
+
+        for rel_path, key in sorted(source_key_map.items()):
+            entry = {'path': rel_path, 'key': key}
+            if stat_file is not None:
+                try:
+                    st = stat_file(rel_path)
+                except Exception as error:
+                    raise SourceError('ERROR getting size of {}'.format(
+                                          rel_path), error)
+                entry['size'] = st.st_size
+                entry['mtime'] = st.st_mtime
+            if force or key not in destination_keys:
+                logger.warning('would upload %s to %s', rel_path, key)
+                entry['upload'] = True
+                num_upload += 1
+            write_line(entry)
+
+        for key in sorted(destination_keys):
+            if key not in source_keys:
+                logger.warning('would delete %s', key)
+                write_line({'delete': key})
+                num_delete += 1
+
+        write_line({
+            'end': True,
+            'num_files': len(source_key_map),
+            'num_upload': num_upload,
+            'num_delete': num_delete,
+        })
+
+    result = Result(source_key_map, destination_keys,
+                    len(source_key_map) + len(destination_keys),
+                    num_upload + num_delete, 0, num_upload, num_delete, stats)
+    return result
+
+
+def read_plan(plan_path):
+    """Read plan file written by write_plan() and return tuple of (header,
+    entries, delete_keys), where entries is a list of dicts with "path",
+    "key", and optionally "size", "mtime", and "upload" fields. Raise
+    PlanError if the plan is invalid or incomplete.
+    """
+    import json
+
+    header = None
+    footer = None
+    entries = []
+    delete_keys = []
+    with open(plan_path) as f:
+        for line_num, line in enumerate(f, start=1):
+            try:
+                obj = json.loads(line)
+            except ValueError as error:
+                raise PlanError('invalid JSON on line {} of plan {}: {}'.format(
+                                line_num, plan_path, error))
+            if not isinstance(obj, dict):
+                raise PlanError('line {} of plan {} is not an object'.format(
+                                line_num, plan_path))
+            if header is None:
+                if obj.get('cdnupload_plan') != PLAN_VERSION:
+                    raise PlanError('{} is not a version {} plan file'.format(
+                                    plan_path, PLAN_VERSION))
+                header = obj
+            elif footer is not None:
+                raise PlanError('unexpected data after end of plan {}'.format(
+                                plan_path))
+            elif 'path' in obj:
+                entries.append(obj)
+            elif 'delete' in obj:
+                delete_keys.append(obj['delete'])
+            elif obj.get('end'):
+                footer = obj
+            else:
+                raise PlanError('unexpected line {} in plan {}'.format(
+                                line_num, plan_path))
+
+    if (footer is None or footer['num_files'] != len(entries) or
+            footer['num_delete'] != len(delete_keys)):
+        raise PlanError('plan {} is incomplete'.format(plan_path))
+    return (header, entries, delete_keys)
+
+
+@_action_hooks('apply')
+def apply_plan(source, destination, plan_path, force=False, dry_run=False,
+               continue_on_errors=False, delete=False, verify=False,
+               delete_delay=0, workers=1, rate_limiter=None):
+    """Execute plan written by write_plan(): upload the files the plan says
+    are missing from the destination, and if "delete" is True, then delete
+    the unused keys listed in the plan (waiting "delete_delay" seconds in
+    between, as per sync()). Neither the source tree nor the destination is
+    scanned. Return a Result namedtuple (destination_keys is the set of
+    existing destination keys that the plan refers to).
+
+    If verify is True, check that the size and modification time of each
+    source file to be uploaded still match the plan, and raise PlanError
+    before uploading anything if they don't.
+
+    The delete-all sanity check uses the number of destination keys recorded
+    in the plan; use force=True to override it. The "source", "destination",
+    "dry_run", "continue_on_errors", "workers", and "rate_limiter" arguments
+    are as per upload().
+    """
+    if isinstance(source, (str, bytes)):
+        source = FileSource(source)
+    if isinstance(destination, (str, bytes)):
+        destination = FileDestination(destination)
+
+    header, entries, delete_keys = read_plan(plan_path)
+    source_key_map = {e['path']: e['key'] for e in entries}
+    existing_keys = set(e['key'] for e in entries if not e.get('upload'))
+    logger.info('applying plan %s (made for %s to %s) from %s to %s',
+                plan_path, header['source'], header['destination'],
+                source, destination)
+
+    if verify:
+        plan_hash = header.get('hash_algorithm')
+        source_hash = getattr(source, 'hash_id', None)
+        if plan_hash and source_hash and plan_hash != source_hash:
+            raise PlanError('plan was made with hash algorithm {}, but source '
+                            'uses {}'.format(plan_hash, source_hash))
+        for entry in entries:
+            if not entry.get('upload') or 'size' not in entry:
+                continue
+            try:
+                st = source.stat_file(entry['path'])
+            except Exception as error:
+                raise SourceError('ERROR verifying {}'.format(entry['path']),
+                                  error)
+            if st.st_size != entry['size'] or st.st_mtime != entry['mtime']:
+                raise PlanError('{} has changed since plan was written'.format(
+                                entry['path']))
+
+    if (delete and delete_keys and not force and
+            len(delete_keys) >= header['num_destination_keys']):
+        raise DeleteAllKeysError(
+                "ERROR - would delete all {} destination keys, "
+                "you probably didn't intend this! (use -f/--force or "
+                "force=True to override)".format(len(delete_keys)))
+
+    stats = Stats()
+    upload_result = _upload_missing(source, source_key_map, destination,
+                                    existing_keys, dry_run=dry_run,
+                                    continue_on_errors=continue_on_errors,
+                                    stats=stats, workers=workers,
+                                    rate_limiter=rate_limiter)
+    num_scanned = upload_result.num_scanned
+    num_deleted = 0
+    num_errors = upload_result.num_errors
+
+    if delete and delete_keys:
+        if delete_delay and not dry_run:
+            logger.info('waiting %s seconds before deleting', delete_delay)
+            time.sleep(delete_delay)
+        delete_result = _delete_unused(source, source_key_map, destination,
+                                       set(delete_keys), force=True,
+                                       dry_run=dry_run,
+                                       continue_on_errors=continue_on_errors,
+                                       stats=stats, rate_limiter=rate_limiter)
+        num_scanned += delete_result.num_scanned
+        num_deleted = delete_result.num_deleted
+        num_errors += delete_result.num_errors
+
+    result = Result(source_key_map, existing_keys | set(delete_keys),
+                    num_scanned, upload_result.num_uploaded + num_deleted,
+                    num_errors, upload_result.num_uploaded, num_deleted, stats)
     return result
 
 
-def main(args=None):
+def merge_key_maps(shard_key_maps):
+    """Merge partial key maps from a sharded run into a full key map, and
+    return the full key map dict. "shard_key_maps" is a list of dicts in the
+    format written by the command line tool's --key-map option when --shard
+    is specified: {"cdnupload_shard": [index, count], "key_map": {...},
+    "hash_algorithm": name}.
+
+    Raise KeyMapError if any shard is missing or duplicated, or if the
+    shards have a different number of shards or were hashed with different
+    hash algorithms.
+    """
+    counts = set()
+    hash_algorithms = set()
+    indexes = []
+    key_map = {}
+    for shard_key_map in shard_key_maps:
+        try:
+            index, count = shard_key_map['cdnupload_shard']
+            partial = shard_key_map['key_map']
+        except (KeyError, TypeError, ValueError):
+            raise KeyMapError('not a partial key map from a sharded run')
+        counts.add(count)
+        indexes.append(index)
+        key_map.update(partial)
+        if shard_key_map.get('hash_algorithm'):
+            hash_algorithms.add(shard_key_map['hash_algorithm'])
+
+    if len(hash_algorithms) > 1:
+        raise KeyMapError('partial key maps have different hash algorithms: '
+                          '{}'.format(', '.join(sorted(hash_algorithms))))
+
+    if len(counts) != 1:
+        raise KeyMapError('partial key maps have different shard counts: '
+                          '{}'.format(', '.join(str(c) for c in sorted(counts))))
+    count = counts.pop()
+    if sorted(indexes) != list(range(1, count + 1)):
+        missing = sorted(set(range(1, count + 1)) - set(indexes))
+        raise KeyMapError('expected shards 1 to {}, got {}{}'.format(
+                count, ', '.join(str(i) for i in sorted(indexes)),
+                ' (missing {})'.format(', '.join(str(i) for i in missing))
+                if missing else ''))
+    return key_map
+
+
+def write_key_map(key_map, path, format='json', metadata=None):
+    """Write key map (dict of relative path to destination key) to file at
+    given path in given format:
+
+    * json: a JSON object, sorted by path (written atomically)
+    * index: a binary index that can be memory-mapped and searched by the
+      KeyMap class without loading the whole key map (written atomically)
+    * sqlite: an SQLite database with a key_map table of (path, key) rows,
+      for lookups from other languages (written atomically)
+
+    If "metadata" is given, it's a dict of extra information like the hash
+    algorithm, stored in a metadata table of (name, value) rows in the
+    sqlite format (the other formats only store the mapping itself, so web
+    servers can use them directly).
+
+    The index format is the 8-byte magic string KEY_MAP_INDEX_MAGIC, the
+    number of entries N, N offsets (from the start of the file) of each
+    entry, and then the N entries in order of UTF-8 encoded path. Each entry
+    is the path length, the UTF-8 path, the key length, and the UTF-8 key.
+    All numbers are unsigned 32-bit little-endian integers.
+    """
+    if format == 'json':
+        _write_key_map_json(key_map, path)
+    elif format == 'index':
+        _write_key_map_index(key_map, path)
+    elif format == 'sqlite':
+        _write_key_map_sqlite(key_map, path, metadata=metadata)
+    else:
+        raise ValueError('key map format must be one of {}, not {!r}'.format(
+                ', '.join(KEY_MAP_FORMATS), format))
+
+
+def read_key_map(path):
+    """Read key map file written by write_key_map() in any format (the
+    format is detected from the file's contents) and return it as a dict.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(16)
+    if header.startswith(KEY_MAP_INDEX_MAGIC):
+        return dict(KeyMap(path, reload_interval=None).items())
+    if header.startswith(b'SQLite format 3\x00'):
+        import sqlite3
+        connection = sqlite3.connect(path)
+        try:
+            return dict(connection.execute('SELECT path, key FROM key_map'))
+        finally:
+            connection.close()
+
+    import json
+    with open(path) as f:
+        return json.load(f)
+
+
+def diff_key_maps(old_key_map, new_key_map):
+    """Compare two key maps and return a dict with "added" and "changed"
+    (dicts of path to new key) and "removed" (sorted list of paths), so that
+    a reader of the old key map can apply just the changes.
+    """
+    added = {}
+    changed = {}
+    for rel_path, key in new_key_map.items():
+        old_key = old_key_map.get(rel_path)
+        if old_key is None:
+            added[rel_path] = key
+        elif old_key != key:
+            changed[rel_path] = key
+    removed = sorted(p for p in old_key_map if p not in new_key_map)
+    return collections.OrderedDict([
+        ('added', added),
+        ('changed', changed),
+        ('removed', removed),
+    ])
+
+
+def split_key_map(key_map, sections=None):
+    """Split key map into smaller key maps by section, and return an
+    OrderedDict mapping section name to key map (sorted by name), so that a
+    client only needs to load the sections it uses.
+
+    "sections" is an optional list of (name, pattern) tuples: a path that
+    matches pattern (per fnmatch) is in that named section, with the first
+    match winning. Other paths are in a section named after their top-level
+    directory, or "_root" for files in the root directory.
+    """
+    import fnmatch
+
+    split = {}
+    for rel_path, key in key_map.items():
+        for name, pattern in sections or []:
+            if fnmatch.fnmatch(rel_path, pattern):
+                break
+        else:
+            name = rel_path.partition('/')[0] if '/' in rel_path else '_root'
+        split.setdefault(name, {})[rel_path] = key
+    return collections.OrderedDict(sorted(split.items()))
+
+
+def _entry_points(key_map, entry_points, extensions=None):
+    """Return sorted list of paths in key map that match one of the
+    entry_points patterns, or that have one of the given extensions if
+    entry_points is empty.
+    """
+    import fnmatch
+
+    if entry_points:
+        return sorted(p for p in key_map
+                      if any(fnmatch.fnmatch(p, e) for e in entry_points))
+    return sorted(p for p in key_map
+                  if os.path.splitext(p)[1].lower() in (extensions or ()))
+
+
+def make_import_map(key_map, entry_points=None, url_prefix=''):
+    """Return a JavaScript import map (a dict in the format of a
+    <script type="importmap"> element) that maps the URL of each entry point
+    to the URL of its key. "entry_points" is a list of patterns (per
+    fnmatch) of paths to include; the default is all .js and .mjs files. URLs
+    are url_prefix plus the path or key.
+    """
+    imports = collections.OrderedDict()
+    for rel_path in _entry_points(key_map, entry_points, ('.js', '.mjs')):
+        imports[url_prefix + rel_path] = url_prefix + key_map[rel_path]
+    return {'imports': imports}
+
+
+def make_preload_links(key_map, entry_points, url_prefix=''):
+    """Return HTML with a <link rel="preload"> element (one per line) for
+    each path in key map that matches one of the entry_points patterns (per
+    fnmatch), pointing to url_prefix plus its key. JavaScript modules
+    (.mjs) use rel="modulepreload" instead, and the "as" attribute is
+    chosen by extension.
+    """
+    lines = []
+    for rel_path in _entry_points(key_map, entry_points):
+        ext = os.path.splitext(rel_path)[1].lower()
+        href = (url_prefix + key_map[rel_path]).replace('&', '&amp;')
+        href = href.replace('"', '&quot;')
+        if ext == '.mjs':
+            lines.append('<link rel="modulepreload" href="{}">'.format(href))
+            continue
+        preload_as = PRELOAD_AS.get(ext, 'fetch')
+        crossorigin = (' crossorigin' if preload_as in ('font', 'fetch')
+                       else '')
+        lines.append('<link rel="preload" href="{}" as="{}"{}>'.format(
+                href, preload_as, crossorigin))
+    return ''.join(line + '\n' for line in lines)
+
+
+def _write_key_map_json(key_map, path):
+    # Write one entry at a time (in the same format as json.dump with
+    # sort_keys=True and indent=4) rather than encoding the whole document
+    # in memory first
+    import json
+    encode = json.JSONEncoder().encode
+    with _atomic_path(path) as temp_path:
+        with open(temp_path, 'w') as f:
+            separator = '{\n'
+            for rel_path in sorted(key_map):
+                f.write('{}    {}: {}'.format(separator, encode(rel_path),
+                                              encode(key_map[rel_path])))
+                separator = ',\n'
+            f.write('\n}' if key_map else '{}')
+
+
+def _to_utf8(value):
+    return value if isinstance(value, bytes) else value.encode('utf-8')
+
+
+def _write_key_map_index(key_map, path):
+    entries = sorted((_to_utf8(p), _to_utf8(k)) for p, k in key_map.items())
+    header_size = len(KEY_MAP_INDEX_MAGIC) + 4 + 4 * len(entries)
+    offsets = []
+    offset = header_size
+    for path_bytes, key_bytes in entries:
+        offsets.append(offset)
+        offset += 8 + len(path_bytes) + len(key_bytes)
+    if offset > 0xffffffff:
+        raise ValueError('key map too large for index format')
+
+    with _atomic_path(path) as temp_path:
+        with open(temp_path, 'wb') as f:
+            f.write(KEY_MAP_INDEX_MAGIC)
+            f.write(struct.pack('<I', len(entries)))
+            f.write(struct.pack('<{}I'.format(len(offsets)), *offsets))
+            for path_bytes, key_bytes in entries:
+                f.write(struct.pack('<I', len(path_bytes)))
+                f.write(path_bytes)
+                f.write(struct.pack('<I', len(key_bytes)))
+                f.write(key_bytes)
+
+
+def _write_key_map_sqlite(key_map, path, metadata=None):
+    import sqlite3
+
+    def to_text(value):
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    with _atomic_path(path) as temp_path:
+        connection = sqlite3.connect(temp_path)
+        try:
+            connection.execute('CREATE TABLE key_map (path TEXT PRIMARY KEY, '
+                               'key TEXT NOT NULL) WITHOUT ROWID')
+            connection.executemany(
+                'INSERT INTO key_map (path, key) VALUES (?, ?)',
+                sorted((to_text(p), to_text(k)) for p, k in key_map.items()))
+            connection.execute('CREATE TABLE metadata (name TEXT PRIMARY KEY, '
+                               'value TEXT) WITHOUT ROWID')
+            connection.executemany(
+                'INSERT INTO metadata (name, value) VALUES (?, ?)',
+                sorted((metadata or {}).items()))
+            connection.commit()
+        finally:
+            connection.close()
+
+
+class KeyMap(object):
+    """Read-only key map backed by an index file written by write_key_map()
+    with format='index', for looking up destination keys in a web server.
+
+    The index is memory-mapped and binary searched, so lookups are O(log n)
+    without loading the key map into a dict, and the pages are shared by all
+    processes that map the same file. Supports the read-only mapping
+    interface: km[path], km.get(path), path in km, len(km), and iteration
+    over paths (in sorted order), keys(), and items().
+
+    If "reload_interval" is not None, lookups check whether the file has
+    been replaced at most every "reload_interval" seconds, and map the new
+    file if so (call reload() to check immediately). Because write_key_map()
+    replaces the file atomically, readers never see a partial index.
+    """
+
+    def __init__(self, path, reload_interval=1.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._index = None
+        self._last_check = _timer()
+        self.reload()
+
+    def __repr__(self):
+        return 'KeyMap({!r})'.format(self.path)
+
+    def reload(self):
+        """Map the index file again if it has changed. Return True if it was
+        (re)loaded, False if it hasn't changed.
+        """
+        import mmap
+
+        with self._lock:
+            self._last_check = _timer()
+            st = os.stat(self.path)
+            file_id = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+            if self._index is not None and self._index[0] == file_id:
+                return False
+
+            magic_size = len(KEY_MAP_INDEX_MAGIC)
+            with open(self.path, 'rb') as f:
+                # mmap can't map an empty file (as seen mid-copy, say)
+                if os.fstat(f.fileno()).st_size < magic_size + 4:
+                    raise KeyMapError('{} is not a key map index file'.format(
+                            self.path))
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if data[:magic_size] != KEY_MAP_INDEX_MAGIC:
+                data.close()
+                raise KeyMapError('{} is not a key map index file'.format(
+                        self.path))
+            count = _UINT32.unpack_from(data, magic_size)[0]
+            # Swap in a single tuple so concurrent lookups see a consistent
+            # index (the old mapping is closed when no longer referenced)
+            self._index = (file_id, data, count)
+            return True
+
+    def _get_index(self):
+        if (self.reload_interval is not None and
+                _timer() - self._last_check >= self.reload_interval):
+            self.reload()
+        return self._index
+
+    @staticmethod
+    def _entry(data, i):
+        offset = _UINT32.unpack_from(data, len(KEY_MAP_INDEX_MAGIC) + 4 + 4 * i)[0]
+        path_len = _UINT32.unpack_from(data, offset)[0]
+        path_end = offset + 4 + path_len
+        return path_end, data[offset + 4:path_end]
+
+    def _find(self, path):
+        _, data, count = self._get_index()
+        path_bytes = _to_utf8(path)
+        low, high = 0, count
+        while low < high:
+            mid = (low + high) // 2
+            path_end, mid_path = self._entry(data, mid)
+            if mid_path < path_bytes:
+                low = mid + 1
+            elif mid_path > path_bytes:
+                high = mid
+            else:
+                key_len = _UINT32.unpack_from(data, path_end)[0]
+                key_start = path_end + 4
+                return data[key_start:key_start + key_len].decode('utf-8')
+        return None
+
+    def get(self, path, default=None):
+        """Return destination key for given relative path, or default."""
+        key = self._find(path)
+        return default if key is None else key
+
+    def __getitem__(self, path):
+        key = self._find(path)
+        if key is None:
+            raise KeyError(path)
+        return key
+
+    def __contains__(self, path):
+        return self._find(path) is not None
+
+    def __len__(self):
+        return self._get_index()[2]
+
+    def items(self):
+        """Generate (path, key) tuples in sorted path order."""
+        _, data, count = self._get_index()
+        for i in range(count):
+            path_end, path_bytes = self._entry(data, i)
+            key_len = _UINT32.unpack_from(data, path_end)[0]
+            key_start = path_end + 4
+            yield (path_bytes.decode('utf-8'),
+                   data[key_start:key_start + key_len].decode('utf-8'))
+
+    def __iter__(self):
+        for path, _ in self.items():
+            yield path
+
+
+def _parse_shard(value):
+    """Parse "I/N" shard command line argument into (I, N) tuple."""
+    import argparse
+    import re
+
+    match = re.match(r'(\d+)/(\d+)$', value)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError(
+                'shard must be in I/N format with I from 1 to N, for example '
+                '2/4, not {!r}'.format(value))
+    return (int(match.group(1)), int(match.group(2)))
+
+
+def _parse_section(value):
+    """Parse "NAME=PATTERN" key map section command line argument into
+    (name, pattern) tuple.
+    """
+    import argparse
+
+    name, sep, pattern = value.partition('=')
+    if not sep or not name or not pattern or '/' in name:
+        raise argparse.ArgumentTypeError(
+                'section must be in NAME=PATTERN format, for example '
+                'icons=images/icons/*, not {!r}'.format(value))
+    return (name, pattern)
+
+
+def get_destination_class(destination):
+    """Return the Destination subclass to use for given destination "URL":
+    S3Destination for s3:// URLs, HTTPDestination for http:// and https://
+    URLs, the Destination class in the cdnupload_scheme module for other
+    scheme:// URLs, or FileDestination for plain paths. Raise ValueError if
+    the handler module can't be imported.
+    """
+    import re
+
+    match = re.match(r'(\w+):', destination)
+    if not match:
+        return FileDestination
+
+    scheme = match.group(1)
+    if scheme == 's3':
+        return S3Destination
+    if scheme in ('http', 'https'):
+        return HTTPDestination
+    module_name = 'cdnupload_' + scheme
+    try:
+        module = __import__(module_name)
+    except ImportError as error:
+        raise ValueError("can't import handler for scheme {!r}: {}".format(
+                scheme, error))
+    if not hasattr(module, 'Destination'):
+        raise ValueError('{} module has no Destination class'.format(
+                module_name))
+    return getattr(module, 'Destination')
+
+
+def main(args=None, _daemon=None):
     """Command line endpoint for uploading/deleting. If args not specified,
     the sys.argv command line arguments are used. Run "cdnupload.py -h" for
     detailed help on the arguments.
     """
+    import argparse
+
     if args is None:
         args = sys.argv[1:]
+    arg_list = list(args)
 
     description = """
 cdnupload {version} -- (c) Ben Hoyt 2017 -- github.com/benhoyt/cdnupload
@@ -652,19 +4569,33 @@ Amazon S3 bucket, with content-based hash in filenames for versioning.
         description=description,
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
-
-    parser.add_argument('source',
+    if _daemon is not None:
+        # Send usage errors back to the client rather than printing them to
+        # the daemon's stderr
+        def daemon_error(message):
+            raise _RequestExit(2, '{}{}: error: {}\n'.format(
+                    parser.format_usage(), parser.prog, message))
+        parser.error = daemon_error
+
+    parser.add_argument('source', nargs='?',
                         help='source directory')
-    parser.add_argument('destination',
+    parser.add_argument('destination', nargs='?',
                         help='destination directory (or s3://bucket/path)')
     parser.add_argument('dest_args', nargs='*', default=[],
                         help='optional Destination() keyword args, for example: '
                              '"max-age=3600"')
 
     parser.add_argument('-a', '--action', default='upload',
-                        choices=['upload', 'delete', 'dest-help'],
-                        help='action to perform (upload, delete, or show help '
-                             'for given Destination class), default %(default)s')
+                        choices=['upload', 'delete', 'sync', 'plan', 'apply',
+                                 'key-map', 'merge-key-maps', 'serve',
+                                 'dest-help'],
+                        help='action to perform (upload, delete, sync to '
+                             'upload and then delete, write a plan or apply '
+                             'a plan written earlier, only write --key-map, '
+                             'merge partial key maps given as positional '
+                             'args into --key-map, serve requests on '
+                             '--daemon-socket, or show help for given '
+                             'Destination class), default %(default)s')
     parser.add_argument('-d', '--dry-run', action='store_true',
                         help='show what script would upload or delete instead of '
                              'actually doing it')
@@ -686,16 +4617,71 @@ Amazon S3 bucket, with content-based hash in filenames for versioning.
     parser.add_argument('-l', '--log-level', default='default',
                         choices=[k for k, v in LOG_LEVELS],
                         help='set logging level')
+    parser.add_argument('-p', '--plan', metavar='FILENAME',
+                        help='plan file to write (with --action=plan) or to '
+                             'execute (with --action=apply)')
     parser.add_argument('-v', '--version', action='version', version=__version__)
 
     less_common = parser.add_argument_group('less commonly-used arguments')
+    less_common.add_argument('--cache-text-by-extension', action='store_true',
+                             help='only check whether the first file with '
+                                  'each extension is text, and assume others '
+                                  'with that extension are the same')
+    less_common.add_argument('--check-existing', action='store_true',
+                             help='with --action=upload, check whether each '
+                                  'source key exists at the destination '
+                                  'instead of listing all its keys (file '
+                                  'destinations only)')
+    less_common.add_argument('--content-cache-size', default=0, type=int,
+                             metavar='BYTES',
+                             help='keep up to this many bytes of small source '
+                                  'files in memory after hashing so uploads '
+                                  "don't read them again (default 0, disabled)")
     less_common.add_argument('--continue-on-errors', action='store_true',
                              help='continue after upload or delete errors')
+    less_common.add_argument('--daemon-socket', metavar='FILENAME',
+                             help='with --action=serve, listen for requests '
+                                  'on this Unix socket; with upload, delete, '
+                                  'sync, or key-map, send the request to the '
+                                  'daemon listening on it, if any (otherwise '
+                                  'run it here)')
+    less_common.add_argument('--delete-delay', default=0, type=float,
+                             metavar='SECONDS',
+                             help='with --action=sync, wait this long between '
+                                  'uploading and deleting (default %(default)s)')
     less_common.add_argument('--dot-names', action='store_true',
                              help="include source files and directories starting "
                                   "with '.'")
+    less_common.add_argument('--entry-point', action='append',
+                             metavar='PATTERN',
+                             help='include source files matching this '
+                                  'pattern in --import-map (default all .js '
+                                  'and .mjs files) and --preload (may be '
+                                  'specified multiple times)')
+    less_common.add_argument('--extra-destination', action='append',
+                             metavar='DESTINATION',
+                             help='also upload to or delete from this '
+                                  'destination, concurrently and without '
+                                  'rescanning the source (may be specified '
+                                  'multiple times; dest_args are only passed '
+                                  'to destinations of the same type as the '
+                                  'main one)')
+    less_common.add_argument('--fingerprint-cache', metavar='FILENAME',
+                             help='store a fingerprint of each source '
+                                  'directory in given file, and only hash '
+                                  'files in directories that have changed '
+                                  'since the last run')
     less_common.add_argument('--follow-symlinks', action='store_true',
                              help='follow symbolic links when walking source tree')
+    less_common.add_argument('--full-rescan', action='store_true',
+                             help='ignore the --fingerprint-cache file and '
+                                  'hash all source files (the cache is still '
+                                  'updated)')
+    less_common.add_argument('--hash-algorithm', default='sha1',
+                             choices=list(HASH_ALGORITHMS),
+                             help='hash algorithm for destination keys '
+                                  '(xxh3_128 and blake3 require the xxhash '
+                                  'and blake3 packages; default %(default)s)')
     less_common.add_argument('--hash-length', default=DEFAULT_HASH_LENGTH,
                              type=int, metavar='N',
                              help='number of hex chars of hash to use for '
@@ -703,33 +4689,200 @@ Amazon S3 bucket, with content-based hash in filenames for versioning.
     less_common.add_argument('--ignore-walk-errors', action='store_true',
                              help='ignore errors when walking source tree, '
                                   'except for error on root directory')
+    less_common.add_argument('--import-map', metavar='FILENAME',
+                             help='write a JavaScript import map of the '
+                                  '--entry-point files to given file (after '
+                                  'successful upload or delete)')
+    less_common.add_argument('--key-map-diff', metavar='FILENAME',
+                             help='compare the new key map with the previous '
+                                  '--key-map file and write the added, '
+                                  'changed, and removed entries to given file '
+                                  'as JSON')
+    less_common.add_argument('--key-map-format', default='json',
+                             choices=KEY_MAP_FORMATS,
+                             help='format of --key-map file: JSON, binary '
+                                  'index for the KeyMap class, or SQLite '
+                                  '(default %(default)s)')
+    less_common.add_argument('--key-map-section', action='append',
+                             type=_parse_section, metavar='NAME=PATTERN',
+                             help='with --key-map-shards, put paths matching '
+                                  'PATTERN in the shard named NAME instead '
+                                  'of grouping them by top-level directory '
+                                  '(may be specified multiple times)')
+    less_common.add_argument('--key-map-shards', metavar='FILENAME',
+                             help='split the key map into a JSON shard per '
+                                  'top-level directory (or --key-map-section), '
+                                  'upload the shards under key-map/ with '
+                                  'hashed keys like other files, and write '
+                                  'an index of the shard keys to given file')
+    less_common.add_argument('--max-bandwidth', type=int, metavar='BYTES',
+                             help='limit total upload bandwidth to this many '
+                                  'bytes per second, across all workers and '
+                                  'destinations (default no limit)')
+    less_common.add_argument('--max-requests-per-second', type=float,
+                             metavar='N',
+                             help='limit total uploads plus deletes to this '
+                                  'many per second, across all workers and '
+                                  'destinations (default no limit)')
+    less_common.add_argument('--plan-delete', action='store_true',
+                             help='with --action=apply, also delete unused '
+                                  'keys listed in the plan')
+    less_common.add_argument('--plan-verify', action='store_true',
+                             help='with --action=apply, check that source '
+                                  'file sizes and modification times still '
+                                  'match the plan before uploading')
+    less_common.add_argument('--preload', metavar='FILENAME',
+                             help='write <link rel="preload"> elements for '
+                                  'the --entry-point files to given file '
+                                  '(after successful upload or delete)')
+    less_common.add_argument('--profile', metavar='FILENAME',
+                             help='profile the action with cProfile and write '
+                                  'the stats to given file')
+    less_common.add_argument('--relist-interval', default=300, type=float,
+                             metavar='SECONDS',
+                             help='with --action=serve, list each destination '
+                                  'again if its keys were last listed this '
+                                  'long ago (default %(default)s)')
+    less_common.add_argument('--rewrite-css', action='store_true',
+                             help='rewrite relative url() and @import '
+                                  'references in CSS files to the hashed '
+                                  'keys of the files they refer to')
+    less_common.add_argument('--rewrite-html', action='store_true',
+                             help='rewrite relative src and href references '
+                                  'in HTML files to the hashed keys of the '
+                                  'files they refer to')
+    less_common.add_argument('--shard', type=_parse_shard, metavar='I/N',
+                             help='only hash and upload source files in shard '
+                                  'I of N (from 1 to N), and write a partial '
+                                  'key map (combine them with '
+                                  '--action=merge-key-maps)')
+    less_common.add_argument('--stats-json', metavar='FILENAME',
+                             help='write timing and throughput statistics '
+                                  '(per phase and per operation) to given file '
+                                  'as JSON')
+    less_common.add_argument('--stats-prometheus', metavar='FILENAME',
+                             help='write statistics to given file in '
+                                  'Prometheus text format, for the node '
+                                  'exporter textfile collector')
+    less_common.add_argument('--throughput-history', metavar='FILENAME',
+                             help='record upload and delete timings for each '
+                                  'destination in given JSON file, and use '
+                                  'them to estimate the time a --dry-run '
+                                  'would take')
+    less_common.add_argument('--trace', metavar='FILENAME',
+                             help='write a timeline of walk, hash, list, '
+                                  'upload, and delete events to given file in '
+                                  'Chrome trace event JSON format')
+    less_common.add_argument('--trace-memory', action='store_true',
+                             help='trace memory allocations and log the peak '
+                                  'memory used by the action')
+    less_common.add_argument('--tree-hash-chunk-size', default=0, type=int,
+                             metavar='BYTES',
+                             help='hash files larger than this as a tree of '
+                                  'chunks of this size, in parallel (default '
+                                  '0, off)')
+    less_common.add_argument('--url-prefix', default='', metavar='URL',
+                             help='prefix for URLs in --import-map and '
+                                  '--preload, for example '
+                                  'https://cdn.example.com/static/ (default '
+                                  'none)')
+    less_common.add_argument('--walk-workers', default=1, type=int,
+                             metavar='N',
+                             help='list up to N source directories (and '
+                                  'destination directories, for a directory '
+                                  'destination) at once, using threads, which '
+                                  'is faster on network filesystems (default '
+                                  '%(default)s)')
+    less_common.add_argument('--workers', default=1, type=int, metavar='N',
+                             help='number of files to upload at once per '
+                                  'destination, largest files first (default '
+                                  '%(default)s)')
     less_common.add_argument('--license',
                              help="deprecated (cdnupload now has a simple MIT license)")
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
+
+    if args.source is None and args.action != 'serve':
+        parser.error('the following arguments are required: source')
+    if (args.destination is None and
+            args.action not in ('key-map', 'merge-key-maps', 'serve')):
+        parser.error('the following arguments are required: destination')
+    if args.key_map_diff and not args.key_map:
+        parser.error('--key-map-diff requires --key-map')
+    if args.full_rescan and not (args.fingerprint_cache or
+                                 args.daemon_socket):
+        parser.error('--full-rescan requires --fingerprint-cache')
+    if args.action == 'serve' and not args.daemon_socket:
+        parser.error('--daemon-socket is required with --action=serve')
+    if args.check_existing and args.action != 'upload':
+        parser.error('--check-existing is only valid with --action=upload')
+    if (args.throughput_history and
+            args.action not in ('upload', 'delete', 'sync')):
+        parser.error('--throughput-history is only valid with --action '
+                     'upload, delete, or sync')
+    if args.preload and not args.entry_point:
+        parser.error('--preload requires --entry-point')
+    if args.key_map_section and not args.key_map_shards:
+        parser.error('--key-map-section requires --key-map-shards')
+    if args.key_map_shards and (args.shard or
+                                args.action in ('plan', 'apply')):
+        parser.error("--key-map-shards can't be used with --shard, "
+                     "--action=plan, or --action=apply")
+    if args.action == 'key-map':
+        if not args.key_map:
+            parser.error('--key-map is required with --action=key-map')
+        if args.stats_json or args.stats_prometheus:
+            parser.error('--stats-json and --stats-prometheus are not '
+                         'supported with --action=key-map')
+    for name in ('max_bandwidth', 'max_requests_per_second'):
+        value = getattr(args, name)
+        if value is not None and value <= 0:
+            parser.error('--{} must be positive'.format(name.replace('_', '-')))
+    if args.shard and args.key_map_diff:
+        parser.error('--key-map-diff not valid with --shard (use it when '
+                     'merging the partial key maps)')
+    if args.shard and args.key_map_format != 'json':
+        parser.error('--key-map-format must be json with --shard (merge the '
+                     'partial key maps to write another format)')
+    if args.shard and args.action in ('delete', 'sync'):
+        parser.error("--shard can't be used with --action={}, as each shard "
+                     "only knows about its own source files".format(args.action))
+    if args.action in ('plan', 'apply'):
+        if not args.plan:
+            parser.error('--plan is required with --action={}'.format(
+                    args.action))
+        if args.extra_destination:
+            parser.error('--extra-destination is not supported with '
+                         '--action={}'.format(args.action))
 
     logging.basicConfig(level=logging.WARNING, format='%(message)s')
     log_level = next(v for k, v in LOG_LEVELS if k == args.log_level)
     logger.setLevel(log_level)
 
-    match = re.match(r'(\w+):', args.destination)
-    if match:
-        scheme = match.group(1)
-        if scheme == 's3':
-            destination_class = S3Destination
-        else:
-            module_name = 'cdnupload_' + scheme
-            try:
-                module = __import__(module_name)
-            except ImportError as error:
-                parser.error("can't import handler for scheme {!r}: {}".format(
-                        scheme, error))
-            if not hasattr(module, 'Destination'):
-                parser.error('{} module has no Destination class'.format(
-                        module_name))
-            destination_class = getattr(module, 'Destination')
-    else:
-        destination_class = FileDestination
+    if args.action == 'serve':
+        return _serve(args.daemon_socket, relist_interval=args.relist_interval)
+    if (args.daemon_socket and _daemon is None and
+            args.action in ('upload', 'delete', 'sync', 'key-map')):
+        exit_code = _run_in_daemon(args.daemon_socket, arg_list)
+        if exit_code is not None:
+            return exit_code
+        logger.info('no daemon listening on %s, running here',
+                    args.daemon_socket)
+
+    if args.action == 'merge-key-maps':
+        if not args.key_map:
+            parser.error('--key-map is required with --action=merge-key-maps')
+        paths = [args.source] + [p for p in [args.destination] + args.dest_args
+                                 if p is not None]
+        return _merge_key_map_files(paths, args.key_map,
+                                    key_map_format=args.key_map_format,
+                                    key_map_diff_path=args.key_map_diff)
+
+    try:
+        destination_class = (get_destination_class(args.destination)
+                             if args.destination is not None else None)
+    except ValueError as error:
+        parser.error(str(error))
 
     if args.action == 'dest-help':
         import inspect
@@ -749,15 +4902,33 @@ Amazon S3 bucket, with content-based hash in filenames for versioning.
         print(inspect.getdoc(destination_class))
         return 0
 
-    source = FileSource(
-        args.source,
+    source_kwargs = dict(
         dot_names=args.dot_names,
         include=args.include,
         exclude=args.exclude,
         ignore_walk_errors=args.ignore_walk_errors,
         follow_symlinks=args.follow_symlinks,
         hash_length=args.hash_length,
+        content_cache_size=args.content_cache_size,
+        shard=args.shard,
+        hash_algorithm=args.hash_algorithm,
+        tree_hash_chunk_size=args.tree_hash_chunk_size,
+        cache_text_by_extension=args.cache_text_by_extension,
+        fingerprint_cache=args.fingerprint_cache,
+        full_rescan=args.full_rescan,
+        walk_workers=args.walk_workers,
+        rewrite_css=args.rewrite_css,
+        rewrite_html=args.rewrite_html,
     )
+    try:
+        if _daemon is not None:
+            source = _daemon.get_source(args.source, **source_kwargs)
+        else:
+            source = FileSource(args.source, **source_kwargs)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.key_map_shards:
+        source = _KeyMapShardSource(source, sections=args.key_map_section)
 
     dest_kwargs = {}
     for arg in args.dest_args:
@@ -774,43 +4945,510 @@ Amazon S3 bucket, with content-based hash in filenames for versioning.
         else:
             dest_kwargs[name] = value
 
+    destinations = []
+    urls = [args.destination] + (args.extra_destination or [])
+    if args.action == 'key-map':
+        urls = []
+    for url in urls:
+        try:
+            url_class = get_destination_class(url)
+        except ValueError as error:
+            parser.error(str(error))
+        url_kwargs = dest_kwargs if url_class is destination_class else {}
+        if (issubclass(url_class, (S3Destination, HTTPDestination)) and
+                'workers' not in url_kwargs):
+            url_kwargs = dict(url_kwargs, workers=args.workers)
+        if (issubclass(url_class, FileDestination) and
+                'walk_workers' not in url_kwargs):
+            url_kwargs = dict(url_kwargs, walk_workers=args.walk_workers)
+        try:
+            if _daemon is not None:
+                destination = _daemon.get_destination(url_class, url,
+                                                      url_kwargs)
+            else:
+                destination = url_class(url, **url_kwargs)
+            destinations.append(destination)
+        except Exception as error:
+            logger.error('ERROR creating %s instance: %s',
+                         url_class.__name__, error)
+            return 1
+
+    hooks = []
     try:
-        destination = destination_class(args.destination, **dest_kwargs)
+        if args.profile:
+            hooks.append(ProfileHook(args.profile))
+        if args.trace:
+            hooks.append(TraceHook(args.trace))
+        if args.trace_memory:
+            hooks.append(MemoryHook())
     except Exception as error:
-        logger.error('ERROR creating %s instance: %s',
-                     destination_class.__name__, error)
+        logger.error('ERROR setting up hooks: %s', error)
         return 1
+    for hook in hooks:
+        add_hook(hook)
 
+    results = []
     action_args = dict(
         source=source,
-        destination=destination,
+        destination=destinations if len(destinations) != 1 else destinations[0],
         force=args.force,
         dry_run=args.dry_run,
         continue_on_errors=args.continue_on_errors,
     )
+    if args.max_bandwidth or args.max_requests_per_second:
+        action_args['rate_limiter'] = RateLimiter(
+                max_bandwidth=args.max_bandwidth,
+                max_requests_per_second=args.max_requests_per_second)
+    history = None
+    if args.throughput_history:
+        history = ThroughputHistory(args.throughput_history)
+        action_args['history'] = history
     try:
         if args.action == 'upload':
-            result = upload(**action_args)
+            result = upload(workers=args.workers,
+                            check_existing=args.check_existing, **action_args)
         elif args.action == 'delete':
             result = delete(**action_args)
+        elif args.action == 'sync':
+            result = sync(delete_delay=args.delete_delay,
+                          workers=args.workers, **action_args)
+        elif args.action == 'plan':
+            result = write_plan(action_args['source'],
+                                action_args['destination'], args.plan,
+                                force=args.force)
+        elif args.action == 'apply':
+            result = apply_plan(plan_path=args.plan, delete=args.plan_delete,
+                                verify=args.plan_verify,
+                                delete_delay=args.delete_delay,
+                                workers=args.workers, **action_args)
+        elif args.action == 'key-map':
+            result = _build_key_map_result(source)
         else:
             assert 'unexpected action {!r}'.format(args.action)
-        num_errors = result.num_errors
+        results = result if isinstance(result, list) else [result]
+        num_errors = sum(r.num_errors for r in results)
+        result = results[0]
     except Error as error:
         logger.error('%s', error)
         num_errors = 1
+    finally:
+        for hook in hooks:
+            remove_hook(hook)
+
+    for destination, r in zip(destinations, results):
+        if r.stats.estimate is not None:
+            at_destination = (' for {}'.format(destination)
+                              if len(destinations) > 1 else '')
+            logger.warning('estimate%s: %s', at_destination, r.stats.estimate)
+    if history is not None and results and not args.dry_run:
+        try:
+            history.save()
+        except Exception as error:
+            logger.error('ERROR writing throughput history: {}'.format(error))
+            num_errors += 1
 
     if num_errors == 0 and args.key_map:
+        key_map = result.source_key_map
         try:
-            logger.info('writing key map JSON to {}'.format(args.key_map))
-            with open(args.key_map, 'w') as f:
-                json.dump(result.source_key_map, f, sort_keys=True, indent=4)
+            if args.shard:
+                import json
+                logger.info('writing partial key map JSON to {}'.format(
+                        args.key_map))
+                partial = {'cdnupload_shard': list(args.shard),
+                           'hash_algorithm': source.hash_id,
+                           'key_map': key_map}
+                _write_file_atomic(args.key_map, json.dumps(
+                        partial, sort_keys=True, indent=4))
+            else:
+                _write_key_map_and_diff(
+                        key_map, args.key_map, args.key_map_format,
+                        args.key_map_diff,
+                        metadata={'hash_algorithm': source.hash_id})
         except Exception as error:
             logger.error('ERROR writing key map file: {}'.format(error))
             num_errors += 1
 
+    if num_errors == 0 and (args.key_map_shards or args.import_map or
+                            args.preload):
+        try:
+            _write_front_end_files(source, result.source_key_map,
+                                   shards_path=args.key_map_shards,
+                                   import_map_path=args.import_map,
+                                   preload_path=args.preload,
+                                   entry_points=args.entry_point,
+                                   url_prefix=args.url_prefix)
+        except Exception as error:
+            logger.error('ERROR writing front-end files: {}'.format(error))
+            num_errors += 1
+
+    if results and (args.stats_json or args.stats_prometheus):
+        try:
+            _write_stats(destinations, results, json_path=args.stats_json,
+                         prometheus_path=args.stats_prometheus)
+        except Exception as error:
+            logger.error('ERROR writing stats file: {}'.format(error))
+            num_errors += 1
+
     return 1 if num_errors else 0
 
 
+def _write_key_map_and_diff(key_map, path, format, diff_path=None,
+                            metadata=None):
+    """Write key map (and metadata) to path in given format. If diff_path
+    is specified, first read the previous key map at path (if any), and write
+    the differences between it and the new key map as JSON to diff_path.
+    """
+    if diff_path:
+        import json
+        old_key_map = read_key_map(path) if os.path.exists(path) else {}
+    logger.info('writing key map {} to {}'.format(format, path))
+    write_key_map(key_map, path, format=format, metadata=metadata)
+    if diff_path:
+        diff = diff_key_maps(old_key_map, key_map)
+        logger.info('writing key map diff ({} added, {} changed, {} removed) '
+                    'to {}'.format(len(diff['added']), len(diff['changed']),
+                                   len(diff['removed']), diff_path))
+        _write_file_atomic(diff_path, json.dumps(diff, sort_keys=True,
+                                                 indent=4))
+
+
+def _write_front_end_files(source, key_map, shards_path=None,
+                           import_map_path=None, preload_path=None,
+                           entry_points=None, url_prefix=''):
+    """Write the key map shard index (for a _KeyMapShardSource source) to
+    shards_path, the import map to import_map_path, and the preload links to
+    preload_path, for the paths that are specified.
+    """
+    import json
+
+    if shards_path:
+        logger.info('writing index of {} key map shards to {}'.format(
+                len(source.shard_keys), shards_path))
+        index = collections.OrderedDict([
+            ('sections', [list(s) for s in source.sections or []]),
+            ('shards', source.shard_keys),
+        ])
+        _write_file_atomic(shards_path, json.dumps(index, indent=4) + '\n')
+    if import_map_path:
+        import_map = make_import_map(key_map, entry_points=entry_points,
+                                     url_prefix=url_prefix)
+        logger.info('writing import map ({} entries) to {}'.format(
+                len(import_map['imports']), import_map_path))
+        _write_file_atomic(import_map_path,
+                           json.dumps(import_map, indent=4) + '\n')
+    if preload_path:
+        links = make_preload_links(key_map, entry_points, url_prefix=url_prefix)
+        logger.info('writing {} preload links to {}'.format(
+                links.count('\n'), preload_path))
+        _write_file_atomic(preload_path, links)
+
+
+def _merge_key_map_files(paths, key_map_path, key_map_format='json',
+                         key_map_diff_path=None):
+    """Merge partial key map files at given paths and write the full key map
+    to key_map_path in given format (and the diff from the previous key map
+    to key_map_diff_path if specified). Return the process exit code (0 on
+    success).
+    """
+    import json
+
+    shard_key_maps = []
+    for path in paths:
+        try:
+            with open(path) as f:
+                shard_key_maps.append(json.load(f))
+        except Exception as error:
+            logger.error('ERROR reading partial key map {}: {}'.format(
+                    path, error))
+            return 1
+    try:
+        key_map = merge_key_maps(shard_key_maps)
+    except KeyMapError as error:
+        logger.error('ERROR merging key maps: {}'.format(error))
+        return 1
+
+    try:
+        logger.info('merged {} partial key maps ({} files)'.format(
+                len(shard_key_maps), len(key_map)))
+        hash_algorithms = [m['hash_algorithm'] for m in shard_key_maps
+                           if m.get('hash_algorithm')]
+        metadata = ({'hash_algorithm': hash_algorithms[0]}
+                    if hash_algorithms else None)
+        _write_key_map_and_diff(key_map, key_map_path, key_map_format,
+                                key_map_diff_path, metadata=metadata)
+    except Exception as error:
+        logger.error('ERROR writing key map file: {}'.format(error))
+        return 1
+    return 0
+
+
+def _build_key_map_result(source):
+    """Build the source key map (for --action=key-map) and return a Result
+    namedtuple with nothing uploaded or deleted.
+    """
+    source, source_key_map, _, stats = _prepare(source, [])
+    logger.info('built key map of %d files in %s', len(source_key_map),
+                source)
+    return Result(source_key_map, set(), len(source_key_map), 0, 0, 0, 0,
+                  stats)
+
+
+class _DaemonState(object):
+    """Sources and destinations kept by --action=serve between requests.
+
+    Sources are FileSource instances with an in-memory fingerprint cache,
+    so only files in changed directories are hashed again (their content
+    caches are cleared at the start of each request). Destinations are
+    wrapped in _KeyCacheDestination, so they're only listed again every
+    "relist_interval" seconds. Both are keyed by their arguments, so a
+    request with different options gets its own instance.
+    """
+
+    def __init__(self, relist_interval=300):
+        self.relist_interval = relist_interval
+        self.sources = {}
+        self.destinations = {}
+
+    def get_source(self, root, **kwargs):
+        root = os.path.abspath(root)
+        full_rescan = kwargs.pop('full_rescan', False)
+        cache_key = repr((root, sorted(kwargs.items())))
+        source = self.sources.get(cache_key)
+        if source is None:
+            if not kwargs.get('fingerprint_cache'):
+                kwargs['fingerprint_cache'] = {}
+            source = FileSource(root, cache_key_map=False, **kwargs)
+            self.sources[cache_key] = source
+        source.full_rescan = full_rescan
+        # Never serve contents read during an earlier request (and don't
+        # hold them in memory between requests)
+        source._clear_content_cache()
+        return source
+
+    def get_destination(self, destination_class, url, kwargs):
+        if destination_class is FileDestination:
+            url = os.path.abspath(url)
+        cache_key = repr((destination_class.__name__, url,
+                          sorted(kwargs.items())))
+        destination = self.destinations.get(cache_key)
+        if destination is None:
+            destination = _KeyCacheDestination(
+                    destination_class(url, **kwargs), self.relist_interval)
+            self.destinations[cache_key] = destination
+        return destination
+
+
+class _SocketLogHandler(logging.Handler):
+    """Logging handler that sends each record to a daemon client as a JSON
+    line.
+    """
+
+    def __init__(self, conn):
+        logging.Handler.__init__(self)
+        self.conn = conn
+
+    def emit(self, record):
+        try:
+            _send_json(self.conn, {'log': record.levelno,
+                                   'message': self.format(record)})
+        except Exception:
+            self.handleError(record)
+
+
+class _RequestExit(Exception):
+    """Raised while the daemon is running a request to finish it with the
+    given exit status, after writing "message" to the client's stderr.
+    """
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+
+
+def _send_json(conn, message):
+    import json
+    conn.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+
+def _connect_daemon(socket_path):
+    """Return a socket connected to the daemon listening on socket_path, or
+    None if there isn't one.
+    """
+    import socket
+
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+    except (IOError, OSError):
+        conn.close()
+        return None
+    return conn
+
+
+def _run_in_daemon(socket_path, args):
+    """Send command line args (and the current directory) to the daemon
+    listening on socket_path, and log its output here (usage errors are
+    written to stderr, as argparse would). Return the exit code of the
+    request, or None if no daemon is listening.
+    """
+    import json
+
+    conn = _connect_daemon(socket_path)
+    if conn is None:
+        return None
+    try:
+        _send_json(conn, {'args': args, 'cwd': os.getcwd()})
+        for line in conn.makefile('rb'):
+            message = json.loads(line.decode('utf-8'))
+            if 'exit' in message:
+                return message['exit']
+            elif 'stderr' in message:
+                sys.stderr.write(message['stderr'])
+            else:
+                logger.log(message['log'], '%s', message['message'])
+    except (IOError, OSError, ValueError) as error:
+        logger.error('ERROR communicating with daemon on %s: %s',
+                     socket_path, error)
+        return 1
+    finally:
+        conn.close()
+    logger.error('ERROR: daemon on %s closed connection before finishing',
+                 socket_path)
+    return 1
+
+
+def _handle_daemon_request(state, conn):
+    """Read one request from client connection conn, run it with main()
+    using the warm sources and destinations in state, and send the log
+    output and exit code back to the client.
+    """
+    import json
+
+    line = conn.makefile('rb').readline()
+    if not line:
+        return
+    request = json.loads(line.decode('utf-8'))
+    logger.info('request: %s', ' '.join(request['args']))
+
+    old_cwd = os.getcwd()
+    old_level = logger.level
+    handler = _SocketLogHandler(conn)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    try:
+        os.chdir(request['cwd'])
+        exit_code = main(request['args'], _daemon=state)
+    except _RequestExit as error:
+        _send_json(conn, {'stderr': error.message})
+        exit_code = error.status
+    except SystemExit as error:
+        exit_code = error.code if isinstance(error.code, int) else 1
+    except Exception as error:
+        logger.error('ERROR running request: %s', error)
+        exit_code = 1
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(old_level)
+        os.chdir(old_cwd)
+    _send_json(conn, {'exit': exit_code})
+
+
+def _peer_uid(conn):
+    """Return the user ID of the process at the other end of Unix socket
+    conn, or None if that isn't supported on this platform.
+    """
+    import socket
+
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', creds)
+    return uid
+
+
+def _serve(socket_path, relist_interval=300, _stop=None):
+    """Listen for requests from cdnupload clients on the Unix socket at
+    socket_path and run them one at a time, keeping source key maps and
+    destination keys in memory between requests (see _DaemonState). Run
+    until interrupted (or until the _stop event is set), and return the
+    process exit code.
+
+    Requests run with the daemon's permissions and credentials, so only the
+    daemon's own user may connect: the socket is created with mode 0600,
+    and where the peer's credentials are available (SO_PEERCRED), requests
+    from other users are refused.
+    """
+    import signal
+    import socket
+
+    if not hasattr(socket, 'AF_UNIX'):
+        logger.error('ERROR: --action=serve requires Unix domain sockets')
+        return 1
+    if os.path.exists(socket_path):
+        conn = _connect_daemon(socket_path)
+        if conn is not None:
+            conn.close()
+            logger.error('ERROR: a daemon is already listening on %s',
+                         socket_path)
+            return 1
+        # Left behind by a daemon that didn't exit cleanly
+        os.remove(socket_path)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    try:
+        old_handler = signal.signal(signal.SIGTERM, stop)
+    except ValueError:
+        old_handler = None  # not in the main thread
+
+    state = _DaemonState(relist_interval=relist_interval)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        listener.bind(socket_path)
+        os.chmod(socket_path, 0o600)
+    except (IOError, OSError) as error:
+        listener.close()
+        if old_handler is not None:
+            signal.signal(signal.SIGTERM, old_handler)
+        logger.error('ERROR listening on %s: %s', socket_path, error)
+        return 1
+    finally:
+        os.umask(old_umask)
+    try:
+        listener.listen(16)
+        listener.settimeout(0.5)
+        logger.warning('listening on %s', socket_path)
+        while _stop is None or not _stop.is_set():
+            try:
+                conn, _ = listener.accept()
+            except socket.timeout:
+                continue
+            try:
+                uid = _peer_uid(conn)
+                if uid is not None and uid != os.getuid():
+                    logger.warning('refusing request from user %d', uid)
+                    continue
+                conn.settimeout(None)
+                _handle_daemon_request(state, conn)
+            except Exception as error:
+                logger.error('ERROR handling request: %s', error)
+            finally:
+                conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        if old_handler is not None:
+            signal.signal(signal.SIGTERM, old_handler)
+    return 0
+
+
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,61 @@
+"""Smoke test the benchmark harness so it doesn't rot between runs."""
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+import benchmark
+
+
+def test_generate_tree(tmpdir):
+    num_bytes = benchmark.generate_tree(
+        tmpdir.strpath, num_files=50, median_size=100, max_size=1000,
+        text_ratio=1.0, max_depth=2, files_per_dir=10, crlf_density=1.0)
+    paths = [os.path.join(d, n) for d, _, ns in os.walk(tmpdir.strpath)
+             for n in ns]
+    assert len(paths) == 50
+    assert sum(os.path.getsize(p) for p in paths) == num_bytes
+    for path in paths:
+        rel_path = os.path.relpath(path, tmpdir.strpath)
+        assert rel_path.count(os.sep) <= 2
+        with open(path, 'rb') as f:
+            content = f.read()
+        assert b'\n' not in content.replace(b'\r\n', b'')
+
+
+def test_fake_s3_throttling():
+    s3 = benchmark.FakeS3Client(max_requests_per_second=1000)
+    for i in range(5):
+        s3.delete_object(Bucket='b', Key='k')
+    assert s3.num_requests == 5
+    assert s3.num_throttled >= 1
+
+
+def test_run_benchmark():
+    results = benchmark.run_benchmark(num_files=20, median_size=100,
+                                      delete_fraction=0.5, page_size=7,
+                                      repeat=1)
+    json.dumps(results)
+    upload = results['results']['upload']
+    assert upload['num_uploaded'] == 20
+    # One (empty) listing page plus one request per upload
+    assert upload['num_requests'] == 21
+    delete = results['results']['delete']
+    assert delete['num_removed_files'] == 10
+    assert delete['num_deleted'] == 10
+    # Three listing pages of up to 7 keys plus one request per delete
+    assert delete['num_requests'] == 13
+
+
+def test_run_http_benchmark():
+    import http_origin
+    results = http_origin.run_http_benchmark(num_files=10, median_size=100,
+                                             workers=2, repeat=1)
+    json.dumps(results)
+    keep_alive = results['results']['keep_alive']
+    no_keep_alive = results['results']['no_keep_alive']
+    assert keep_alive['num_requests'] == no_keep_alive['num_requests'] == 22
+    assert keep_alive['num_connections'] <= 2
+    assert no_keep_alive['num_connections'] == 22
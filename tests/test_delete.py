@@ -5,7 +5,8 @@ import os
 import pytest
 
 from cdnupload import (SourceError, DestinationError, DeleteAllKeysError,
-                       FileSource, FileDestination, delete, upload)
+                       FileSource, FileDestination, RateLimiter, delete,
+                       upload)
 
 
 def list_files(top):
@@ -158,3 +159,47 @@ def test_str_destination(tmpdir):
 
     result = delete(s, d)
     assert result.num_processed == 0
+
+
+def test_delete_multiple_destinations(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'a.txt').write_binary(b'a')
+    tmpdir.join('src', 'b.txt').write_binary(b'b')
+
+    s = tmpdir.join('src').strpath
+    d1 = tmpdir.join('dest1').strpath
+    d2 = tmpdir.join('dest2').strpath
+    upload(s, [d1, d2])
+    tmpdir.join('src', 'a.txt').remove()
+
+    s = FileSource(s)
+    results = delete(s, [d1, FileDestination(d2)])
+    assert [(r.num_scanned, r.num_processed, r.num_errors) for r in results] == [
+        (2, 1, 0),
+        (2, 1, 0),
+    ]
+    assert list_files(d1) == list_files(d2) == ['b_e9d71f5ee7c92d6d.txt']
+
+    tmpdir.join('src', 'b.txt').remove()
+    with pytest.raises(DeleteAllKeysError):
+        delete(FileSource(tmpdir.join('src').strpath), [d1, d2])
+    assert list_files(d1) == list_files(d2) == ['b_e9d71f5ee7c92d6d.txt']
+
+
+def test_delete_rate_limiter(tmpdir):
+    tmpdir.join('src').mkdir()
+    for i in range(5):
+        tmpdir.join('src', '{}.txt'.format(i)).write_binary(str(i).encode())
+    s = tmpdir.join('src').strpath
+    d = tmpdir.join('dest').strpath
+    upload(s, d)
+    for i in range(4):
+        tmpdir.join('src', '{}.txt'.format(i)).remove()
+
+    limiter = RateLimiter(max_requests_per_second=20)
+    limiter.requests.tokens = 2
+    result = delete(s, d, rate_limiter=limiter)
+    assert result.num_deleted == 4
+    assert result.stats.throttle_waits == 2
+    assert result.stats.throttle_seconds > 0.05
+    assert len(list_files(d)) == 1
@@ -1,5 +1,9 @@
 """Test FileDestination class."""
 
+import os
+
+import pytest
+
 from cdnupload import FileDestination, FileSource
 
 
@@ -35,3 +39,62 @@ def test_file_operations(tmpdir):
 
     d.delete(keys['file.txt'])
     assert sorted(d.walk_keys()) == ['subdir/subfile_0beec7b5ea3f0fdb.txt']
+
+
+def test_walk_keys(tmpdir):
+    dest = tmpdir.join('dest')
+    for path in ['a.txt', 'b/c.txt', 'b/d/e.txt', 'b/d/f/g.txt', 'h/i.txt']:
+        dest.join(*path.split('/')).write_binary(b'x', ensure=True)
+    dest.join('empty').mkdir()
+    expected = ['a.txt', 'b/c.txt', 'b/d/e.txt', 'b/d/f/g.txt', 'h/i.txt']
+    if hasattr(os, 'symlink'):
+        # Like os.walk(), symbolic links to directories aren't walked
+        os.symlink(dest.join('b').strpath, dest.join('link').strpath)
+        os.symlink(dest.join('a.txt').strpath, dest.join('a-link.txt').strpath)
+        expected.insert(0, 'a-link.txt')
+
+    for walk_workers in [1, 3, '4']:
+        d = FileDestination(dest.strpath, walk_workers=walk_workers)
+        assert sorted(d.walk_keys()) == expected
+
+    assert list(FileDestination(tmpdir.join('missing').strpath).walk_keys()) == []
+    with pytest.raises(TypeError):
+        FileDestination(dest.strpath, walk_workers='many')
+
+
+def test_exists_many(tmpdir):
+    dest = tmpdir.join('dest')
+    dest.join('a', 'b.txt').write_binary(b'b', ensure=True)
+    dest.join('c.txt').write_binary(b'c')
+    for walk_workers in [1, 4]:
+        d = FileDestination(dest.strpath, walk_workers=walk_workers)
+        assert d.exists_many(['a/b.txt', 'c.txt', 'a', 'd.txt', 'a/e.txt']) == {
+            'a/b.txt', 'c.txt'}
+        assert d.exists_many([]) == set()
+
+
+def test_upload_made_dirs(tmpdir, monkeypatch):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'file.txt').write_binary(b'foo')
+    s = FileSource(tmpdir.join('src').strpath)
+    dest = tmpdir.join('dest')
+    dest.mkdir()
+    d = FileDestination(dest.strpath)
+
+    makedirs_calls = []
+    real_makedirs = os.makedirs
+
+    def makedirs(path, *args, **kwargs):
+        makedirs_calls.append(path)
+        real_makedirs(path, *args, **kwargs)
+    monkeypatch.setattr(os, 'makedirs', makedirs)
+
+    for i in range(3):
+        d.upload('sub/file{}.txt'.format(i), s, 'file.txt')
+    assert makedirs_calls == [dest.join('sub').strpath]
+
+    # A directory removed behind the destination's back is created again
+    dest.join('sub').remove()
+    d.upload('sub/file3.txt', s, 'file.txt')
+    assert dest.join('sub', 'file3.txt').read_binary() == b'foo'
+    assert len(makedirs_calls) == 2
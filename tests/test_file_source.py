@@ -6,7 +6,7 @@ import sys
 
 import pytest
 
-from cdnupload import FileSource
+from cdnupload import FileSource, get_hash_class, upload
 
 
 def test_init():
@@ -69,6 +69,75 @@ def test_hash_file(tmpdir):
     assert s.hash_file('test1.txt', is_text=True) == '76bb1822205fc52742565357a1027fec'
 
 
+def test_hash_algorithm(tmpdir):
+    tmpdir.join('test.txt').write_binary(b'one\r\ntwo')
+    s = FileSource(tmpdir.strpath, hash_algorithm='blake2b')
+    assert s.hash_class == hashlib.blake2b
+    assert s.hash_id == 'blake2b'
+    assert s.hash_file('test.txt') == hashlib.blake2b(b'one\ntwo').hexdigest()
+
+    assert FileSource(tmpdir.strpath).hash_id == 'sha1'
+    assert FileSource(tmpdir.strpath, hash_class=hashlib.md5).hash_id == 'md5'
+    assert get_hash_class('blake2s') == hashlib.blake2s
+    with pytest.raises(ValueError):
+        get_hash_class('crc32')
+    with pytest.raises(ValueError):
+        FileSource(tmpdir.strpath, hash_algorithm='crc32')
+
+
+def test_hash_file_tree(tmpdir):
+    content = b'a\r\n' * 10 + b'b' * 5
+    tmpdir.join('big.txt').write_binary(content)
+    tmpdir.join('small.txt').write_binary(b'small')
+    s = FileSource(tmpdir.strpath, tree_hash_chunk_size=8, tree_hash_workers=2,
+                   hash_chunk_size=4)
+    assert s.hash_id == 'sha1-tree-8'
+
+    # Chunks are cut after removing CRs, so the hash doesn't depend on
+    # line endings
+    normalized = content.replace(b'\r', b'')
+    digests = b''.join(hashlib.sha1(normalized[i:i + 8]).digest()
+                       for i in range(0, len(normalized), 8))
+    assert s.hash_file('big.txt') == hashlib.sha1(digests).hexdigest()
+    assert s.bytes_hashed == len(content)
+    tmpdir.join('big_lf.txt').write_binary(normalized)
+    assert s.hash_file('big_lf.txt') == s.hash_file('big.txt')
+    # Files no larger than the tree chunk size are hashed normally
+    assert s.hash_file('small.txt') == hashlib.sha1(b'small').hexdigest()
+    # Including text files that are only larger because of their CRs
+    tmpdir.join('crlf.txt').write_binary(b'ab\r\ncd\r\ne\r\n')
+    assert s.hash_file('crlf.txt') == hashlib.sha1(b'ab\ncd\ne\n').hexdigest()
+
+
+def test_hash_file_tree_line_endings(tmpdir):
+    lines = [u'var line{} = {};'.format(i, i).encode('ascii')
+             for i in range(20000)]
+    tmpdir.join('lf.js').write_binary(b'\n'.join(lines))
+    tmpdir.join('crlf.js').write_binary(b'\r\n'.join(lines))
+    plain = FileSource(tmpdir.strpath)
+    tree = FileSource(tmpdir.strpath, tree_hash_chunk_size=65536,
+                      tree_hash_workers=4)
+    assert plain.hash_file('lf.js') == plain.hash_file('crlf.js')
+    assert tree.hash_file('lf.js') == tree.hash_file('crlf.js')
+    assert tree.hash_file('lf.js') != plain.hash_file('lf.js')
+
+
+def test_cache_text_by_extension(tmpdir):
+    tmpdir.join('a.txt').write_binary(b'text\r\n')
+    tmpdir.join('b.txt').write_binary(b'binary\r\n\x00')
+    tmpdir.join('c').write_binary(b'binary\r\n\x00')
+    s = FileSource(tmpdir.strpath, cache_text_by_extension=True)
+    assert s.hash_file('a.txt') == hashlib.sha1(b'text\n').hexdigest()
+    # Treated as text because a.txt was text
+    assert s.hash_file('b.txt') == hashlib.sha1(b'binary\n\x00').hexdigest()
+    # Files without an extension are always checked
+    assert s.hash_file('c') == hashlib.sha1(b'binary\r\n\x00').hexdigest()
+
+    s = FileSource(tmpdir.strpath)
+    s.hash_file('a.txt')
+    assert s.hash_file('b.txt') == hashlib.sha1(b'binary\r\n\x00').hexdigest()
+
+
 def test_hash_file_chunk_size(tmpdir):
     class MockHasher:
         updates = []
@@ -209,6 +278,38 @@ def test_walk_files_follow_symlinks(tmpdir):
     s = FileSource(tmpdir.join('walkdir').strpath, follow_symlinks=True)
     assert sorted(s.walk_files()) == ['file', 'link/test.txt']
 
+    s = FileSource(tmpdir.join('walkdir').strpath, walk_workers=2)
+    assert sorted(s.walk_files()) == ['file']
+    s = FileSource(tmpdir.join('walkdir').strpath, follow_symlinks=True,
+                   walk_workers=2)
+    assert sorted(s.walk_files()) == ['file', 'link/test.txt']
+
+
+@pytest.mark.skipif(not hasattr(os, 'symlink'), reason='no os.symlink()')
+def test_walk_files_symlink_cycle(tmpdir):
+    tmpdir.join('walkdir').mkdir()
+    tmpdir.join('walkdir', 'file').write_binary(b'bar')
+    tmpdir.join('walkdir', 'sub').mkdir()
+    tmpdir.join('walkdir', 'sub', 'sub_file').write_binary(b'foo')
+    try:
+        os.symlink(tmpdir.join('walkdir').strpath,
+                   tmpdir.join('walkdir', 'sub', 'loop').strpath)
+        os.symlink(tmpdir.join('walkdir', 'sub').strpath,
+                   tmpdir.join('walkdir', 'sub2').strpath)
+    except (NotImplementedError, OSError):
+        pytest.skip('symlinks not supported')
+
+    for walk_workers in [1, 2]:
+        s = FileSource(tmpdir.join('walkdir').strpath, follow_symlinks=True,
+                       walk_workers=walk_workers)
+        # Links to an ancestor are skipped, other links to a directory aren't
+        assert sorted(s.walk_files()) == ['file', 'sub/sub_file',
+                                          'sub2/sub_file']
+        # Files reached through a symlink are only hashed once
+        keys = s.build_key_map()
+        assert keys['sub2/sub_file'] == 'sub2' + keys['sub/sub_file'][3:]
+        assert s.bytes_hashed == 6
+
 
 def test_walk_files_errors(tmpdir):
     def check_walk_error(file_source, error_path):
@@ -243,6 +344,58 @@ def test_walk_files_errors(tmpdir):
     assert sorted(s.walk_files()) == ['good_dir/test.txt', 'script.js']
 
 
+def test_walk_files_parallel(tmpdir):
+    tmpdir.join('.dot_dir').mkdir()
+    tmpdir.join('.dot_dir', 'file.txt').write_binary(b'dot')
+    tmpdir.join('b.txt').write_binary(b'b')
+    tmpdir.join('a.jpg').write_binary(b'a')
+    for sub in ['sub2', 'sub1']:
+        tmpdir.join(sub).mkdir()
+        tmpdir.join(sub, 'z.txt').write_binary(b'z')
+        tmpdir.join(sub, '.dot_file').write_binary(b'dot')
+        tmpdir.join(sub, 'deep').mkdir()
+        tmpdir.join(sub, 'deep', 'y.jpg').write_binary(b'y')
+
+    s = FileSource(tmpdir.strpath, walk_workers=4)
+    assert list(s.walk_files()) == [
+        'a.jpg',
+        'b.txt',
+        'sub1/z.txt',
+        'sub2/z.txt',
+        'sub1/deep/y.jpg',
+        'sub2/deep/y.jpg',
+    ]
+
+    for kwargs in [{'dot_names': True}, {'include': '*.jpg'},
+                   {'exclude': ['sub1/*', '*.txt']}]:
+        serial = FileSource(tmpdir.strpath, **kwargs)
+        parallel = FileSource(tmpdir.strpath, walk_workers=3, **kwargs)
+        assert sorted(parallel.walk_files()) == sorted(serial.walk_files())
+
+    s = FileSource(tmpdir.join('not_exists').strpath, walk_workers=4,
+                   ignore_walk_errors=True)
+    with pytest.raises(OSError):
+        list(s.walk_files())
+
+    def mock_os_walk(top, onerror=None, followlinks=False):
+        if top.endswith('bad_dir'):
+            error = OSError()
+            error.filename = top
+            onerror(error)
+            return
+        if top.endswith('good_dir'):
+            yield (top, [], ['test.txt'])
+        else:
+            yield (top, ['good_dir', 'bad_dir'], ['script.js'])
+
+    s = FileSource(tmpdir.strpath, walk_workers=2, _os_walk=mock_os_walk)
+    with pytest.raises(OSError):
+        list(s.walk_files())
+    s = FileSource(tmpdir.strpath, walk_workers=2, ignore_walk_errors=True,
+                   _os_walk=mock_os_walk)
+    assert list(s.walk_files()) == ['script.js', 'good_dir/test.txt']
+
+
 def test_walk_files_unicode(tmpdir):
     tmpdir.join(u'foo\u2012.txt').write_binary(b'unifoo')
     s = FileSource(tmpdir.strpath)
@@ -291,3 +444,308 @@ def test_build_key_map_caching(tmpdir):
     assert num_walks[0] == 1
     assert s.build_key_map() == {'test.txt': 'test_0beec7b5ea3f0fdb.txt'}
     assert num_walks[0] == 2
+
+
+def test_fingerprint_cache(tmpdir):
+    src = tmpdir.join('src')
+    src.mkdir()
+    src.join('script.js').write_binary(b'/* test */')
+    src.join('images').mkdir()
+    src.join('images', 'foo1.jpg').write_binary(b'foo1')
+    src.join('images', 'foo2.jpg').write_binary(b'foo2')
+    src.join('images', 'big').mkdir()
+    src.join('images', 'big', 'bar.jpg').write_binary(b'bar')
+
+    def set_old_mtimes():
+        # Fingerprints of recently-modified directories aren't cached
+        for path in src.visit():
+            os.utime(path.strpath, (1000000000, 1000000000))
+        os.utime(src.strpath, (1000000000, 1000000000))
+
+    set_old_mtimes()
+    cache_path = tmpdir.join('fingerprints.json').strpath
+    full_key_map = FileSource(src.strpath).build_key_map()
+
+    s = FileSource(src.strpath, fingerprint_cache=cache_path)
+    assert s.build_key_map() == full_key_map
+    assert s.bytes_hashed == 21
+    assert os.path.exists(cache_path)
+
+    s = FileSource(src.strpath, fingerprint_cache=cache_path)
+    assert s.build_key_map() == full_key_map
+    assert s.bytes_hashed == 0
+
+    # Changing a file in a nested directory only rehashes that directory
+    src.join('images', 'big', 'bar.jpg').write_binary(b'BAR2')
+    set_old_mtimes()
+    full_key_map = FileSource(src.strpath).build_key_map()
+    s = FileSource(src.strpath, fingerprint_cache=cache_path)
+    assert s.build_key_map() == full_key_map
+    assert s.bytes_hashed == 4
+
+    # Recently-modified directories are rehashed until they're stable
+    src.join('images', 'foo3.jpg').write_binary(b'foo3')
+    full_key_map = FileSource(src.strpath).build_key_map()
+    for _ in range(2):
+        s = FileSource(src.strpath, fingerprint_cache=cache_path)
+        assert s.build_key_map() == full_key_map
+        assert s.bytes_hashed == 12
+
+    # Filters are applied as usual
+    set_old_mtimes()
+    FileSource(src.strpath, fingerprint_cache=cache_path).build_key_map()
+    s = FileSource(src.strpath, fingerprint_cache=cache_path,
+                   exclude='images/foo1.jpg')
+    assert sorted(s.build_key_map()) == ['images/big/bar.jpg',
+                                         'images/foo2.jpg', 'images/foo3.jpg',
+                                         'script.js']
+    assert s.bytes_hashed == 8
+
+    # Different settings or full_rescan ignore the cache
+    s = FileSource(src.strpath, fingerprint_cache=cache_path, hash_length=8)
+    s.build_key_map()
+    assert s.bytes_hashed == 26
+    s = FileSource(src.strpath, fingerprint_cache=cache_path, hash_length=8,
+                   full_rescan=True)
+    s.build_key_map()
+    assert s.bytes_hashed == 26
+    s = FileSource(src.strpath, fingerprint_cache=cache_path, hash_length=8)
+    s.build_key_map()
+    assert s.bytes_hashed == 0
+
+    tmpdir.join('fingerprints.json').write('not json')
+    s = FileSource(src.strpath, fingerprint_cache=cache_path)
+    s.build_key_map()
+    assert s.bytes_hashed == 26
+
+    # An in-memory cache is updated in place
+    cache = {}
+    s = FileSource(src.strpath, fingerprint_cache=cache, cache_key_map=False)
+    s.build_key_map()
+    assert s.bytes_hashed == 26
+    assert sorted(cache['directories']) == ['', 'images', 'images/big']
+    s.build_key_map()
+    assert s.bytes_hashed == 26
+
+
+@pytest.mark.skipif(not hasattr(os, 'link'), reason='no os.link()')
+def test_build_key_map_hard_links(tmpdir):
+    tmpdir.join('a.txt').write_binary(b'shared')
+    tmpdir.join('sub').mkdir()
+    tmpdir.join('b.bin').write_binary(b'shared')
+    try:
+        os.link(tmpdir.join('a.txt').strpath, tmpdir.join('c.txt').strpath)
+        os.link(tmpdir.join('a.txt').strpath,
+                tmpdir.join('sub', 'd.txt').strpath)
+        os.link(tmpdir.join('a.txt').strpath, tmpdir.join('e.css').strpath)
+    except (NotImplementedError, OSError):
+        pytest.skip('hard links not supported')
+
+    class CountingSource(FileSource):
+        num_stats = 0
+
+        def stat_file(self, rel_path):
+            self.num_stats += 1
+            return FileSource.stat_file(self, rel_path)
+
+    # Identity comes from fstat() on the file opened for hashing
+    s = CountingSource(tmpdir.strpath)
+    keys = s.build_key_map()
+    assert keys['c.txt'] == 'c' + keys['a.txt'][1:]
+    assert keys['sub/d.txt'] == 'sub/d' + keys['a.txt'][1:]
+    assert keys['e.css'][1:-4] == keys['a.txt'][1:-4]
+    # a.txt, b.bin, and e.css (different extension) are hashed
+    assert s.bytes_hashed == 18
+    assert s.num_hashes_reused == 2
+    assert s.num_stats == 0
+
+    cache_path = tmpdir.join('fingerprints.json').strpath
+    s = FileSource(tmpdir.strpath, fingerprint_cache=cache_path)
+    assert s.build_key_map() == keys
+    assert s.bytes_hashed == 18
+
+    # Subclasses that override hash_file() stat each file first instead
+    class MySource(CountingSource):
+        def hash_file(self, rel_path, is_text=None):
+            return FileSource.hash_file(self, rel_path, is_text=is_text)
+
+    tmpdir.join('fingerprints.json').remove()
+    s = MySource(tmpdir.strpath)
+    assert s.build_key_map() == keys
+    assert s.num_hashes_reused == 2
+    assert s.num_stats == 5
+
+
+def test_content_cache(tmpdir):
+    tmpdir.join('a.txt').write_binary(b'aaaa')
+    tmpdir.join('b.txt').write_binary(b'bbbb')
+    tmpdir.join('big.txt').write_binary(b'x' * 20)
+
+    s = FileSource(tmpdir.strpath)
+    s.hash_file('a.txt')
+    tmpdir.join('a.txt').write_binary(b'AAAA')
+    with s.open('a.txt') as f:
+        assert f.read() == b'AAAA'
+
+    s = FileSource(tmpdir.strpath, content_cache_size=11, content_cache_max_file=10)
+    assert s.hash_file('a.txt') == hashlib.sha1(b'AAAA').hexdigest()
+    s.hash_file('big.txt')
+    tmpdir.join('a.txt').write_binary(b'changed')
+    tmpdir.join('big.txt').write_binary(b'changed')
+    with s.open('a.txt') as f:
+        assert f.read() == b'AAAA'
+    with s.open('big.txt') as f:
+        assert f.read() == b'changed'
+
+    # Cached contents are only returned once
+    tmpdir.join('a.txt').write_binary(b'AAAA')
+    with s.open('a.txt') as f:
+        assert f.read() == b'AAAA'
+    tmpdir.join('a.txt').write_binary(b'changed')
+
+    # Hashing a.txt, b.txt, and then big.txt (7 bytes) should evict a.txt,
+    # the least recently used file
+    s.hash_file('a.txt')
+    s.hash_file('b.txt')
+    s.hash_file('big.txt')
+    tmpdir.join('b.txt').write_binary(b'BBBB')
+    tmpdir.join('a.txt').write_binary(b'AAAA')
+    with s.open('b.txt') as f:
+        assert f.read() == b'bbbb'
+    with s.open('a.txt') as f:
+        assert f.read() == b'AAAA'
+    with s.open('big.txt') as f:
+        assert f.read() == b'changed'
+
+
+def test_content_cache_rebuild(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'a.txt').write_binary(b'one')
+    tmpdir.join('src', 'b.txt').write_binary(b'bbb')
+    s = FileSource(tmpdir.join('src').strpath, cache_key_map=False,
+                   content_cache_size=1000)
+    key_map = s.build_key_map()
+    assert key_map['a.txt'] == 'a_fe05bcdcdc492801.txt'
+
+    # A rebuild hashes the changed file from disk, not the cached contents
+    tmpdir.join('src', 'a.txt').write_binary(b'two')
+    key_map = s.build_key_map()
+    assert key_map['a.txt'] == 'a_ad782ecdac770fc6.txt'
+    with s.open('a.txt') as f:
+        assert f.read() == b'two'
+
+    # Files already at the destination are dropped from the cache
+    tmpdir.join('src', 'a.txt').write_binary(b'three')
+    result = upload(s, tmpdir.join('dest').strpath)
+    assert result.num_uploaded == 2
+    key = result.source_key_map['a.txt']
+    assert tmpdir.join('dest', key).read_binary() == b'three'
+    result = upload(s, tmpdir.join('dest').strpath)
+    assert result.num_uploaded == 0
+    assert s._content_cache_bytes == 0
+    tmpdir.join('src', 'b.txt').write_binary(b'BBB')
+    with s.open('b.txt') as f:
+        assert f.read() == b'BBB'
+
+
+def test_walk_files_shard(tmpdir):
+    for i in range(20):
+        tmpdir.join('file{}.txt'.format(i)).write_binary(b'x')
+
+    all_files = sorted(FileSource(tmpdir.strpath).walk_files())
+    shards = [sorted(FileSource(tmpdir.strpath, shard=(i, 3)).walk_files())
+              for i in range(1, 4)]
+    assert sorted(sum(shards, [])) == all_files
+    assert all(shards)
+    assert shards[0] == sorted(FileSource(tmpdir.strpath, shard=(1, 3)).walk_files())
+
+    with pytest.raises(ValueError):
+        FileSource(tmpdir.strpath, shard=(0, 3))
+    with pytest.raises(ValueError):
+        FileSource(tmpdir.strpath, shard=(4, 3))
+
+
+def test_rewrite_references(tmpdir):
+    src = tmpdir.join('src')
+    src.mkdir()
+    src.join('img').mkdir()
+    src.join('img', 'logo.png').write_binary(b'logo')
+    src.join('img', 'my icon.png').write_binary(b'icon')
+    src.join('fonts').mkdir()
+    src.join('fonts', 'a.woff').write_binary(b'font')
+    src.join('css').mkdir()
+    src.join('css', 'base.css').write_binary(
+        b'.logo { background: url("../img/logo.png"); }\n'
+        b'.icon { background: url(../img/my%20icon.png); }\n'
+        b"@font-face { src: url('../fonts/a.woff?#iefix') format('woff'); }\n"
+        b'.x { background: url(data:image/png;base64,AAAA); }\n'
+        b'.y { background: url(/img/logo.png) url(missing.png); }\n')
+    src.join('css', 'main.css').write_binary(
+        b'@import "base.css";\nbody { background: url(../img/logo.png); }\n')
+    src.join('index.html').write_binary(
+        b'<link rel="stylesheet" href="css/main.css">\n'
+        b'<img src=img/logo.png> <a href="index.html#top">top</a>\n'
+        b'<div style="background: url(\'img/logo.png\')"></div>\n')
+
+    s = FileSource(src.strpath, cache_key_map=False, rewrite_css=True,
+                   rewrite_html=True)
+    key_map = s.build_key_map()
+    logo = key_map['img/logo.png']
+    assert logo == FileSource(src.strpath).build_key_map()['img/logo.png']
+
+    with s.open('css/base.css') as f:
+        base = f.read().decode('utf-8')
+    assert base == (
+        '.logo { background: url("../' + logo + '"); }\n'
+        '.icon { background: url(../' +
+        key_map['img/my icon.png'].replace(' ', '%20') + '); }\n'
+        "@font-face { src: url('../" + key_map['fonts/a.woff'] +
+        "?#iefix') format('woff'); }\n"
+        '.x { background: url(data:image/png;base64,AAAA); }\n'
+        '.y { background: url(/img/logo.png) url(missing.png); }\n')
+    assert key_map['css/base.css'] == s.make_key(
+        'css/base.css', hashlib.sha1(base.encode('utf-8')).hexdigest())
+
+    # Dependencies are keyed first, so main.css refers to base.css's new key
+    with s.open('css/main.css') as f:
+        assert f.read() == ('@import "' +
+                            key_map['css/base.css'].split('/')[1] +
+                            '";\nbody { background: url(../' + logo +
+                            '); }\n').encode('utf-8')
+    with s.open('index.html') as f:
+        assert f.read() == (
+            '<link rel="stylesheet" href="' + key_map['css/main.css'] + '">\n'
+            '<img src=' + logo + '> <a href="index.html#top">top</a>\n'
+            '<div style="background: url(\'' + logo + '\')"></div>\n'
+        ).encode('utf-8')
+
+    # Unchanged files aren't hashed again, but a changed dependency
+    # changes the keys of the files that refer to it
+    bytes_hashed = s.bytes_hashed
+    assert s.build_key_map() == key_map
+    assert s.bytes_hashed - bytes_hashed == 12  # only the images and font
+    src.join('img', 'logo.png').write_binary(b'new logo')
+    new_key_map = s.build_key_map()
+    assert new_key_map['img/logo.png'] != logo
+    assert new_key_map['fonts/a.woff'] == key_map['fonts/a.woff']
+    for rel_path in ['css/base.css', 'css/main.css', 'index.html']:
+        assert new_key_map[rel_path] != key_map[rel_path]
+
+    # Cycles are reported but don't stop the build
+    src.join('css', 'base.css').write_binary(b'@import "main.css";')
+    key_map = s.build_key_map()
+    with s.open('css/base.css') as f:
+        assert f.read() == b'@import "main.css";'
+
+    # Rewriting is off by default, and files are opened as usual
+    s = FileSource(src.strpath)
+    with s.open('css/base.css') as f:
+        assert f.read() == b'@import "main.css";'
+
+    # The key map is built if a rewritten file is opened first
+    s = FileSource(src.strpath, rewrite_css=True)
+    with s.open('css/main.css') as f:
+        assert b'img/logo_' in f.read()
+
+    with pytest.raises(ValueError):
+        FileSource(src.strpath, rewrite_css=True, shard=(1, 2))
@@ -0,0 +1,185 @@
+"""Test Hook interface and built-in hooks."""
+
+import json
+import pstats
+import threading
+
+import pytest
+
+from cdnupload import (Hook, MemoryHook, TraceHook, add_hook, delete, main,
+                       remove_hook, upload)
+
+
+class RecordingHook(Hook):
+    def __init__(self):
+        self.events = []
+
+    def action_start(self, action):
+        self.events.append(('action_start', action))
+
+    def action_end(self, action):
+        self.events.append(('action_end', action))
+
+    def walk_start(self, source):
+        self.events.append(('walk_start',))
+
+    def walk_end(self, source, num_files):
+        self.events.append(('walk_end', num_files))
+
+    def hash_start(self, rel_path):
+        self.events.append(('hash_start', rel_path))
+
+    def hash_end(self, rel_path, num_bytes):
+        self.events.append(('hash_end', rel_path, num_bytes))
+
+    def list_start(self, destination):
+        self.events.append(('list_start',))
+
+    def list_end(self, destination, num_keys):
+        self.events.append(('list_end', num_keys))
+
+    def upload_start(self, key, rel_path):
+        self.events.append(('upload_start', key, rel_path))
+
+    def upload_end(self, key, rel_path, num_bytes):
+        self.events.append(('upload_end', key, rel_path, num_bytes))
+
+    def delete_start(self, key):
+        self.events.append(('delete_start', key))
+
+    def delete_end(self, key):
+        self.events.append(('delete_end', key))
+
+
+def test_hooks(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'file.txt').write_binary(b'file.txt')
+    dest = tmpdir.join('dest')
+    dest.mkdir()
+    dest.join('old_1234.txt').write_binary(b'old')
+
+    hook = RecordingHook()
+    add_hook(hook)
+    try:
+        upload(tmpdir.join('src').strpath, dest.strpath)
+        delete(tmpdir.join('src').strpath, dest.strpath)
+    finally:
+        remove_hook(hook)
+
+    assert hook.events == [
+        ('action_start', 'upload'),
+        ('walk_start',),
+        ('hash_start', 'file.txt'),
+        ('hash_end', 'file.txt', 8),
+        ('walk_end', 1),
+        ('list_start',),
+        ('list_end', 1),
+        ('upload_start', 'file_5436437fa01a7d3e.txt', 'file.txt'),
+        ('upload_end', 'file_5436437fa01a7d3e.txt', 'file.txt', 8),
+        ('action_end', 'upload'),
+        ('action_start', 'delete'),
+        ('walk_start',),
+        ('hash_start', 'file.txt'),
+        ('hash_end', 'file.txt', 8),
+        ('walk_end', 1),
+        ('list_start',),
+        ('list_end', 2),
+        ('delete_start', 'old_1234.txt'),
+        ('delete_end', 'old_1234.txt'),
+        ('action_end', 'delete'),
+    ]
+
+    upload(tmpdir.join('src').strpath, dest.strpath)
+    assert len(hook.events) == 20
+    with pytest.raises(ValueError):
+        remove_hook(hook)
+
+
+def test_trace_hook(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'file.txt').write_binary(b'file.txt')
+    tmpdir.join('dest').mkdir()
+    trace_path = tmpdir.join('trace.json').strpath
+
+    hook = TraceHook(trace_path)
+    add_hook(hook)
+    try:
+        upload(tmpdir.join('src').strpath, tmpdir.join('dest').strpath)
+    finally:
+        remove_hook(hook)
+
+    with open(trace_path) as f:
+        trace = json.load(f)
+    events = [(e['ph'], e['cat']) for e in trace['traceEvents']]
+    assert events == [
+        ('B', 'action'),
+        ('B', 'walk'),
+        ('B', 'hash'),
+        ('E', 'hash'),
+        ('E', 'walk'),
+        ('B', 'list'),
+        ('i', 'list'),
+        ('E', 'list'),
+        ('B', 'upload'),
+        ('E', 'upload'),
+        ('E', 'action'),
+    ]
+    timestamps = [e['ts'] for e in trace['traceEvents']]
+    assert timestamps == sorted(timestamps)
+
+
+def test_main_profile(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'file.txt').write_binary(b'file.txt')
+    profile_path = tmpdir.join('out.prof').strpath
+    assert main([tmpdir.join('src').strpath, tmpdir.join('dest').strpath,
+                 '--profile', profile_path, '--trace-memory', '-l', 'off']) == 0
+    stats = pstats.Stats(profile_path)
+    assert any(func[2] == 'build_key_map' for func in stats.stats)
+
+
+def test_memory_hook_threads():
+    class MockTracemalloc(object):
+        def __init__(self):
+            self.tracing = False
+            self.num_starts = 0
+
+        def start(self):
+            assert not self.tracing
+            self.tracing = True
+            self.num_starts += 1
+
+        def get_traced_memory(self):
+            assert self.tracing
+            return (0, 1024)
+
+        def stop(self):
+            assert self.tracing
+            self.tracing = False
+
+    hook = MemoryHook()
+    hook.tracemalloc = MockTracemalloc()
+    errors = []
+
+    # Actions on several threads (for example, one per destination) nest
+    # rather than starting or stopping tracing twice
+    def run_actions():
+        try:
+            for _ in range(200):
+                hook.action_start('upload')
+                hook.action_end('upload')
+        except AssertionError as error:
+            errors.append(error)
+
+    hook.action_start('sync')
+    threads = [threading.Thread(target=run_actions) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert hook.tracemalloc.tracing
+    hook.action_end('sync')
+    assert errors == []
+    assert hook.tracemalloc.num_starts == 1
+    assert not hook.tracemalloc.tracing
+    assert hook.peak == 1024
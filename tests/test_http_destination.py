@@ -0,0 +1,114 @@
+"""Test HTTPDestination class against the stand-in origin server."""
+
+import io
+import os
+import sys
+
+import pytest
+
+from cdnupload import (DestinationError, FileSource, HTTPDestination,
+                       get_destination_class, upload, delete)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+import http_origin
+
+
+@pytest.fixture
+def origin():
+    server = http_origin.Origin(page_size=2).start()
+    yield server
+    server.stop()
+
+
+def test_init():
+    d = HTTPDestination('http://example.com:8080/static')
+    assert str(d) == 'http://example.com:8080/static/'
+    assert (d.host, d.port, d.path) == ('example.com', 8080, '/static/')
+    assert d.list_url == 'http://example.com:8080/static/'
+    assert d.headers == {'Cache-Control': 'public, max-age=31536000'}
+    assert get_destination_class('https://example.com/') is HTTPDestination
+
+    d = HTTPDestination('https://example.com/', list_url='/_list?all=1',
+                        headers=['X-Token: abc', 'X-Other:def'],
+                        cache_control=None, username='user', password='pw',
+                        keep_alive='false')
+    assert d.list_url == 'https://example.com/_list?all=1'
+    assert d.headers == {'X-Token': 'abc', 'X-Other': 'def',
+                         'Authorization': 'Basic dXNlcjpwdw=='}
+    assert not d.keep_alive
+
+    with pytest.raises(ValueError):
+        HTTPDestination('ftp://example.com/')
+    with pytest.raises(ValueError):
+        HTTPDestination('http://example.com/', list_url='http://other.com/')
+    with pytest.raises(ValueError):
+        HTTPDestination('http://example.com/', headers='no colon')
+    with pytest.raises(TypeError):
+        HTTPDestination('http://example.com/', workers='many')
+
+
+def test_upload_and_delete(tmpdir, origin):
+    tmpdir.join('src').mkdir()
+    for name in ['a.css', 'b.js', 'c d.txt', 'e.png']:
+        tmpdir.join('src', name).write_binary(name.encode('ascii') * 1000)
+    s = tmpdir.join('src').strpath
+    d = HTTPDestination(origin.url + 'static', list_url='/_list', workers=4)
+
+    result = upload(s, d, workers=4)
+    assert result.num_uploaded == 4
+    for rel_path, key in result.source_key_map.items():
+        content = origin.objects['/static/' + key]
+        assert content == rel_path.encode('ascii') * 1000
+    assert sorted(d.walk_keys()) == sorted(result.source_key_map.values())
+    methods = [r[0] for r in origin.requests]
+    assert methods.count('PUT') == 4
+    put_headers = [r[2] for r in origin.requests if r[0] == 'PUT']
+    assert all(h['Cache-Control'] == 'public, max-age=31536000'
+               for h in put_headers)
+    assert sorted(h['Content-Type'] for h in put_headers) == [
+        'application/javascript', 'image/png', 'text/css', 'text/plain']
+
+    # Connections are reused, and at most "workers" are kept open
+    stats = d.connection_stats()
+    assert stats['requests'] == origin.num_requests
+    assert stats['connections'] == origin.num_connections <= 4
+    assert stats['reused'] == stats['requests'] - stats['connections'] > 0
+
+    tmpdir.join('src', 'a.css').remove()
+    result = delete(s, d)
+    assert result.num_deleted == 1
+    assert len(origin.objects) == 3
+    d.delete('not-there.txt')
+
+
+def test_upload_chunked(origin):
+    class StreamSource(object):
+        def open(self, rel_path):
+            # Size of a non-seekable stream isn't known, so it's chunked
+            return io.BufferedReader(io.BytesIO(b'x' * 100000))
+
+    d = HTTPDestination(origin.url, chunk_size=30000)
+    d.upload('stream.bin', StreamSource(), 'stream.bin')
+    assert origin.objects['/stream.bin'] == b'x' * 100000
+    assert origin.requests[-1][2]['Transfer-Encoding'] == 'chunked'
+
+
+def test_stale_connection(tmpdir, origin):
+    tmpdir.join('a.txt').write_binary(b'a' * 1000)
+    s = FileSource(tmpdir.strpath)
+    d = HTTPDestination(origin.url)
+    d.upload('a1.txt', s, 'a.txt')
+    # Simulate the server closing an idle keep-alive connection
+    d._pool[0].sock.close()
+    d.upload('a2.txt', s, 'a.txt')
+    assert origin.objects['/a2.txt'] == b'a' * 1000
+    assert d.connection_stats()['connections'] == 2
+
+
+def test_errors(tmpdir, origin):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'a.txt').write_binary(b'a')
+    d = HTTPDestination(origin.url, list_url='/not-a-listing')
+    with pytest.raises(DestinationError):
+        upload(tmpdir.join('src').strpath, d)
@@ -0,0 +1,32 @@
+"""Test that importing cdnupload stays lightweight."""
+
+import os
+import subprocess
+import sys
+
+from cdnupload import _guess_content_type
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that should only be imported by the actions that need them
+LAZY_MODULES = ['argparse', 'json', 'mimetypes', 'hashlib', 'shutil',
+                'fnmatch', 'urllib.parse', 'urlparse']
+
+
+def test_import_is_lazy():
+    code = ('import sys, cdnupload; '
+            'print(" ".join(m for m in {!r} if m in sys.modules))'.format(
+                LAZY_MODULES))
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+    assert output.decode('ascii').split() == []
+
+
+def test_guess_content_type():
+    assert _guess_content_type('style.css') == 'text/css'
+    assert _guess_content_type('js/app.min.js') == 'application/javascript'
+    assert _guess_content_type('IMAGE.PNG') == 'image/png'
+    assert _guess_content_type('font.woff2') == 'font/woff2'
+    assert _guess_content_type('no_extension') is None
+    # Falls back to the mimetypes module for less common extensions
+    assert _guess_content_type('movie.mpeg') == 'video/mpeg'
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""Test write_key_map() formats and the KeyMap index reader."""
+
+from __future__ import unicode_literals
+
+import json
+import os
+import sqlite3
+
+import pytest
+
+from cdnupload import (KeyMap, KeyMapError, diff_key_maps, main,
+                       make_import_map, make_preload_links, read_key_map,
+                       split_key_map, write_key_map)
+
+
+KEY_MAP = {
+    'a.txt': 'a_0123456789abcdef.txt',
+    'images/logo.png': 'images/logo_fedcba9876543210.png',
+    'images/b.png': 'images/b_1111111111111111.png',
+    'unicodé.css': 'unicodé_2222222222222222.css',
+}
+
+
+def test_write_json(tmpdir):
+    path = tmpdir.join('key_map.json').strpath
+    write_key_map(KEY_MAP, path)
+    with open(path) as f:
+        assert json.load(f) == KEY_MAP
+    with open(path) as f:
+        assert f.read() == json.dumps(KEY_MAP, sort_keys=True, indent=4)
+
+    write_key_map({}, path)
+    with open(path) as f:
+        assert f.read() == '{}'
+    assert os.listdir(tmpdir.strpath) == ['key_map.json']
+
+
+@pytest.mark.parametrize('format', ['json', 'index', 'sqlite'])
+def test_read_key_map(tmpdir, format):
+    path = tmpdir.join('key_map').strpath
+    write_key_map(KEY_MAP, path, format=format)
+    assert read_key_map(path) == KEY_MAP
+
+
+def test_diff_key_maps():
+    old = {'a': 'a_1', 'b': 'b_1', 'c': 'c_1'}
+    new = {'a': 'a_1', 'b': 'b_2', 'd': 'd_2'}
+    assert diff_key_maps(old, new) == {
+        'added': {'d': 'd_2'},
+        'changed': {'b': 'b_2'},
+        'removed': ['c'],
+    }
+    assert diff_key_maps(new, new) == {'added': {}, 'changed': {},
+                                       'removed': []}
+
+
+def test_write_sqlite(tmpdir):
+    path = tmpdir.join('key_map.sqlite').strpath
+    write_key_map(KEY_MAP, path, format='sqlite',
+                  metadata={'hash_algorithm': 'blake2b'})
+    connection = sqlite3.connect(path)
+    try:
+        rows = connection.execute('SELECT path, key FROM key_map').fetchall()
+        metadata = connection.execute('SELECT name, value FROM metadata').fetchall()
+    finally:
+        connection.close()
+    assert dict(rows) == KEY_MAP
+    assert metadata == [('hash_algorithm', 'blake2b')]
+    assert os.listdir(tmpdir.strpath) == ['key_map.sqlite']
+
+
+def test_write_bad_format(tmpdir):
+    with pytest.raises(ValueError):
+        write_key_map(KEY_MAP, tmpdir.join('key_map').strpath, format='xml')
+
+
+def test_key_map(tmpdir):
+    path = tmpdir.join('key_map.index').strpath
+    write_key_map(KEY_MAP, path, format='index')
+    km = KeyMap(path)
+
+    assert len(km) == 4
+    for rel_path, key in KEY_MAP.items():
+        assert km[rel_path] == key
+        assert km.get(rel_path) == key
+        assert rel_path in km
+    assert km.get(b'a.txt') == 'a_0123456789abcdef.txt'
+    for missing in ['', 'a', 'b.txt', 'images/', 'zzz']:
+        assert missing not in km
+        assert km.get(missing) is None
+        assert km.get(missing, 'x') == 'x'
+        with pytest.raises(KeyError):
+            km[missing]
+    assert list(km) == sorted(KEY_MAP, key=lambda p: p.encode('utf-8'))
+    assert dict(km.items()) == KEY_MAP
+
+
+def test_key_map_empty(tmpdir):
+    path = tmpdir.join('key_map.index').strpath
+    write_key_map({}, path, format='index')
+    km = KeyMap(path)
+    assert len(km) == 0
+    assert 'a.txt' not in km
+    assert list(km) == []
+
+
+def test_key_map_reload(tmpdir):
+    path = tmpdir.join('key_map.index').strpath
+    write_key_map({'a.txt': 'a_1.txt'}, path, format='index')
+    km = KeyMap(path, reload_interval=None)
+    assert km['a.txt'] == 'a_1.txt'
+    assert not km.reload()
+
+    write_key_map({'a.txt': 'a_2.txt', 'b.txt': 'b_2.txt'}, path,
+                  format='index')
+    # Not reloaded automatically with reload_interval=None
+    assert km['a.txt'] == 'a_1.txt'
+    assert km.reload()
+    assert km['a.txt'] == 'a_2.txt'
+    assert len(km) == 2
+
+    km = KeyMap(path, reload_interval=0)
+    write_key_map({'c.txt': 'c_3.txt'}, path, format='index')
+    assert km['c.txt'] == 'c_3.txt'
+    assert 'a.txt' not in km
+
+
+def test_key_map_invalid(tmpdir):
+    path = tmpdir.join('key_map.json').strpath
+    write_key_map(KEY_MAP, path)
+    with pytest.raises(KeyMapError):
+        KeyMap(path)
+
+    # Empty or short files, as seen partway through a non-atomic copy
+    path = tmpdir.join('key_map.index').strpath
+    write_key_map(KEY_MAP, path, format='index')
+    km = KeyMap(path, reload_interval=None)
+    for data in [b'', b'x']:
+        tmpdir.join('key_map.index').write_binary(data)
+        with pytest.raises(KeyMapError):
+            KeyMap(path)
+        with pytest.raises(KeyMapError):
+            km.reload()
+
+
+def test_main_key_map_format(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'a.txt').write_binary(b'a')
+    key_map_path = tmpdir.join('key_map.index').strpath
+    assert main([tmpdir.join('src').strpath, tmpdir.join('dest').strpath,
+                 '--key-map', key_map_path,
+                 '--key-map-format', 'index']) == 0
+    assert dict(KeyMap(key_map_path).items()) == {
+        'a.txt': 'a_86f7e437faa5a7fc.txt',
+    }
+
+    with pytest.raises(SystemExit):
+        main([tmpdir.join('src').strpath, tmpdir.join('dest').strpath,
+              '--key-map', key_map_path, '--key-map-format', 'index',
+              '--shard', '1/2'])
+
+
+def test_main_key_map_diff(tmpdir):
+    src = tmpdir.join('src')
+    src.mkdir()
+    src.join('a.txt').write_binary(b'a')
+    src.join('b.txt').write_binary(b'b')
+    key_map_path = tmpdir.join('key_map.json').strpath
+    diff_path = tmpdir.join('diff.json').strpath
+    args = [src.strpath, tmpdir.join('dest').strpath, '--key-map',
+            key_map_path, '--key-map-diff', diff_path]
+
+    assert main(args) == 0
+    with open(diff_path) as f:
+        assert json.load(f) == {
+            'added': {'a.txt': 'a_86f7e437faa5a7fc.txt',
+                      'b.txt': 'b_e9d71f5ee7c92d6d.txt'},
+            'changed': {},
+            'removed': [],
+        }
+
+    src.join('a.txt').write_binary(b'A')
+    src.join('b.txt').remove()
+    src.join('c.txt').write_binary(b'c')
+    assert main(args) == 0
+    with open(diff_path) as f:
+        assert json.load(f) == {
+            'added': {'c.txt': 'c_84a516841ba77a5b.txt'},
+            'changed': {'a.txt': 'a_6dcd4ce23d88e2ee.txt'},
+            'removed': ['b.txt'],
+        }
+
+    with pytest.raises(SystemExit):
+        main([src.strpath, tmpdir.join('dest').strpath,
+              '--key-map-diff', diff_path])
+
+
+def test_split_key_map():
+    split = split_key_map(KEY_MAP)
+    assert list(split) == ['_root', 'images']
+    assert split['_root'] == {'a.txt': 'a_0123456789abcdef.txt',
+                              'unicodé.css': 'unicodé_2222222222222222.css'}
+    assert split['images'] == {
+        'images/logo.png': 'images/logo_fedcba9876543210.png',
+        'images/b.png': 'images/b_1111111111111111.png',
+    }
+
+    split = split_key_map(KEY_MAP, sections=[('logos', '*/logo*'),
+                                             ('text', '*.txt')])
+    assert list(split) == ['_root', 'images', 'logos', 'text']
+    assert list(split['logos']) == ['images/logo.png']
+    assert list(split['text']) == ['a.txt']
+
+
+def test_make_import_map_and_preload_links():
+    key_map = {
+        'app.js': 'app_0123456789abcdef.js',
+        'lib/util.mjs': 'lib/util_1111111111111111.mjs',
+        'style.css': 'style_2222222222222222.css',
+        'fonts/a.woff2': 'fonts/a_3333333333333333.woff2',
+        'data.bin': 'data_4444444444444444.bin',
+    }
+    assert make_import_map(key_map, url_prefix='/static/') == {'imports': {
+        '/static/app.js': '/static/app_0123456789abcdef.js',
+        '/static/lib/util.mjs': '/static/lib/util_1111111111111111.mjs',
+    }}
+    assert make_import_map(key_map, entry_points=['lib/*']) == {'imports': {
+        'lib/util.mjs': 'lib/util_1111111111111111.mjs',
+    }}
+
+    links = make_preload_links(key_map, ['*.js', '*.mjs', '*.css', 'fonts/*',
+                                         'data.bin'], url_prefix='https://cdn/')
+    assert links.splitlines() == [
+        '<link rel="preload" href="https://cdn/app_0123456789abcdef.js" '
+        'as="script">',
+        '<link rel="preload" href="https://cdn/data_4444444444444444.bin" '
+        'as="fetch" crossorigin>',
+        '<link rel="preload" href="https://cdn/fonts/a_3333333333333333.woff2" '
+        'as="font" crossorigin>',
+        '<link rel="modulepreload" '
+        'href="https://cdn/lib/util_1111111111111111.mjs">',
+        '<link rel="preload" href="https://cdn/style_2222222222222222.css" '
+        'as="style">',
+    ]
+    assert make_preload_links(key_map, []) == ''
+
+
+def test_main_key_map_shards(tmpdir):
+    src = tmpdir.join('src')
+    src.mkdir()
+    src.join('app.js').write_binary(b'app')
+    src.join('images').mkdir()
+    src.join('images', 'a.png').write_binary(b'a')
+    src.join('images', 'icons').mkdir()
+    src.join('images', 'icons', 'b.png').write_binary(b'b')
+    dest = tmpdir.join('dest')
+    key_map_path = tmpdir.join('key_map.json').strpath
+    shards_path = tmpdir.join('shards.json').strpath
+    import_map_path = tmpdir.join('import_map.json').strpath
+    preload_path = tmpdir.join('preload.html').strpath
+    args = [src.strpath, dest.strpath, '--key-map', key_map_path,
+            '--key-map-shards', shards_path,
+            '--key-map-section', 'icons=images/icons/*',
+            '--import-map', import_map_path, '--preload', preload_path,
+            '--entry-point', '*.js', '--url-prefix', '/s/', '-l', 'off']
+    assert main(args) == 0
+
+    with open(key_map_path) as f:
+        key_map = json.load(f)
+    with open(shards_path) as f:
+        index = json.load(f)
+    assert index['sections'] == [['icons', 'images/icons/*']]
+    assert sorted(index['shards']) == ['_root', 'icons', 'images']
+    for name, key in index['shards'].items():
+        assert key == key_map['key-map/{}.json'.format(name)]
+        with open(dest.join(key).strpath) as f:
+            shard = json.load(f)
+        assert shard == split_key_map(
+            {p: k for p, k in key_map.items() if not p.startswith('key-map/')},
+            sections=[('icons', 'images/icons/*')])[name]
+    assert json.loads(dest.join(index['shards']['icons']).read()) == {
+        'images/icons/b.png': 'images/icons/b_e9d71f5ee7c92d6d.png'}
+
+    with open(import_map_path) as f:
+        assert json.load(f) == {'imports': {
+            '/s/app.js': '/s/' + key_map['app.js']}}
+    with open(preload_path) as f:
+        assert f.read() == ('<link rel="preload" href="/s/{}" '
+                            'as="script">\n'.format(key_map['app.js']))
+
+    # Shards are kept when deleting, and changed shards get new keys
+    src.join('images', 'a.png').write_binary(b'A')
+    assert main(args + ['-a', 'sync']) == 0
+    with open(shards_path) as f:
+        new_index = json.load(f)
+    assert new_index['shards']['icons'] == index['shards']['icons']
+    assert new_index['shards']['images'] != index['shards']['images']
+    assert dest.join(new_index['shards']['images']).check()
+    assert not dest.join(index['shards']['images']).check()
+
+    with pytest.raises(SystemExit):
+        main([src.strpath, dest.strpath, '--preload', preload_path])
+    with pytest.raises(SystemExit):
+        main([src.strpath, dest.strpath, '--key-map-section', 'x'])
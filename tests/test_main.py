@@ -0,0 +1,263 @@
+"""Test main() command line entry point."""
+
+import json
+import os
+import stat
+import sys
+import threading
+import time
+
+import pytest
+
+from cdnupload import (KeyMapError, _peer_uid, _serve, main, merge_key_maps,
+                       shard_index)
+
+
+def list_files(top):
+    lst = []
+    for root, dirs, files in os.walk(top):
+        for file in files:
+            full_path = os.path.join(root, file)
+            rel_path = os.path.relpath(full_path, top)
+            lst.append(rel_path.replace('\\', '/'))
+    lst.sort()
+    return lst
+
+
+def test_shard_index():
+    assert shard_index('images/logo.png', 1) == 1
+    assert shard_index('images/logo.png', 4) == shard_index(b'images/logo.png', 4)
+    assert {shard_index('file{}'.format(i), 4) for i in range(100)} == {1, 2, 3, 4}
+
+
+def test_merge_key_maps():
+    assert merge_key_maps([
+        {'cdnupload_shard': [2, 2], 'key_map': {'b': 'b_2'}},
+        {'cdnupload_shard': [1, 2], 'key_map': {'a': 'a_1'}},
+    ]) == {'a': 'a_1', 'b': 'b_2'}
+
+    with pytest.raises(KeyMapError):
+        merge_key_maps([{'cdnupload_shard': [1, 2], 'key_map': {'a': 'a_1'}}])
+    with pytest.raises(KeyMapError):
+        merge_key_maps([
+            {'cdnupload_shard': [1, 2], 'key_map': {}},
+            {'cdnupload_shard': [1, 2], 'key_map': {}},
+        ])
+    with pytest.raises(KeyMapError):
+        merge_key_maps([
+            {'cdnupload_shard': [1, 1], 'key_map': {}},
+            {'cdnupload_shard': [2, 2], 'key_map': {}},
+        ])
+    with pytest.raises(KeyMapError):
+        merge_key_maps([{'a': 'a_1'}])
+    with pytest.raises(KeyMapError):
+        merge_key_maps([
+            {'cdnupload_shard': [1, 2], 'hash_algorithm': 'sha1',
+             'key_map': {}},
+            {'cdnupload_shard': [2, 2], 'hash_algorithm': 'blake2b',
+             'key_map': {}},
+        ])
+
+
+def test_main_shards(tmpdir):
+    tmpdir.join('src').mkdir()
+    for i in range(10):
+        tmpdir.join('src', 'file{}.txt'.format(i)).write_binary(b'x')
+    src = tmpdir.join('src').strpath
+    dest = tmpdir.join('dest').strpath
+
+    partials = []
+    for i in range(1, 4):
+        partial = tmpdir.join('partial{}.json'.format(i)).strpath
+        partials.append(partial)
+        assert main([src, dest, '--shard={}/3'.format(i), '--key-map', partial,
+                     '--log-level=off']) == 0
+    assert len(list_files(dest)) == 10
+
+    key_map_path = tmpdir.join('key_map.json').strpath
+    assert main(partials[:2] + ['-a', 'merge-key-maps', '-k', key_map_path,
+                                '-l', 'off']) == 1
+    assert not os.path.exists(key_map_path)
+    assert main(partials + ['-a', 'merge-key-maps', '-k', key_map_path,
+                            '-l', 'off']) == 0
+    with open(key_map_path) as f:
+        key_map = json.load(f)
+    assert sorted(key_map) == ['file{}.txt'.format(i) for i in range(10)]
+    assert sorted(key_map.values()) == list_files(dest)
+
+    with pytest.raises(SystemExit):
+        main([src, dest, '--shard=1/3', '-a', 'delete'])
+    with pytest.raises(SystemExit):
+        main([src, dest, '--shard=4/3'])
+
+
+def test_main_rate_limits(tmpdir):
+    tmpdir.join('src').mkdir()
+    for i in range(3):
+        tmpdir.join('src', 'file{}.txt'.format(i)).write_binary(b'x' * 100)
+    src = tmpdir.join('src').strpath
+    dest = tmpdir.join('dest').strpath
+    stats_path = tmpdir.join('stats.json').strpath
+
+    assert main([src, dest, '--max-bandwidth=1000000',
+                 '--max-requests-per-second=100', '--workers=2',
+                 '--stats-json', stats_path, '-l', 'off']) == 0
+    assert len(list_files(dest)) == 3
+    with open(stats_path) as f:
+        stats = json.load(f)
+    assert stats[0]['throttle']['waits'] == 0
+
+    with pytest.raises(SystemExit):
+        main([src, dest, '--max-bandwidth=0'])
+    with pytest.raises(SystemExit):
+        main([src, dest, '--max-requests-per-second=-1'])
+
+
+def test_main_fingerprint_cache(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'a.txt').write_binary(b'a')
+    src = tmpdir.join('src').strpath
+    dest = tmpdir.join('dest').strpath
+    cache_path = tmpdir.join('fingerprints.json').strpath
+
+    for extra_args in [[], ['--full-rescan']]:
+        assert main([src, dest, '--fingerprint-cache', cache_path,
+                     '-l', 'off'] + extra_args) == 0
+        assert os.path.exists(cache_path)
+        assert list_files(dest) == ['a_86f7e437faa5a7fc.txt']
+
+    with pytest.raises(SystemExit):
+        main([src, dest, '--full-rescan'])
+
+
+def test_main_key_map_action(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'a.txt').write_binary(b'a')
+    key_map_path = tmpdir.join('key_map.json').strpath
+    assert main([tmpdir.join('src').strpath, '-a', 'key-map',
+                 '--key-map', key_map_path, '-l', 'off']) == 0
+    with open(key_map_path) as f:
+        assert json.load(f) == {'a.txt': 'a_86f7e437faa5a7fc.txt'}
+
+    with pytest.raises(SystemExit):
+        main([tmpdir.join('src').strpath, '-a', 'key-map'])
+
+
+def test_main_daemon(tmpdir, monkeypatch):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'a.txt').write_binary(b'a')
+    src = tmpdir.join('src').strpath
+    dest = tmpdir.join('dest').strpath
+    socket_path = tmpdir.join('d.sock').strpath
+
+    # No daemon listening, so the action is run here
+    assert main([src, dest, '--daemon-socket', socket_path, '-l', 'off']) == 0
+    assert list_files(dest) == ['a_86f7e437faa5a7fc.txt']
+
+    stop = threading.Event()
+    thread = threading.Thread(target=_serve, args=(socket_path,),
+                              kwargs={'_stop': stop})
+    thread.start()
+    try:
+        while not os.path.exists(socket_path):
+            time.sleep(0.01)
+        # Only the daemon's own user may connect
+        assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+        args = ['--daemon-socket', socket_path, '-l', 'off']
+
+        tmpdir.join('src', 'b.txt').write_binary(b'b')
+        assert main([src, dest] + args) == 0
+        assert list_files(dest) == ['a_86f7e437faa5a7fc.txt',
+                                    'b_e9d71f5ee7c92d6d.txt']
+
+        # The daemon doesn't list the destination again, so it doesn't
+        # notice keys removed behind its back (unless forced)
+        os.remove(os.path.join(dest, 'b_e9d71f5ee7c92d6d.txt'))
+        assert main([src, dest] + args) == 0
+        assert list_files(dest) == ['a_86f7e437faa5a7fc.txt']
+        assert main([src, dest, '--force'] + args) == 0
+        assert list_files(dest) == ['a_86f7e437faa5a7fc.txt',
+                                    'b_e9d71f5ee7c92d6d.txt']
+
+        tmpdir.join('src', 'a.txt').remove()
+        assert main([src, dest, '-a', 'delete'] + args) == 0
+        assert list_files(dest) == ['b_e9d71f5ee7c92d6d.txt']
+
+        # Relative paths are relative to the client's current directory
+        monkeypatch.chdir(tmpdir.strpath)
+        assert main(['src', '-a', 'key-map', '--key-map', 'key_map.json'] +
+                    args) == 0
+        with open(tmpdir.join('key_map.json').strpath) as f:
+            assert json.load(f) == {'b.txt': 'b_e9d71f5ee7c92d6d.txt'}
+
+        # Usage errors are written to the client's stderr, not the daemon's
+        writes = []
+
+        class ThreadStderr(object):
+            def write(self, text):
+                writes.append((threading.current_thread(), text))
+
+            def flush(self):
+                pass
+
+        old_stderr = sys.stderr
+        sys.stderr = ThreadStderr()
+        try:
+            assert main(['src', 'foo://bar'] + args) == 2
+        finally:
+            sys.stderr = old_stderr
+        assert writes
+        assert all(t is threading.current_thread() for t, _ in writes)
+        output = ''.join(text for _, text in writes)
+        assert output.startswith('usage: ')
+        assert "error: can't import handler for scheme 'foo'" in output
+
+        # A second daemon on the same socket refuses to start
+        assert _serve(socket_path) == 1
+    finally:
+        stop.set()
+        thread.join()
+    assert not os.path.exists(socket_path)
+
+
+def test_main_daemon_content_cache(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'a.txt').write_binary(b'one')
+    src = tmpdir.join('src').strpath
+    dest = tmpdir.join('dest').strpath
+    socket_path = tmpdir.join('d.sock').strpath
+
+    stop = threading.Event()
+    thread = threading.Thread(target=_serve, args=(socket_path,),
+                              kwargs={'_stop': stop})
+    thread.start()
+    try:
+        while not os.path.exists(socket_path):
+            time.sleep(0.01)
+        args = [src, dest, '--daemon-socket', socket_path,
+                '--content-cache-size', '100000', '-l', 'off']
+        assert main(args) == 0
+        assert list_files(dest) == ['a_fe05bcdcdc492801.txt']
+
+        # A changed file gets a new key and its new contents are uploaded
+        tmpdir.join('src', 'a.txt').write_binary(b'three')
+        assert main(args) == 0
+        assert list_files(dest) == ['a_b802f384302cb24f.txt',
+                                    'a_fe05bcdcdc492801.txt']
+        assert tmpdir.join('dest', 'a_b802f384302cb24f.txt').read_binary() == \
+            b'three'
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_peer_uid():
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        pytest.skip('requires Unix domain sockets')
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        assert _peer_uid(a) in (None, os.getuid())
+    finally:
+        a.close()
+        b.close()
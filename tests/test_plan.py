@@ -0,0 +1,176 @@
+"""Test write_plan() and apply_plan() functions."""
+
+import json
+import os
+
+import pytest
+
+from cdnupload import (DeleteAllKeysError, FileDestination, FileSource,
+                       PlanError, SourceError, apply_plan, upload,
+                       write_plan)
+
+
+def list_files(top):
+    lst = []
+    for root, dirs, files in os.walk(top):
+        for file in files:
+            full_path = os.path.join(root, file)
+            rel_path = os.path.relpath(full_path, top)
+            lst.append(rel_path.replace('\\', '/'))
+    lst.sort()
+    return lst
+
+
+def test_write_plan(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'file.txt').write_binary(b'file.txt')
+    tmpdir.join('src', 'images').mkdir()
+    tmpdir.join('src', 'images', '1.jpg').write_binary(b'1.jpg')
+    tmpdir.join('dest').mkdir()
+    tmpdir.join('dest', 'file_5436437fa01a7d3e.txt').write_binary(b'file.txt')
+    tmpdir.join('dest', 'old_1234.txt').write_binary(b'old')
+
+    plan_path = tmpdir.join('plan.jsonl').strpath
+    result = write_plan(tmpdir.join('src').strpath, tmpdir.join('dest').strpath,
+                        plan_path)
+    assert (result.num_uploaded, result.num_deleted) == (1, 1)
+    assert list_files(tmpdir.join('dest').strpath) == [
+        'file_5436437fa01a7d3e.txt',
+        'old_1234.txt',
+    ]
+
+    with open(plan_path) as f:
+        lines = [json.loads(line) for line in f]
+    assert lines[0]['cdnupload_plan'] == 1
+    assert lines[0]['num_destination_keys'] == 2
+    assert lines[0]['hash_algorithm'] == 'sha1'
+    for line in lines[1:3]:
+        del line['mtime']
+    assert lines[1:] == [
+        {'path': 'file.txt', 'key': 'file_5436437fa01a7d3e.txt', 'size': 8},
+        {'path': 'images/1.jpg', 'key': 'images/1_accf102caaa970ce.jpg',
+         'size': 5, 'upload': True},
+        {'delete': 'old_1234.txt'},
+        {'end': True, 'num_files': 2, 'num_upload': 1, 'num_delete': 1},
+    ]
+
+
+def test_apply_plan(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'file.txt').write_binary(b'file.txt')
+    tmpdir.join('src', 'images').mkdir()
+    tmpdir.join('src', 'images', '1.jpg').write_binary(b'1.jpg')
+    dest = tmpdir.join('dest').strpath
+    upload(tmpdir.join('src').strpath, dest)
+    tmpdir.join('dest', 'old_1234.txt').write_binary(b'old')
+    tmpdir.join('src', 'file.txt').write_binary(b'changed')
+
+    plan_path = tmpdir.join('plan.jsonl').strpath
+    write_plan(tmpdir.join('src').strpath, dest, plan_path)
+
+    num_walks = [0]
+    def count_os_walk(*args, **kwargs):
+        num_walks[0] += 1
+        for root, dirs, files in os.walk(*args, **kwargs):
+            yield (root, dirs, files)
+
+    class NoListDestination(FileDestination):
+        def walk_keys(self):
+            raise Exception('should not list keys')
+
+    s = FileSource(tmpdir.join('src').strpath, _os_walk=count_os_walk)
+    d = NoListDestination(dest)
+    result = apply_plan(s, d, plan_path)
+    assert (result.num_uploaded, result.num_deleted, result.num_errors) == (1, 0, 0)
+    assert result.source_key_map == {
+        'file.txt': 'file_37c6c57bedf4305e.txt',
+        'images/1.jpg': 'images/1_accf102caaa970ce.jpg',
+    }
+    assert num_walks[0] == 0
+    assert list_files(dest) == [
+        'file_37c6c57bedf4305e.txt',
+        'file_5436437fa01a7d3e.txt',
+        'images/1_accf102caaa970ce.jpg',
+        'old_1234.txt',
+    ]
+
+    result = apply_plan(s, d, plan_path, delete=True, dry_run=True)
+    assert (result.num_uploaded, result.num_deleted) == (1, 2)
+    assert len(list_files(dest)) == 4
+
+    result = apply_plan(s, d, plan_path, delete=True)
+    assert (result.num_uploaded, result.num_deleted) == (1, 2)
+    assert list_files(dest) == [
+        'file_37c6c57bedf4305e.txt',
+        'images/1_accf102caaa970ce.jpg',
+    ]
+
+
+def test_apply_plan_verify(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'file.txt').write_binary(b'file.txt')
+    dest = tmpdir.join('dest').strpath
+    plan_path = tmpdir.join('plan.jsonl').strpath
+    write_plan(tmpdir.join('src').strpath, dest, plan_path)
+
+    with pytest.raises(PlanError):
+        apply_plan(FileSource(tmpdir.join('src').strpath,
+                              hash_algorithm='blake2b'),
+                   dest, plan_path, verify=True)
+
+    tmpdir.join('src', 'file.txt').write_binary(b'changed!!')
+    with pytest.raises(PlanError):
+        apply_plan(tmpdir.join('src').strpath, dest, plan_path, verify=True)
+    assert list_files(dest) == []
+
+
+def test_apply_plan_errors(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'file.txt').write_binary(b'file.txt')
+    tmpdir.join('other').mkdir()
+    tmpdir.join('other', 'other.txt').write_binary(b'other')
+    dest = tmpdir.join('dest').strpath
+    upload(tmpdir.join('src').strpath, dest)
+
+    plan_path = tmpdir.join('plan.jsonl').strpath
+    write_plan(tmpdir.join('other').strpath, dest, plan_path)
+    with pytest.raises(DeleteAllKeysError):
+        apply_plan(tmpdir.join('other').strpath, dest, plan_path, delete=True)
+    assert list_files(dest) == ['file_5436437fa01a7d3e.txt']
+
+    with open(plan_path) as f:
+        lines = f.readlines()
+    with open(plan_path, 'w') as f:
+        f.writelines(lines[:-1])
+    with pytest.raises(PlanError):
+        apply_plan(tmpdir.join('other').strpath, dest, plan_path)
+
+    with open(plan_path, 'w') as f:
+        f.write('{"foo": "bar"}\n')
+    with pytest.raises(PlanError):
+        apply_plan(tmpdir.join('other').strpath, dest, plan_path)
+
+    with open(plan_path, 'w') as f:
+        f.write('[1]\n')
+    with pytest.raises(PlanError):
+        apply_plan(tmpdir.join('other').strpath, dest, plan_path)
+
+
+def test_write_plan_atomic(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'file.txt').write_binary(b'file.txt')
+    dest = tmpdir.join('dest').strpath
+    plan_path = tmpdir.join('plan.jsonl').strpath
+    write_plan(tmpdir.join('src').strpath, dest, plan_path)
+    with open(plan_path) as f:
+        original = f.read()
+
+    class BadSource(FileSource):
+        def stat_file(self, rel_path):
+            raise OSError('stat failed')
+
+    with pytest.raises(SourceError):
+        write_plan(BadSource(tmpdir.join('src').strpath), dest, plan_path)
+    with open(plan_path) as f:
+        assert f.read() == original
+    assert sorted(os.listdir(tmpdir.strpath)) == ['plan.jsonl', 'src']
@@ -4,9 +4,13 @@ This is very much white-box testing, and not testing the actual upload to S3,
 but it'll do for now.
 """
 
+import sys
+import threading
+import types
+
 import pytest
 
-from cdnupload import S3Destination, FileSource
+from cdnupload import S3Destination, FileSource, RateLimiter, _ThrottledSource
 
 
 class MockBoto3:
@@ -15,6 +19,13 @@ class MockBoto3:
         self._prefix = prefix
         self._keys = keys
 
+    @property
+    def session(self):
+        return self  # stands in for the boto3.session module
+
+    def Session(self):
+        return self
+
     def client(self, name, **client_args):
         assert name == 's3'
         self._s3 = MockS3Client(self._bucket, self._prefix, self._keys, **client_args)
@@ -34,26 +45,53 @@ class MockPaginator:
         yield {'Contents': [{'Key': k} for k in self._keys]}
 
 
+class MockEvents:
+    def __init__(self):
+        self.handlers = []
+
+    def register(self, event_name, handler):
+        self.handlers.append((event_name, handler))
+
+    def emit(self, event_name, **kwargs):
+        for name, handler in self.handlers:
+            if event_name.startswith(name):
+                handler(**kwargs)
+
+
 class MockS3Client:
     def __init__(self, bucket, prefix, keys, **client_args):
+        self.meta = types.SimpleNamespace(events=MockEvents())
         self._bucket = bucket
         self._prefix = prefix
         self._keys = keys
         self._args = client_args
         self._uploads = []
+        self._multipart_uploads = []
         self._deletions = []
 
     def get_paginator(self, name):
         assert name == 'list_objects_v2'
         return MockPaginator(self._bucket, self._prefix, self._keys)
 
-    def upload_fileobj(self, file, bucket, key, ExtraArgs=None):
+    def upload_fileobj(self, file, bucket, key, ExtraArgs=None, Config=None):
         self._uploads.append((bucket, key, file.read(), ExtraArgs))
+        self._multipart_uploads.append(key)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._uploads.append((Bucket, Key, Body.read(), kwargs))
 
     def delete_object(self, Bucket, Key):
         self._deletions.append((Bucket, Key))
 
 
+def set_num_connections(client, num_connections):
+    pool = types.SimpleNamespace(num_connections=num_connections)
+    manager = types.SimpleNamespace(
+            pools=types.SimpleNamespace(_container={'pool': pool}))
+    client._endpoint = types.SimpleNamespace(
+            http_session=types.SimpleNamespace(_manager=manager))
+
+
 def test_str():
     d = S3Destination('s3://bucket/prefix', _boto3=MockBoto3())
     assert str(d) == 's3://bucket/prefix/'
@@ -110,6 +148,100 @@ def test_init():
     assert d.s3_client._args['aws_secret_access_key'] == 'SECRET'
 
 
+def test_connections(monkeypatch):
+    d = S3Destination('s3://bucket/prefix', _boto3=MockBoto3())
+    assert (d.workers, d.max_pool_connections) == (1, 10)
+    assert not d.per_thread_clients
+    d = S3Destination('s3://bucket/prefix', workers='8', _boto3=MockBoto3())
+    assert d.max_pool_connections == 80
+    d = S3Destination('s3://bucket/prefix', workers=8, max_pool_connections=20,
+                      _boto3=MockBoto3())
+    assert d.max_pool_connections == 20
+    with pytest.raises(TypeError):
+        S3Destination('s3://bucket/prefix', workers='x', _boto3=MockBoto3())
+
+    # Per-thread clients each have a pool sized for one worker
+    d = S3Destination('s3://bucket/prefix', workers=8,
+                      per_thread_clients='true', _boto3=MockBoto3())
+    assert d.per_thread_clients
+    assert d.max_pool_connections == 10
+    with d._borrow_client() as client1:
+        assert client1 is d.s3_client
+        with d._borrow_client() as client2:
+            assert client2 is not client1
+    assert len(d._clients) == 2
+
+    # Clients are reused by later threads rather than created per thread
+    clients = []
+
+    def borrow():
+        with d._borrow_client() as client:
+            clients.append(client)
+    for _ in range(5):
+        thread = threading.Thread(target=borrow)
+        thread.start()
+        thread.join()
+    assert len(d._clients) == 2
+    assert all(c in (client1, client2) for c in clients)
+    assert S3Destination('s3://bucket/prefix', per_thread_clients='false',
+                         _boto3=MockBoto3()).per_thread_clients is False
+
+    # Requests are counted with botocore events, and new connections come
+    # from urllib3's pools (if available)
+    for _ in range(15):
+        client1.meta.events.emit('request-created.s3.PutObject')
+    assert d.connection_stats() == {'clients': 2, 'requests': 15,
+                                    'connections': None, 'reused': None}
+    for client, num_connections in [(client1, 2), (client2, 1)]:
+        set_num_connections(client, num_connections)
+    assert d.connection_stats() == {'clients': 2, 'requests': 15,
+                                    'connections': 3, 'reused': 12}
+
+    # Counts from clients dropped from the pool are kept
+    d.workers = 1
+    with d._borrow_client():
+        with d._borrow_client():
+            pass
+    assert len(d._clients) == 1
+    assert d.connection_stats() == {'clients': 1, 'requests': 15,
+                                    'connections': 3, 'reused': 12}
+    assert S3Destination(
+            's3://bucket/prefix', _boto3=MockBoto3()).connection_stats() == {
+            'clients': 1, 'requests': 0, 'connections': None, 'reused': None}
+
+    # No more than "workers" idle clients are kept
+    d = S3Destination('s3://bucket/prefix', workers=1,
+                      per_thread_clients=True, _boto3=MockBoto3())
+    with d._borrow_client():
+        with d._borrow_client():
+            with d._borrow_client():
+                assert len(d._clients) == 3
+    assert len(d._clients) == 1
+    assert len(d._idle_clients) == 1
+
+    # Clients are configured with pool size and keepalive
+    class Config(object):
+        def __init__(self, **kwargs):
+            self.kwargs = kwargs
+
+        def merge(self, other):
+            return Config(**dict(self.kwargs, **other.kwargs))
+
+    botocore = types.ModuleType('botocore')
+    botocore.config = types.ModuleType('botocore.config')
+    botocore.config.Config = Config
+    monkeypatch.setitem(sys.modules, 'botocore', botocore)
+    monkeypatch.setitem(sys.modules, 'botocore.config', botocore.config)
+    d = S3Destination('s3://bucket/prefix', workers=3,
+                      client_args={'config': Config(retries={'mode': 'standard'})},
+                      _boto3=MockBoto3())
+    assert d.s3_client._args['config'].kwargs == {
+        'max_pool_connections': 30,
+        'tcp_keepalive': True,
+        'retries': {'mode': 'standard'},
+    }
+
+
 def test_keys():
     keys = ['file.txt', 'images/', 'images/bar.jpg', 'images/foo.jpg']
     mock_boto3 = MockBoto3(bucket='buck', prefix='pref/', keys=keys)
@@ -125,19 +257,52 @@ def test_upload(tmpdir):
     mock_boto3 = MockBoto3()
     d = S3Destination('s3://bucket/prefix', max_age=60, _boto3=mock_boto3)
     d.upload('test_1234.txt', s, 'test.txt')
-    mock_boto3._s3._uploads = [
+    assert mock_boto3._s3._uploads == [
         ('bucket', 'prefix/test_1234.txt', b'foo',
-            {'ContentType': 'text/plain'})
+            {'ACL': 'public-read', 'CacheControl': 'public, max-age=60',
+             'ContentType': 'text/plain'})
     ]
 
     mock_boto3 = MockBoto3()
     d = S3Destination('s3://bucket/prefix', max_age=60,
                       upload_args={'Foo': 'Bar'}, _boto3=mock_boto3)
     d.upload('image_4321.txt', s, 'image.jpg')
-    mock_boto3._s3._uploads = [
-        ('bucket', 'prefix/image_4321.txt', b'foo',
-            {'Foo': 'Bar', 'ContentType': 'image/jpeg'})
+    assert mock_boto3._s3._uploads == [
+        ('bucket', 'prefix/image_4321.txt', b'bar',
+            {'Foo': 'Bar', 'ACL': 'public-read',
+             'CacheControl': 'public, max-age=60', 'ContentType': 'image/jpeg'})
     ]
+    assert mock_boto3._s3._multipart_uploads == []
+
+
+def test_upload_multipart(tmpdir):
+    tmpdir.join('small.txt').write_binary(b'x' * 99)
+    tmpdir.join('large.txt').write_binary(b'x' * 100)
+    s = FileSource(tmpdir.strpath)
+
+    mock_boto3 = MockBoto3()
+    d = S3Destination('s3://bucket/prefix', multipart_threshold='100',
+                      _boto3=mock_boto3)
+    assert d.multipart_threshold == 100
+    d.upload('small_1.txt', s, 'small.txt')
+    d.upload('large_1.txt', s, 'large.txt')
+    assert [u[1] for u in mock_boto3._s3._uploads] == [
+        'prefix/small_1.txt', 'prefix/large_1.txt']
+    assert mock_boto3._s3._multipart_uploads == ['prefix/large_1.txt']
+
+    with pytest.raises(TypeError):
+        S3Destination('s3://bucket/prefix', max_concurrency='many',
+                      _boto3=MockBoto3())
+
+    # Throttled files are still routed by size
+    mock_boto3 = MockBoto3()
+    d = S3Destination('s3://bucket/prefix', multipart_threshold='100',
+                      _boto3=mock_boto3)
+    throttled = _ThrottledSource(s, RateLimiter(max_bandwidth=10**9))
+    d.upload('small_1.txt', throttled, 'small.txt')
+    d.upload('large_1.txt', throttled, 'large.txt')
+    assert [u[2] for u in mock_boto3._s3._uploads] == [b'x' * 99, b'x' * 100]
+    assert mock_boto3._s3._multipart_uploads == ['prefix/large_1.txt']
 
 
 def test_delete():
@@ -149,3 +314,29 @@ def test_delete():
         ('bucket', 'prefix/foo'),
         ('bucket', 'prefix/bar'),
     ]
+
+
+def test_set_s3_client():
+    custom = MockS3Client('bucket', 'prefix/', [])
+    for per_thread_clients in [False, True]:
+        d = S3Destination('s3://bucket/prefix', workers=2,
+                          per_thread_clients=per_thread_clients,
+                          _boto3=MockBoto3())
+        with d._borrow_client():
+            d.s3_client = custom
+        assert d.s3_client is custom
+        d.delete('foo')
+        assert custom._deletions[-1] == ('bucket', 'prefix/foo')
+        assert d._clients == [custom]
+
+    # Counts from the replaced clients are kept, and the new client's
+    # requests are counted too
+    d = S3Destination('s3://bucket/prefix', _boto3=MockBoto3())
+    d.s3_client.meta.events.emit('request-created.s3.PutObject')
+    set_num_connections(d.s3_client, 1)
+    custom = MockS3Client('bucket', 'prefix/', [])
+    d.s3_client = custom
+    custom.meta.events.emit('request-created.s3.PutObject')
+    set_num_connections(custom, 0)
+    assert d.connection_stats() == {'clients': 1, 'requests': 2,
+                                    'connections': 1, 'reused': 1}
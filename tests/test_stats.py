@@ -0,0 +1,349 @@
+"""Test Stats, LatencyHistogram, TimingFit, rate limiter, and throughput
+history classes, and statistics and estimates in results.
+"""
+
+import json
+
+import cdnupload
+from cdnupload import (Estimate, FileDestination, FileSource,
+                       LatencyHistogram, RateLimiter, Stats, ThroughputHistory,
+                       TimingFit, TokenBucket, delete, main, upload,
+                       _write_stats)
+
+
+def test_latency_histogram():
+    h = LatencyHistogram()
+    assert h.percentile(50) == 0.0
+    for i in range(1, 101):
+        h.add(i / 1000.0)
+    assert h.count == 100
+    assert abs(h.total - 5.05) < 0.000001
+    assert h.max == 0.1
+    assert 0.04 <= h.percentile(50) <= 0.05 * 1.25
+    assert 0.094 <= h.percentile(95) <= 0.1
+    assert h.percentile(100) == 0.1
+
+    h2 = LatencyHistogram()
+    h2.add(1000000.0)
+    h2.add(0.0)
+    h.merge(h2)
+    assert h.count == 102
+    assert h.max == 1000000.0
+    assert h.percentile(100) == 1000000.0
+
+
+def test_stats():
+    s = Stats(num_slowest=2)
+    s.add_phase_time('walk', 1.0)
+    s.add_phase_time('walk', 0.5)
+    s.add_operation('hash', 'a.txt', 0.1, 10)
+    s.add_operation('hash', 'b.txt', 0.3, 20)
+    s.add_operation('upload', 'b.txt', 0.2, 20)
+    assert s.phase_times == {'walk': 1.5}
+    assert (s.bytes_hashed, s.bytes_uploaded) == (30, 20)
+
+    d = s.as_dict()
+    assert d['operations']['hash']['count'] == 2
+    assert [x['name'] for x in d['slowest']] == ['b.txt', 'b.txt']
+    assert [x['operation'] for x in d['slowest']] == ['hash', 'upload']
+
+    s2 = Stats()
+    s2.add_operation('delete', 'c.txt', 1.0)
+    s2.add_phase_time('delete', 1.0)
+    s3 = s.copy()
+    s3.merge(s2)
+    assert s3.phase_times == {'walk': 1.5, 'delete': 1.0}
+    assert [x['name'] for x in s3.as_dict()['slowest']] == ['c.txt', 'b.txt']
+    assert 'delete' not in s.latencies
+
+    s.add_throttle(0.5)
+    s2.add_throttle(0.25)
+    s.merge(s2)
+    assert s.as_dict()['throttle'] == {'waits': 2, 'seconds': 0.75}
+
+
+def test_token_bucket():
+    now = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    bucket = TokenBucket(100, _timer=lambda: now[0], _sleep=sleep)
+    assert bucket.consume(60) == 0
+    assert bucket.consume(40) == 0
+    assert bucket.consume(50) == 0.5
+    assert sleeps == [0.5]
+
+    # Refills over time, but never beyond capacity
+    now[0] += 10
+    assert bucket.consume(100) == 0
+    # More than capacity just waits longer
+    assert bucket.consume(250) == 2.5
+
+
+def test_rate_limiter(tmpdir):
+    limiter = RateLimiter()
+    assert limiter.bandwidth is None and limiter.requests is None
+    limiter.request()
+    limiter.read(1000)
+
+    tmpdir.join('src').mkdir()
+    for name in ['a.txt', 'b.txt', 'c.txt']:
+        tmpdir.join('src', name).write_binary(b'x' * 1000)
+    limiter = RateLimiter(max_bandwidth=10000, max_requests_per_second=1000)
+    limiter.bandwidth.tokens = 0
+    result = upload(tmpdir.join('src').strpath, tmpdir.join('dest').strpath,
+                    workers=2, rate_limiter=limiter)
+    assert result.num_uploaded == 3
+    assert result.stats.bytes_uploaded == 3000
+    assert result.stats.throttle_waits >= 1
+    assert result.stats.throttle_seconds > 0.1
+    for name in ['a.txt', 'b.txt', 'c.txt']:
+        key = result.source_key_map[name]
+        assert tmpdir.join('dest', key).read_binary() == b'x' * 1000
+
+
+def test_upload_stats(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'a.txt').write_binary(b'a' * 100)
+    tmpdir.join('src', 'b.txt').write_binary(b'b' * 50)
+
+    s = FileSource(tmpdir.join('src').strpath)
+    result = upload(s, tmpdir.join('dest').strpath)
+    stats = result.stats
+    assert sorted(stats.phase_times) == ['hash', 'list', 'upload', 'walk']
+    assert stats.bytes_hashed == 150
+    assert stats.bytes_uploaded == 150
+    assert stats.latencies['hash'].count == 2
+    assert stats.latencies['upload'].count == 2
+    assert len(stats.slowest) == 4
+
+    # Key map is cached, so second upload has no walk or hash phases
+    result = upload(s, tmpdir.join('dest').strpath)
+    assert sorted(result.stats.phase_times) == ['list', 'scan', 'upload']
+    assert result.stats.bytes_uploaded == 0
+
+
+def test_main_stats(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'a.txt').write_binary(b'a' * 100)
+    json_path = tmpdir.join('stats.json').strpath
+    prom_path = tmpdir.join('stats.prom').strpath
+
+    assert main([tmpdir.join('src').strpath, tmpdir.join('dest').strpath,
+                 '--stats-json', json_path, '--stats-prometheus', prom_path,
+                 '-l', 'off']) == 0
+
+    with open(json_path) as f:
+        stats = json.load(f)
+    assert len(stats) == 1
+    assert stats[0]['destination'] == tmpdir.join('dest').strpath
+    assert stats[0]['num_uploaded'] == 1
+    assert stats[0]['bytes_uploaded'] == 100
+    assert stats[0]['operations']['upload']['count'] == 1
+
+    with open(prom_path) as f:
+        lines = f.read().splitlines()
+    assert '# TYPE cdnupload_operation_seconds summary' in lines
+    assert 'cdnupload_bytes_uploaded{{destination="{}"}} 100'.format(
+            tmpdir.join('dest').strpath) in lines
+    assert 'cdnupload_files{{destination="{}",type="uploaded"}} 1'.format(
+            tmpdir.join('dest').strpath) in lines
+
+
+def test_connection_stats(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'a.txt').write_binary(b'a')
+
+    class PooledDestination(FileDestination):
+        def connection_stats(self):
+            return {'clients': 1, 'requests': 5, 'connections': 2,
+                    'reused': 3}
+
+    d = PooledDestination(tmpdir.join('dest').strpath)
+    result = upload(tmpdir.join('src').strpath, d)
+    json_path = tmpdir.join('stats.json').strpath
+    prom_path = tmpdir.join('stats.prom').strpath
+    _write_stats([d], [result], json_path=json_path, prometheus_path=prom_path)
+
+    with open(json_path) as f:
+        stats = json.load(f)
+    assert stats[0]['connections']['reused'] == 3
+    with open(prom_path) as f:
+        lines = f.read().splitlines()
+    assert 'cdnupload_connections{{destination="{}",type="reused"}} 3'.format(
+            d.root) in lines
+
+
+def approx(a, b):
+    return abs(a - b) < 0.000001
+
+
+def test_timing_fit():
+    fit = TimingFit()
+    assert fit.solve() is None
+    for num_bytes in [100, 1000, 5000]:
+        fit.add(num_bytes, 0.05 + num_bytes * 0.001)
+    latency, seconds_per_byte = fit.solve()
+    assert approx(latency, 0.05) and approx(seconds_per_byte, 0.001)
+
+    fit2 = TimingFit.from_dict(json.loads(json.dumps(fit.as_dict())))
+    fit2.merge(fit)
+    fit2.scale(0.5)
+    assert fit2.count == 3
+    latency, seconds_per_byte = fit2.solve()
+    assert approx(latency, 0.05) and approx(seconds_per_byte, 0.001)
+
+    # Can't separate latency from bandwidth when sizes are all the same
+    fit = TimingFit()
+    fit.add(100, 1.0)
+    fit.add(100, 2.0)
+    assert fit.solve() == (0.0, 0.015)
+
+    # Operations without bytes (like deletes) just have a latency
+    fit = TimingFit()
+    fit.add(0, 0.1)
+    fit.add(0, 0.3)
+    latency, seconds_per_byte = fit.solve()
+    assert approx(latency, 0.2) and seconds_per_byte == 0.0
+
+    s = Stats()
+    s.add_operation('upload', 'a.txt', 0.5, 10)
+    s.add_operation('upload', 'b.txt', 1.5, 20)
+    s2 = s.copy()
+    assert s2.fits['upload'].as_dict() == {
+        'count': 2, 'bytes': 30.0, 'seconds': 2.0, 'bytes_squared': 500.0,
+        'bytes_seconds': 35.0}
+
+
+def test_estimate():
+    class MultipartDestination(object):
+        multipart_threshold = 100
+        multipart_chunksize = 40
+
+    fit = TimingFit()
+    for num_bytes in [0, 1000]:
+        fit.add(num_bytes, 0.1 + num_bytes * 0.01)
+    e = Estimate()
+    e.add_list(2, 0.25)
+    e.add_uploads(MultipartDestination(), [10, 100, 250], fit=fit, workers=2)
+    assert e.bytes == 360
+    assert e.requests == {'put': 1, 'multipart_uploads': 2,
+                          'multipart_parts': 10, 'delete': 0, 'list': 2}
+    # Per-upload times are 0.2, 1.1, and 2.6, so the largest is the limit
+    assert approx(e.seconds['upload'], 2.6)
+
+    delete_fit = TimingFit()
+    delete_fit.add(0, 0.5)
+    e.add_deletes(3, fit=delete_fit)
+    assert e.requests['delete'] == 3
+    assert approx(e.total_seconds, 0.25 + 2.6 + 1.5)
+    assert e.as_dict()['total_seconds'] == e.total_seconds
+    assert str(e).startswith('360 bytes to upload, 18 requests (1 put, ')
+
+    e = Estimate()
+    e.add_uploads(object(), [10, 20], fit=fit, workers=1,
+                  rate_limiter=RateLimiter(max_bandwidth=1))
+    assert e.requests['put'] == 2
+    assert e.seconds['upload'] == 30.0
+    e.add_deletes(1)
+    assert e.seconds['delete'] is None
+    assert e.total_seconds is None
+    assert str(e).endswith('no throughput history to estimate time')
+
+
+def test_throughput_history(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'a.txt').write_binary(b'a' * 100)
+    tmpdir.join('src', 'b.txt').write_binary(b'b' * 1000)
+    src = tmpdir.join('src').strpath
+    dest = tmpdir.join('dest').strpath
+    history_path = tmpdir.join('history.json').strpath
+
+    # Dry run without history still counts bytes, requests, and list pages
+    tmpdir.join('dest', 'old', 'x.txt').write_binary(b'x', ensure=True)
+    result = upload(src, dest, dry_run=True)
+    estimate = result.stats.estimate
+    assert estimate.bytes == 1100
+    assert estimate.requests == {'put': 2, 'multipart_uploads': 0,
+                                 'multipart_parts': 0, 'delete': 0, 'list': 2}
+    assert estimate.seconds['upload'] is None
+    assert 'estimate' in result.stats.as_dict()
+
+    history = ThroughputHistory(history_path)
+    assert history.destinations == {}
+    result = upload(src, dest, history=history)
+    assert result.stats.estimate is None
+    result = delete(src, dest, history=history)
+    assert result.num_deleted == 1
+    history.save()
+
+    history = ThroughputHistory(history_path)
+    assert history.get_fit(dest, 'upload').count == 2
+    assert history.get_fit(dest, 'delete').count == 1
+    tmpdir.join('src', 'c.txt').write_binary(b'c' * 500)
+    tmpdir.join('src', 'a.txt').remove()
+    result = upload(src, dest, dry_run=True, history=history)
+    estimate = result.stats.estimate
+    assert estimate.bytes == 500
+    assert estimate.requests['put'] == 1
+    assert estimate.seconds['upload'] is not None
+    assert delete(src, dest, dry_run=True,
+                  history=history).stats.estimate.requests['delete'] == 1
+
+    history = ThroughputHistory(history_path, max_count=2)
+    history.record(dest, result.stats, 'upload')
+    assert history.get_fit(dest, 'upload').count == 2
+    history.record(dest, Stats(), 'upload')
+
+    tmpdir.join('bad.json').write('{"version": 99}')
+    assert ThroughputHistory(tmpdir.join('bad.json').strpath).destinations == {}
+
+
+def test_main_throughput_history(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'a.txt').write_binary(b'a' * 100)
+    src = tmpdir.join('src').strpath
+    dest = tmpdir.join('dest').strpath
+    history_path = tmpdir.join('history.json').strpath
+    json_path = tmpdir.join('stats.json').strpath
+
+    assert main([src, dest, '--throughput-history', history_path,
+                 '-l', 'off']) == 0
+    with open(history_path) as f:
+        history = json.load(f)
+    assert history['destinations'][dest]['upload']['count'] == 1
+
+    tmpdir.join('src', 'b.txt').write_binary(b'b' * 200)
+    assert main([src, dest, '--throughput-history', history_path,
+                 '--action', 'sync', '--dry-run', '--stats-json', json_path,
+                 '-l', 'off']) == 0
+    with open(json_path) as f:
+        estimate = json.load(f)[0]['estimate']
+    assert estimate['bytes'] == 200
+    assert estimate['requests']['put'] == 1
+    assert estimate['total_seconds'] is not None
+    with open(history_path) as f:
+        assert json.load(f) == history
+
+
+def test_list_pages_without_hooks(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'a.txt').write_binary(b'a')
+
+    class PagedDestination(FileDestination):
+        def walk_keys(self):
+            # Counting pages doesn't register a hook
+            assert not cdnupload._hooks
+            for page in [['x_0123456789abcdef.txt'], []]:
+                cdnupload._list_page(self, len(page))
+                for key in page:
+                    yield key
+
+    d = PagedDestination(tmpdir.join('dest').strpath)
+    result = upload(tmpdir.join('src').strpath, d, dry_run=True)
+    assert result.stats.latencies['list'].count == 2
+    assert result.stats.estimate.requests['list'] == 2
+    assert cdnupload._list_page_local.callback is None
@@ -0,0 +1,101 @@
+"""Test sync() function."""
+
+import os
+
+import pytest
+
+from cdnupload import (DeleteAllKeysError, FileSource, FileDestination, sync,
+                       upload)
+
+
+def list_files(top):
+    lst = []
+    for root, dirs, files in os.walk(top):
+        for file in files:
+            full_path = os.path.join(root, file)
+            rel_path = os.path.relpath(full_path, top)
+            lst.append(rel_path.replace('\\', '/'))
+    lst.sort()
+    return lst
+
+
+def test_sync(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'file.txt').write_binary(b'file.txt')
+    tmpdir.join('src', 'images').mkdir()
+    tmpdir.join('src', 'images', '1.jpg').write_binary(b'1.jpg')
+
+    class CountingDestination(FileDestination):
+        def walk_keys(self):
+            self._walks += 1
+            return FileDestination.walk_keys(self)
+
+    num_walks = [0]
+    def count_os_walk(*args, **kwargs):
+        num_walks[0] += 1
+        for root, dirs, files in os.walk(*args, **kwargs):
+            yield (root, dirs, files)
+
+    s = FileSource(tmpdir.join('src').strpath, _os_walk=count_os_walk)
+    d = CountingDestination(tmpdir.join('dest').strpath)
+    d._walks = 0
+
+    result = sync(s, d)
+    assert (result.num_scanned, result.num_processed, result.num_errors) == (2, 2, 0)
+    assert (result.num_uploaded, result.num_deleted) == (2, 0)
+    assert list_files(d.root) == [
+        'file_5436437fa01a7d3e.txt',
+        'images/1_accf102caaa970ce.jpg',
+    ]
+
+    tmpdir.join('src', 'file.txt').write_binary(b'changed')
+    s = FileSource(tmpdir.join('src').strpath, _os_walk=count_os_walk)
+    num_walks[0] = 0
+    d._walks = 0
+
+    result = sync(s, d, dry_run=True)
+    assert (result.num_uploaded, result.num_deleted) == (1, 1)
+    assert list_files(d.root) == [
+        'file_5436437fa01a7d3e.txt',
+        'images/1_accf102caaa970ce.jpg',
+    ]
+
+    result = sync(s, d)
+    assert (result.num_scanned, result.num_processed, result.num_errors) == (4, 2, 0)
+    assert (result.num_uploaded, result.num_deleted) == (1, 1)
+    assert list_files(d.root) == [
+        'file_37c6c57bedf4305e.txt',
+        'images/1_accf102caaa970ce.jpg',
+    ]
+    assert num_walks[0] == 1
+    assert d._walks == 2
+
+
+def test_sync_delete_all(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'file.txt').write_binary(b'file.txt')
+    tmpdir.join('other').mkdir()
+    tmpdir.join('other', 'other.txt').write_binary(b'other')
+    d = tmpdir.join('dest').strpath
+    upload(tmpdir.join('src').strpath, d)
+
+    with pytest.raises(DeleteAllKeysError):
+        sync(tmpdir.join('other').strpath, d)
+    assert list_files(d) == ['file_5436437fa01a7d3e.txt']
+
+    result = sync(tmpdir.join('other').strpath, d, force=True)
+    assert (result.num_uploaded, result.num_deleted) == (1, 1)
+    assert list_files(d) == ['other_d0941e68da8f3815.txt']
+
+
+def test_sync_multiple_destinations(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'file.txt').write_binary(b'file.txt')
+    d1 = tmpdir.join('dest1').strpath
+    d2 = tmpdir.join('dest2').strpath
+    upload(tmpdir.join('src').strpath, d2)
+    tmpdir.join('dest2', 'old_1234.txt').write_binary(b'old')
+
+    results = sync(tmpdir.join('src').strpath, [d1, d2], delete_delay=0.01)
+    assert [(r.num_uploaded, r.num_deleted) for r in results] == [(1, 0), (0, 1)]
+    assert list_files(d1) == list_files(d2) == ['file_5436437fa01a7d3e.txt']
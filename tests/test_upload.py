@@ -1,11 +1,13 @@
 """Test upload() function."""
 
+import io
 import os
+import threading
 
 import pytest
 
 from cdnupload import (SourceError, DestinationError, FileSource,
-                       FileDestination, upload)
+                       FileDestination, upload, _SharedSource, _upload_order)
 
 
 def list_files(top):
@@ -134,3 +136,170 @@ def test_str_destination(tmpdir):
     assert list_files(tmpdir.join('dest').strpath) == sorted(destination_keys)
     assert result.source_key_map == source_key_map
     assert result.destination_keys == set()
+
+
+def test_upload_multiple_destinations(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'file.txt').write_binary(b'file.txt')
+    tmpdir.join('src', 'images').mkdir()
+    tmpdir.join('src', 'images', '1.jpg').write_binary(b'1.jpg')
+
+    source_key_map = {
+        'file.txt': 'file_5436437fa01a7d3e.txt',
+        'images/1.jpg': 'images/1_accf102caaa970ce.jpg',
+    }
+
+    class CountingSource(FileSource):
+        def open(self, rel_path):
+            self._opens.append(rel_path)
+            return FileSource.open(self, rel_path)
+
+    s = CountingSource(tmpdir.join('src').strpath)
+    s._opens = []
+    d1 = tmpdir.join('dest1').strpath
+    d2 = FileDestination(tmpdir.join('dest2').strpath)
+    upload(s, d1, dry_run=True)
+    upload(s, tmpdir.join('dest2').strpath)
+    tmpdir.join('dest2', 'file_5436437fa01a7d3e.txt').remove()
+
+    s._opens = []
+    results = upload(s, [d1, d2])
+    assert len(results) == 2
+    assert [(r.num_scanned, r.num_processed, r.num_errors) for r in results] == [
+        (2, 2, 0),
+        (2, 1, 0),
+    ]
+    assert results[0].source_key_map == source_key_map
+    assert results[1].destination_keys == {'images/1_accf102caaa970ce.jpg'}
+    assert list_files(d1) == sorted(source_key_map.values())
+    assert list_files(d2.root) == sorted(source_key_map.values())
+    assert sorted(s._opens) == ['file.txt', 'images/1.jpg']
+
+    results = upload(s, (d1, d2), force=True)
+    assert [r.num_processed for r in results] == [2, 2]
+    assert sorted(s._opens) == ['file.txt', 'file.txt', 'images/1.jpg', 'images/1.jpg']
+
+    class UploadErrorDestination(FileDestination):
+        def upload(self, key, source, rel_path):
+            raise Exception('error')
+
+    de = UploadErrorDestination(tmpdir.join('dest3').strpath)
+    with pytest.raises(DestinationError):
+        upload(s, [d1, de], force=True)
+    results = upload(s, [d1, de], force=True, continue_on_errors=True)
+    assert [(r.num_processed, r.num_errors) for r in results] == [(2, 0), (0, 2)]
+
+
+def test_upload_workers(tmpdir):
+    tmpdir.join('src').mkdir()
+    for i, size in enumerate([10, 300, 20, 200, 0]):
+        tmpdir.join('src', 'file{}.txt'.format(i)).write_binary(b'x' * size)
+    tmpdir.join('dest').mkdir()
+
+    class RecordingDestination(FileDestination):
+        def upload(self, key, source, rel_path):
+            self.uploads.append(rel_path)
+            return FileDestination.upload(self, key, source, rel_path)
+
+    d = RecordingDestination(tmpdir.join('dest').strpath)
+    d.uploads = []
+    result = upload(tmpdir.join('src').strpath, d, workers=1)
+    assert result.num_uploaded == 5
+    assert d.uploads == ['file0.txt', 'file1.txt', 'file2.txt', 'file3.txt',
+                         'file4.txt']
+
+    tmpdir.join('dest').remove()
+    tmpdir.join('dest').mkdir()
+    d.uploads = []
+    result = upload(tmpdir.join('src').strpath, d, workers=3)
+    assert result.num_uploaded == 5
+    assert len(list_files(tmpdir.join('dest').strpath)) == 5
+    assert sorted(d.uploads) == ['file0.txt', 'file1.txt', 'file2.txt',
+                                 'file3.txt', 'file4.txt']
+
+
+def test_upload_order(tmpdir):
+    for name, size in [('a', 10), ('b', 300), ('c', 20), ('d', 300)]:
+        tmpdir.join(name).write_binary(b'x' * size)
+    items = [(n, n + '_key') for n in ['a', 'b', 'c', 'd', 'missing']]
+    order = _upload_order(FileSource(tmpdir.strpath), items)
+    # Largest first, then by path; files that can't be stat'ed go last
+    assert [rel_path for rel_path, _ in order] == ['b', 'd', 'c', 'a', 'missing']
+
+
+def test_upload_workers_errors(tmpdir):
+    tmpdir.join('src').mkdir()
+    for i in range(6):
+        tmpdir.join('src', 'file{}.txt'.format(i)).write_binary(b'x' * i)
+
+    class FailingDestination(FileDestination):
+        def upload(self, key, source, rel_path):
+            if rel_path in ('file2.txt', 'file4.txt'):
+                raise IOError('upload failed')
+            return FileDestination.upload(self, key, source, rel_path)
+
+    d = FailingDestination(tmpdir.join('dest').strpath)
+    with pytest.raises(DestinationError):
+        upload(tmpdir.join('src').strpath, d, workers=3)
+
+    d = FailingDestination(tmpdir.join('dest2').strpath)
+    result = upload(tmpdir.join('src').strpath, d, workers=3,
+                    continue_on_errors=True)
+    assert (result.num_errors, result.num_uploaded) == (2, 4)
+
+
+def test_upload_check_existing(tmpdir):
+    tmpdir.join('src').mkdir()
+    tmpdir.join('src', 'a.txt').write_binary(b'a')
+    tmpdir.join('src', 'b.txt').write_binary(b'b')
+    tmpdir.join('dest').mkdir()
+    tmpdir.join('dest', 'old_0123456789abcdef.txt').write_binary(b'old')
+    tmpdir.join('dest', 'a_86f7e437faa5a7fc.txt').write_binary(b'a')
+
+    class NoListDestination(FileDestination):
+        def walk_keys(self):
+            raise AssertionError('walk_keys() should not be called')
+
+    s = tmpdir.join('src').strpath
+    d = NoListDestination(tmpdir.join('dest').strpath)
+    result = upload(s, d, check_existing=True)
+    assert result.num_uploaded == 1
+    assert result.destination_keys == {'a_86f7e437faa5a7fc.txt'}
+    assert list_files(tmpdir.join('dest').strpath) == [
+        'a_86f7e437faa5a7fc.txt', 'b_e9d71f5ee7c92d6d.txt',
+        'old_0123456789abcdef.txt']
+
+    # Destinations without exists_many() are listed as usual
+    result = upload(s, FileDestination(tmpdir.join('dest').strpath),
+                    check_existing=True)
+    assert result.num_uploaded == 0
+
+
+def test_shared_source_per_path_locks():
+    slow_started = threading.Event()
+    release_slow = threading.Event()
+
+    class SlowSource(object):
+        def open(self, rel_path):
+            if rel_path == 'slow.txt':
+                slow_started.set()
+                assert release_slow.wait(5)
+            return io.BytesIO(rel_path.encode('ascii'))
+
+    shared = _SharedSource(SlowSource(), {'slow.txt': 2, 'fast.txt': 2})
+    contents = []
+    thread = threading.Thread(
+            target=lambda: contents.append(shared.open('slow.txt').read()))
+    thread.start()
+    try:
+        assert slow_started.wait(5)
+        # Reading another file isn't held up by the slow read
+        assert shared.open('fast.txt').read() == b'fast.txt'
+        assert shared.open('fast.txt').read() == b'fast.txt'
+        assert shared.open('other.txt').read() == b'other.txt'
+    finally:
+        release_slow.set()
+        thread.join()
+    assert contents == [b'slow.txt']
+    assert shared.open('slow.txt').read() == b'slow.txt'
+    assert shared._num_readers == {} and shared._path_locks == {}